@@ -0,0 +1,96 @@
+import os
+import json
+import types
+import asyncio
+import threading
+
+# -------------------------
+# Minimal async-native ZhipuAI chat client (httpx.AsyncClient, one connection
+# pool per event loop: Plan.main / Write.main run asyncio.run per example and
+# Batch thread mode runs a loop per thread, and pooled connections cannot cross
+# loops). Exposes the same `chat.completions.create(...)` surface as
+# the SDK, but as a coroutine, and returns objects shaped like the SDK's
+# (choices[0].message.content, usage.prompt_tokens, ...), so LLM.achat_completion
+# and Limiter.AsyncResilientClient treat it like any other client.
+#   PRISM_ZHIPUAI_BASE_URL   - API root (default https://open.bigmodel.cn/api/paas/v4)
+#   PRISM_LLM_TIMEOUT        - per-request timeout in seconds (default 300)
+#   PRISM_ASYNC_MAX_CONNECTIONS - HTTP connection pool size (default 100)
+# -------------------------
+ZHIPUAI_BASE_URL = os.getenv("PRISM_ZHIPUAI_BASE_URL", "https://open.bigmodel.cn/api/paas/v4")
+LLM_TIMEOUT = float(os.getenv("PRISM_LLM_TIMEOUT", "300"))
+ASYNC_MAX_CONNECTIONS = int(os.getenv("PRISM_ASYNC_MAX_CONNECTIONS", "100"))
+
+
+class APIStatusError(Exception):
+    # carries status_code so Limiter.is_throttle_error / is_retryable_error classify it
+    def __init__(self, status_code, message):
+        super().__init__(f"HTTP {status_code}: {message}")
+        self.status_code = status_code
+
+
+def to_namespace(value):
+    if isinstance(value, dict):
+        return types.SimpleNamespace(**{k: to_namespace(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [to_namespace(v) for v in value]
+    return value
+
+
+class AsyncZhipuAI:
+    def __init__(self, api_key, base_url=ZHIPUAI_BASE_URL, timeout=LLM_TIMEOUT, max_connections=ASYNC_MAX_CONNECTIONS):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._http = {}  # event loop -> httpx.AsyncClient, created on first use
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def _client(self):
+        # the pool of the running loop; pools of closed loops are dropped (their
+        # connections died with the loop and can no longer be closed cleanly)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            for stale in [l for l in self._http if l.is_closed()]:
+                del self._http[stale]
+            http = self._http.get(loop)
+            if http is None:
+                import httpx  # installed with the zhipuai SDK
+                http = self._http[loop] = httpx.AsyncClient(
+                    base_url=self.base_url,
+                    timeout=self.timeout,
+                    limits=httpx.Limits(max_connections=self.max_connections,
+                                        max_keepalive_connections=self.max_connections),
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                )
+        return http
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        payload = dict(kwargs, model=model, messages=messages, stream=stream)
+        if stream:
+            return self._stream(payload)
+        response = await self._client().post("/chat/completions", json=payload)
+        if response.status_code >= 400:
+            raise APIStatusError(response.status_code, response.text)
+        return to_namespace(response.json())
+
+    async def _stream(self, payload):
+        # server-sent events: "data: {...}" lines, terminated by "data: [DONE]"
+        async with self._client().stream("POST", "/chat/completions", json=payload) as response:
+            if response.status_code >= 400:
+                body = await response.aread()
+                raise APIStatusError(response.status_code, body.decode("utf-8", "replace"))
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                yield to_namespace(json.loads(data))
+
+    async def aclose(self):
+        # closes the pool of the running loop
+        with self._lock:
+            http = self._http.pop(asyncio.get_running_loop(), None)
+        if http is not None:
+            await http.aclose()
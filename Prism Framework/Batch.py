@@ -0,0 +1,474 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import Limiter
+import Trace
+
+# -------------------------
+# Multi-example batch runner
+# Runs Plan.main then Write.main for every task, N examples at a time,
+# recording progress in progress.json (same fields as the historical
+# runner: status / plan_done / write_done / errors / *_path / *_finished_at).
+# Completed stages are skipped on restart.
+# -------------------------
+
+
+def now_str():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+# -------------------------
+# progress.json (atomic, thread-safe)
+# -------------------------
+class ProgressStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.data = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.data = json.load(f)
+            except Exception as e:
+                print(f"[WARN] cannot read progress file {path}: {e}")
+
+    def get(self, example_id):
+        with self._lock:
+            return dict(self.data.get(example_id, {}))
+
+    def update(self, example_id, error=None, **fields):
+        with self._lock:
+            entry = self.data.setdefault(example_id, {
+                "status": "pending", "plan_done": False, "write_done": False, "errors": []
+            })
+            entry.update(fields)
+            if error:
+                entry.setdefault("errors", []).append(error)
+            entry["updated_at"] = now_str()
+            self._save()
+            return dict(entry)
+
+    def _save(self):
+        # write-then-rename so a crash never leaves a truncated progress.json
+        tmp_path = f"{self.path}.tmp"
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+# -------------------------
+# task list loading
+# accepts a JSON list of {"example_id"/"id", "task"/"creative_input"/"prompt"},
+# a JSON dict {example_id: task}, or JSONL with one object per line
+# -------------------------
+def load_tasks(path):
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    if isinstance(data, dict):
+        return [(str(k), v) for k, v in data.items()]
+
+    tasks = []
+    for i, item in enumerate(data):
+        if isinstance(item, str):
+            tasks.append((f"example_{i:03d}", item))
+            continue
+        example_id = item.get("example_id") or item.get("id") or f"example_{i:03d}"
+        task = item.get("task") or item.get("creative_input") or item.get("prompt") or ""
+        tasks.append((str(example_id), task))
+    return tasks
+
+
+# -------------------------
+# stage jobs (top-level so they can run in a process pool)
+# -------------------------
+def init_worker(rpm_share, trace_path=None):
+    Limiter.set_rate_limit(rpm_share)
+    if trace_path:
+        Trace.set_trace_path(trace_path)
+
+
+def run_plan_stage(example_id, task, example_dir):
+    import Plan
+    plan_path = os.path.join(example_dir, "story_plan.json")
+    Plan.main(example_id=example_id, creative_input=task, output_dir=example_dir, plan_output_file=plan_path)
+    if not os.path.exists(plan_path):
+        raise RuntimeError(f"plan file not written: {plan_path}")
+    return plan_path
+
+
+def run_write_stage(example_id, plan_path, example_dir, plan=None):
+    import Write
+    write_path = os.path.join(example_dir, "story_text.txt")
+    Write.main(example_id=example_id, plan_path=plan_path, output_dir=example_dir, plan=plan)
+    if not os.path.exists(write_path):
+        raise RuntimeError(f"story text not written: {write_path}")
+    return write_path
+
+
+# -------------------------
+# scheduler: at most `workers` examples in flight, each a plan -> write chain
+# -------------------------
+def run_batch(tasks, output_dir="outputs", workers=4, rpm=0, mode="thread", progress_path=None, trace_path=None):
+    progress = ProgressStore(progress_path or os.path.join(output_dir, "progress.json"))
+    workers = max(1, workers)
+    # spans from every worker go to one JSONL file; a p50/p95 report is written at the end
+    trace_path = trace_path or os.path.join(output_dir, "trace.jsonl")
+
+    if mode == "process":
+        # each process gets an equal share of the global request budget
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                   initargs=(rpm / workers if rpm else 0, trace_path))
+    else:
+        init_worker(rpm, trace_path)
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prism-batch")
+
+    pending = []
+    for example_id, task in tasks:
+        entry = progress.get(example_id)
+        if entry.get("write_done") and entry.get("plan_done"):
+            print(f"[INFO] {example_id} already completed, skipping")
+            continue
+        pending.append((example_id, task))
+    pending.reverse()
+
+    in_flight = {}  # future -> (stage, example_id, task, example_dir)
+
+    def submit_next_stage(example_id, task, example_dir):
+        entry = progress.get(example_id)
+        plan_path = entry.get("plan_path")
+        if not (entry.get("plan_done") and plan_path and os.path.exists(plan_path)):
+            progress.update(example_id, status="running")
+            future = pool.submit(run_plan_stage, example_id, task, example_dir)
+            in_flight[future] = ("plan", example_id, task, example_dir)
+        elif not entry.get("write_done"):
+            progress.update(example_id, status="running")
+            future = pool.submit(run_write_stage, example_id, plan_path, example_dir)
+            in_flight[future] = ("write", example_id, task, example_dir)
+        else:
+            progress.update(example_id, status="completed")
+
+    def fill():
+        while pending and len(in_flight) < workers:
+            example_id, task = pending.pop()
+            submit_next_stage(example_id, task, os.path.abspath(os.path.join(output_dir, example_id)))
+
+    try:
+        fill()
+        while in_flight:
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, example_id, task, example_dir = in_flight.pop(future)
+                try:
+                    path = future.result()
+                except Exception as e:
+                    print(f"[ERROR] {example_id} {stage} stage failed: {e}")
+                    progress.update(example_id, status="failed", error=f"{stage}: {e}")
+                    continue
+                if stage == "plan":
+                    progress.update(example_id, plan_done=True, plan_path=path, plan_finished_at=now_str())
+                else:
+                    progress.update(example_id, write_done=True, write_path=path, write_finished_at=now_str())
+                submit_next_stage(example_id, task, example_dir)
+            fill()
+    finally:
+        pool.shutdown(wait=True)
+
+    if os.path.exists(trace_path):
+        Trace.write_trace_report(trace_path, os.path.join(os.path.dirname(trace_path), "trace_report.json"))
+    return progress.data
+
+
+# -------------------------
+# pipelined scheduler: Plan and Write as two stages with their own queues and
+# worker threads. A finished plan goes to the write queue in memory (the plan
+# file is still written for resume). The write queue is bounded, so plan
+# workers wait instead of piling up plans the writers cannot absorb. Both
+# stages share the process-wide LLM rate limiter and concurrency budget.
+# Queue depth and busy workers per stage are sampled every
+# `sample_interval` seconds and written to pipeline_report.json.
+# -------------------------
+_STOP = object()
+
+
+class StageStats:
+    def __init__(self, name, workers, stage_queue):
+        self.name = name
+        self.workers = workers
+        self.queue = stage_queue
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_s = 0.0
+        self.blocked_s = 0.0  # time spent waiting for room in the next stage's queue
+        self.samples = []  # (queue_depth, busy)
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.busy += 1
+        return time.perf_counter()
+
+    def finish(self, started, ok):
+        with self._lock:
+            self.busy -= 1
+            self.busy_s += time.perf_counter() - started
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def add_blocked(self, seconds):
+        with self._lock:
+            self.blocked_s += seconds
+
+    def sample(self):
+        with self._lock:
+            depth, busy = self.queue.qsize(), self.busy
+            self.samples.append((depth, busy))
+        return depth, busy
+
+    def report(self, wall_s):
+        with self._lock:
+            depths = [d for d, _ in self.samples] or [0]
+            busy = [b for _, b in self.samples] or [0]
+            return {
+                "workers": self.workers,
+                "completed": self.completed,
+                "failed": self.failed,
+                "queue_depth_mean": round(sum(depths) / len(depths), 2),
+                "queue_depth_max": max(depths),
+                "busy_workers_mean": round(sum(busy) / len(busy), 2),
+                "utilization": round(self.busy_s / (self.workers * wall_s), 3) if wall_s > 0 else 0.0,
+                "blocked_s": round(self.blocked_s, 2),
+            }
+
+
+def run_pipeline(tasks, output_dir="outputs", plan_workers=2, write_workers=2, rpm=0, progress_path=None,
+                 trace_path=None, write_queue_size=None, sample_interval=5.0):
+    progress = ProgressStore(progress_path or os.path.join(output_dir, "progress.json"))
+    plan_workers, write_workers = max(1, plan_workers), max(1, write_workers)
+    trace_path = trace_path or os.path.join(output_dir, "trace.jsonl")
+    init_worker(rpm, trace_path)
+
+    plan_queue = queue.Queue()
+    write_queue = queue.Queue(maxsize=write_queue_size or 2 * write_workers)
+    plan_stats = StageStats("plan", plan_workers, plan_queue)
+    write_stats = StageStats("write", write_workers, write_queue)
+
+    resumed = []
+    for example_id, task in tasks:
+        entry = progress.get(example_id)
+        example_dir = os.path.abspath(os.path.join(output_dir, example_id))
+        if entry.get("write_done") and entry.get("plan_done"):
+            print(f"[INFO] {example_id} already completed, skipping")
+            continue
+        plan_path = entry.get("plan_path")
+        if entry.get("plan_done") and plan_path and os.path.exists(plan_path):
+            resumed.append((example_id, task, example_dir, plan_path))  # Write reads the plan file
+        else:
+            plan_queue.put((example_id, task, example_dir))
+
+    def put_write(item):
+        # blocks while the writers are saturated; counted as plan-stage back-pressure
+        started = time.perf_counter()
+        write_queue.put(item)
+        plan_stats.add_blocked(time.perf_counter() - started)
+
+    def plan_worker():
+        while True:
+            try:
+                example_id, task, example_dir = plan_queue.get_nowait()
+            except queue.Empty:
+                return
+            progress.update(example_id, status="running")
+            started = plan_stats.start()
+            plan_path = os.path.join(example_dir, "story_plan.json")
+            try:
+                import Plan
+                plan = Plan.main(example_id=example_id, creative_input=task, output_dir=example_dir,
+                                 plan_output_file=plan_path)
+            except Exception as e:
+                plan_stats.finish(started, ok=False)
+                print(f"[ERROR] {example_id} plan stage failed: {e}")
+                progress.update(example_id, status="failed", error=f"plan: {e}")
+                continue
+            plan_stats.finish(started, ok=True)
+            progress.update(example_id, plan_done=True, plan_path=plan_path, plan_finished_at=now_str())
+            put_write((example_id, example_dir, plan_path, plan))
+
+    def write_worker():
+        while True:
+            item = write_queue.get()
+            if item is _STOP:
+                return
+            example_id, example_dir, plan_path, plan = item
+            progress.update(example_id, status="running")
+            started = write_stats.start()
+            try:
+                path = run_write_stage(example_id, plan_path, example_dir, plan=plan)
+            except Exception as e:
+                write_stats.finish(started, ok=False)
+                print(f"[ERROR] {example_id} write stage failed: {e}")
+                progress.update(example_id, status="failed", error=f"write: {e}")
+                continue
+            write_stats.finish(started, ok=True)
+            progress.update(example_id, write_done=True, write_path=path, write_finished_at=now_str(),
+                            status="completed")
+
+    done = threading.Event()
+
+    def sampler():
+        while not done.wait(sample_interval):
+            plan_depth, plan_busy = plan_stats.sample()
+            write_depth, write_busy = write_stats.sample()
+            print(f"[INFO] pipeline queues: plan {plan_depth} queued / {plan_busy} busy, "
+                  f"write {write_depth} queued / {write_busy} busy")
+        plan_stats.sample()
+        write_stats.sample()
+
+    wall_start = time.perf_counter()
+    sampler_thread = threading.Thread(target=sampler, name="prism-pipeline-sampler", daemon=True)
+    sampler_thread.start()
+    writers = [threading.Thread(target=write_worker, name=f"prism-write-{i}") for i in range(write_workers)]
+    planners = [threading.Thread(target=plan_worker, name=f"prism-plan-{i}") for i in range(plan_workers)]
+    for t in writers + planners:
+        t.start()
+    try:
+        for example_id, task, example_dir, plan_path in resumed:
+            put_write((example_id, example_dir, plan_path, None))
+        for t in planners:
+            t.join()
+    finally:
+        for _ in writers:
+            write_queue.put(_STOP)
+        for t in writers:
+            t.join()
+        done.set()
+        sampler_thread.join()
+    wall_s = time.perf_counter() - wall_start
+
+    report = {
+        "wall_s": round(wall_s, 2),
+        "stages": {"plan": plan_stats.report(wall_s), "write": write_stats.report(wall_s)},
+    }
+    report_path = os.path.join(output_dir, "pipeline_report.json")
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[INFO] Pipeline report written to {report_path}")
+    except Exception as e:
+        print(f"[WARN] cannot write pipeline report {report_path}: {e}")
+
+    if os.path.exists(trace_path):
+        Trace.write_trace_report(trace_path, os.path.join(os.path.dirname(trace_path), "trace_report.json"))
+    return progress.data
+
+
+# -------------------------
+# asyncio scheduler: every example is a coroutine (Plan.amain then
+# Write.amain with the plan handed over in memory) on one event loop, so
+# hundreds of examples can be in flight without a thread each. LLM calls are
+# still bounded by the shared rate limiter / AIMD concurrency budget; set
+# PRISM_ASYNC_CLIENT=1 to use the async-native HTTP client instead of worker
+# threads around the synchronous SDK.
+# -------------------------
+async def arun_batch(tasks, output_dir="outputs", workers=100, progress_path=None):
+    import Plan
+    import Write
+    progress = ProgressStore(progress_path or os.path.join(output_dir, "progress.json"))
+    slots = asyncio.Semaphore(max(1, workers))
+
+    async def run_example(example_id, task):
+        entry = progress.get(example_id)
+        if entry.get("write_done") and entry.get("plan_done"):
+            print(f"[INFO] {example_id} already completed, skipping")
+            return
+        example_dir = os.path.abspath(os.path.join(output_dir, example_id))
+        async with slots:
+            progress.update(example_id, status="running")
+            plan_path = entry.get("plan_path")
+            plan = None
+            stage = "plan"
+            try:
+                if not (entry.get("plan_done") and plan_path and os.path.exists(plan_path)):
+                    plan_path = os.path.join(example_dir, "story_plan.json")
+                    plan = await Plan.amain(example_id=example_id, creative_input=task, output_dir=example_dir,
+                                            plan_output_file=plan_path)
+                    progress.update(example_id, plan_done=True, plan_path=plan_path, plan_finished_at=now_str())
+                stage = "write"
+                await Write.amain(example_id=example_id, plan_path=plan_path, output_dir=example_dir, plan=plan)
+                write_path = os.path.join(example_dir, "story_text.txt")
+                if not os.path.exists(write_path):
+                    raise RuntimeError(f"story text not written: {write_path}")
+            except Exception as e:
+                print(f"[ERROR] {example_id} {stage} stage failed: {e}")
+                progress.update(example_id, status="failed", error=f"{stage}: {e}")
+                return
+            progress.update(example_id, write_done=True, write_path=write_path, write_finished_at=now_str(),
+                            status="completed")
+
+    await asyncio.gather(*(run_example(example_id, task) for example_id, task in tasks))
+    return progress.data
+
+
+def run_async_batch(tasks, output_dir="outputs", workers=100, rpm=0, progress_path=None, trace_path=None):
+    trace_path = trace_path or os.path.join(output_dir, "trace.jsonl")
+    init_worker(rpm, trace_path)
+    results = asyncio.run(arun_batch(tasks, output_dir=output_dir, workers=workers, progress_path=progress_path))
+    if os.path.exists(trace_path):
+        Trace.write_trace_report(trace_path, os.path.join(os.path.dirname(trace_path), "trace_report.json"))
+    return results
+
+
+# -------------------------
+# CLI entry
+# -------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run Plan + Write over a task list with a worker pool.")
+    parser.add_argument("tasks", help="task list (JSON list/dict or JSONL)")
+    parser.add_argument("--output-dir", default=os.environ.get("OUTPUT_DIR", "outputs"))
+    parser.add_argument("--progress", default=None, help="progress file (default <output-dir>/progress.json)")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("PRISM_BATCH_WORKERS", "4")))
+    parser.add_argument("--rpm", type=float, default=float(os.environ.get("PRISM_LLM_RPM", "0")),
+                        help="global LLM requests per minute (0 = unlimited)")
+    parser.add_argument("--mode", choices=["thread", "process", "pipeline", "async"], default="thread",
+                        help="pipeline = separate Plan/Write stages with in-memory plan handoff; "
+                             "async = every example as a coroutine on one event loop")
+    parser.add_argument("--plan-workers", type=int, default=int(os.environ.get("PRISM_PLAN_WORKERS", "0")),
+                        help="pipeline mode: Plan stage workers (default half of --workers)")
+    parser.add_argument("--write-workers", type=int, default=int(os.environ.get("PRISM_WRITE_WORKERS", "0")),
+                        help="pipeline mode: Write stage workers (default the rest of --workers)")
+    parser.add_argument("--trace", default=os.environ.get("PRISM_TRACE_PATH") or None,
+                        help="span trace file (default <output-dir>/trace.jsonl)")
+    args = parser.parse_args()
+
+    if args.mode == "pipeline":
+        plan_workers = args.plan_workers or max(1, args.workers // 2)
+        write_workers = args.write_workers or max(1, args.workers - plan_workers)
+        results = run_pipeline(load_tasks(args.tasks), output_dir=args.output_dir, plan_workers=plan_workers,
+                               write_workers=write_workers, rpm=args.rpm, progress_path=args.progress,
+                               trace_path=args.trace)
+    elif args.mode == "async":
+        results = run_async_batch(load_tasks(args.tasks), output_dir=args.output_dir, workers=args.workers,
+                                  rpm=args.rpm, progress_path=args.progress, trace_path=args.trace)
+    else:
+        results = run_batch(load_tasks(args.tasks), output_dir=args.output_dir, workers=args.workers,
+                            rpm=args.rpm, mode=args.mode, progress_path=args.progress, trace_path=args.trace)
+    failed = [k for k, v in results.items() if v.get("status") == "failed"]
+    print(f"[INFO] batch finished: {len(results) - len(failed)} ok, {len(failed)} failed")
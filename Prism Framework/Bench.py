@@ -0,0 +1,397 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import types
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import Cache
+import Hedge
+import Trace
+import Spectrum
+import LogWriter
+from Budget import count_tokens, SECTIONS
+from Limiter import ResilientClient
+
+# -------------------------
+# Offline benchmark: runs generate_plan_only / generate_write_only end-to-end
+# against a deterministic fake LLM instead of glm-4-air, and reports
+# throughput, per-stage latency, peak memory and log-write cost.
+#
+#   python Bench.py --examples 10 --workers 4 --latency 0.05
+#   python Bench.py --compare            # sequential vs concurrent bands
+#   python Bench.py --baseline old.json  # fail if throughput regressed
+#   python Bench.py --tail-rate 0.03 --tail-latency 2 --compare-hedge   # hedging vs none on a heavy tail
+# -------------------------
+OUTPUTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "outputs")
+BENCH_TAG_RE = re.compile(r"Original Task: \[bench:([^\]]+)\]")
+
+
+def load_recorded_examples(outputs_dir=OUTPUTS_DIR):
+    examples = {}
+    for plan_path in sorted(glob.glob(os.path.join(outputs_dir, "example_*", "story_plan.json"))):
+        example_dir = os.path.dirname(plan_path)
+        example_id = os.path.basename(example_dir)
+        try:
+            with open(plan_path, "r", encoding="utf-8") as f:
+                plan = json.load(f).get("plan", {})
+            story = {}
+            write_path = os.path.join(example_dir, "story_write.json")
+            if os.path.exists(write_path):
+                with open(write_path, "r", encoding="utf-8") as f:
+                    story = json.load(f).get("story_dict", {})
+        except Exception as e:
+            print(f"[WARN] skipping {example_id}: {e}")
+            continue
+        examples[example_id] = {"plan": plan, "story": story}
+    return examples
+
+
+# -------------------------
+# Fake LLM client (chat.completions.create surface, optional streaming)
+# Replays recorded plan/story text for the matching stage when the task is
+# tagged "[bench:<example_id>]", otherwise synthesizes text of a fixed size.
+# Everything (text, grades, latency jitter) is seeded from the request hash,
+# except stalls (tail_rate / tail_latency): those hit individual attempts, so a
+# duplicate of a stalled request usually comes back at normal speed.
+# -------------------------
+class FakeLLMClient:
+    def __init__(self, examples=None, latency=0.0, latency_per_kchar=0.0, jitter=0.0,
+                 response_chars=1200, refine_rate=0.3, seed=0, tail_rate=0.0, tail_latency=0.0):
+        self.examples = examples or {}
+        self.latency = latency
+        self.latency_per_kchar = latency_per_kchar
+        self.jitter = jitter
+        self.response_chars = response_chars
+        self.refine_rate = refine_rate
+        self.seed = seed
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.calls = 0
+        self._prefixes = set()  # simulated provider prefix cache: every leading message run seen so far
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def _rng(self, text):
+        digest = hashlib.sha256(f"{self.seed}:{text}".encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def _synth(self, rng, label, chars=None):
+        chars = chars or self.response_chars
+        words = ["light", "prism", "beam", "shadow", "city", "river", "memory", "clock", "storm", "voice"]
+        body = " ".join(rng.choice(words) for _ in range(chars // 6))
+        return f"{label}: {body}"
+
+    def respond(self, request_text):
+        rng = self._rng(request_text)
+        tag = BENCH_TAG_RE.search(request_text)
+        recorded = self.examples.get(tag.group(1)) if tag else None
+        plan = (recorded or {}).get("plan", {})
+        story = (recorded or {}).get("story", {})
+
+        if "Perform Spectral Analysis" in request_text:
+            grade = rng.choice("AABBBC")
+            return f"Grade: {grade}\n" + self._synth(rng, "- Suggestion", self.response_chars // 3)
+        if "Conduct a Focal Decision" in request_text:
+            category = "Major" if rng.random() < self.refine_rate else "Minor"
+            return f"category: '{category}'\nConfidence: High\nsuggest targeted fixes: tighten pacing."
+        if "Perform Beam Reforging" in request_text:
+            for section in SECTIONS:
+                if f"refine the {section}" in request_text:
+                    return f"{section}: " + (story.get(section) or self._synth(rng, section))
+            return "\n".join(
+                f"{key}: {plan.get(key) or self._synth(rng, key)}"
+                for key in ("Central Conflict", "Character Descriptions", "Setting", "Key Plot Points")
+            )
+        if "Beat Outline:" in request_text:
+            return "\n".join(f"{section}: " + self._synth(rng, "- Beat", self.response_chars // 4) for section in SECTIONS)
+        if "continue the story by writing the" in request_text or "beat outline of the whole story, write the" in request_text:
+            for section in SECTIONS:
+                if f"writing the {section} part" in request_text or f"write the {section} part" in request_text:
+                    return story.get(section) or self._synth(rng, section, self.response_chars * 3)
+        if "synthesize the full story" in request_text:
+            return story.get("Full Story") or self._synth(rng, "Full Story", self.response_chars * 10)
+        for key, marker in (("Central Conflict", "describe the central conflict"),
+                            ("Character Descriptions", "describe the characters"),
+                            ("Setting", "describe the setting"),
+                            ("Key Plot Points", "describe the key plot points")):
+            if marker in request_text:
+                return plan.get(key) or self._synth(rng, key)
+        return self._synth(rng, "Summary")
+
+    def _cached_tokens(self, messages):
+        # longest run of leading messages sent before is served from the "cache"
+        cached = 0
+        with self._lock:
+            for i in range(1, len(messages)):
+                prefix = hashlib.sha256(json.dumps(messages[:i]).encode("utf-8")).hexdigest()
+                if prefix in self._prefixes:
+                    cached = sum(count_tokens(m.get("content")) for m in messages[:i])
+                self._prefixes.add(prefix)
+        return cached
+
+    def create(self, model=None, messages=None, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+            call_no = self.calls
+        request_text = "\n".join(m.get("content") or "" for m in messages or [])
+        cached_tokens = self._cached_tokens(messages or [])
+        output = self.respond(request_text)
+        rng = self._rng(request_text + "#latency")
+        delay = self.latency + self.latency_per_kchar * len(output) / 1000.0 + rng.uniform(0, self.jitter)
+        if self.tail_rate and self._rng(f"{request_text}#tail#{call_no}").random() < self.tail_rate:
+            delay += self.tail_latency
+        usage = types.SimpleNamespace(prompt_tokens=count_tokens(request_text),
+                                      completion_tokens=count_tokens(output),
+                                      total_tokens=count_tokens(request_text) + count_tokens(output),
+                                      prompt_tokens_details=types.SimpleNamespace(cached_tokens=cached_tokens))
+        if stream:
+            return self._stream(output, delay, usage)
+        timeout = kwargs.get("timeout")
+        if timeout and delay > timeout:
+            # behaves like a transport timeout on a real client
+            time.sleep(timeout)
+            raise TimeoutError(f"fake request timed out after {timeout:g}s")
+        if delay:
+            time.sleep(delay)
+        message = types.SimpleNamespace(content=output)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+
+    def _stream(self, output, delay, usage, chunk_chars=64):
+        pieces = [output[i:i + chunk_chars] for i in range(0, len(output), chunk_chars)] or [""]
+        for i, piece in enumerate(pieces):
+            if delay:
+                time.sleep(delay / len(pieces))
+            delta = types.SimpleNamespace(content=piece)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)],
+                                        usage=usage if i == len(pieces) - 1 else None)
+
+
+# -------------------------
+# Log writer that measures hot-path submit cost and counts rows instead of
+# talking to MySQL (use --db mysql to measure the real database).
+# -------------------------
+class BenchLogWriter(LogWriter.LogWriter):
+    def __init__(self, use_db=False, **kwargs):
+        self.use_db = use_db
+        self.rows = 0
+        self.bytes = 0
+        self.submit_s = 0.0
+        self.insert_s = 0.0
+        self._stats_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def submit(self, *args, **kwargs):
+        start = time.perf_counter()
+        super().submit(*args, **kwargs)
+        with self._stats_lock:
+            self.submit_s += time.perf_counter() - start
+
+    def _insert(self, rows):
+        start = time.perf_counter()
+        if self.use_db:
+            super()._insert(rows)
+        self.rows += len(rows)
+        self.bytes += sum(len(r[1] or "") + len(r[2] or "") for r in rows)
+        self.insert_s += time.perf_counter() - start
+
+
+# -------------------------
+# harness
+# -------------------------
+def run_bench(examples, workers=1, spectral_workers=None, fake_kwargs=None, use_db=False, wrap_client=True,
+              hedge_policy=None):
+    import Plan
+    import Write
+
+    fake = FakeLLMClient(examples, **(fake_kwargs or {}))
+    client = ResilientClient(fake) if wrap_client else fake
+    saved = (Plan.client, Write.client, Spectrum.SPECTRAL_MAX_WORKERS)
+    Plan.client = Write.client = client
+    if spectral_workers:
+        Spectrum.SPECTRAL_MAX_WORKERS = spectral_workers
+    Cache.set_cache(None)  # always measure real work
+    saved_policy = Hedge.get_hedge_policy()
+    Hedge.set_hedge_policy(hedge_policy)  # None: no hedging, no deadlines, fresh latency history
+
+    writer = BenchLogWriter(use_db=use_db, spool_path=os.path.join(tempfile.gettempdir(), "prism_bench_spool.jsonl"))
+    LogWriter.set_log_writer(writer)
+    trace_fd, trace_path = tempfile.mkstemp(prefix="prism_bench_", suffix=".jsonl")
+    os.close(trace_fd)
+    Trace.set_trace_path(trace_path)
+
+    def run_one(example_id):
+        task = f"[bench:{example_id}] Write the story recorded as {example_id}."
+        plan = Plan.generate_plan_only(example_id, task)
+        Write.generate_write_only(example_id, plan, task)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    errors = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="prism-bench") as pool:
+            for future in [pool.submit(run_one, eid) for eid in examples]:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors += 1
+                    print(f"[ERROR] bench example failed: {e}")
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        Plan.client, Write.client, Spectrum.SPECTRAL_MAX_WORKERS = saved
+        hedging = Hedge.hedge_report()
+        Hedge.set_hedge_policy(saved_policy)
+        LogWriter.flush_logs()
+        Trace.set_trace_path(None)
+
+    stages = Trace.trace_report(trace_path)["by_family"]
+    os.remove(trace_path)
+    n = len(examples)
+    return {
+        "examples": n,
+        "errors": errors,
+        "workers": workers,
+        "spectral_workers": spectral_workers or Spectrum.SPECTRAL_MAX_WORKERS,
+        "llm_calls": fake.calls,
+        "prompt_tokens": sum(row["prompt_tokens"] for row in stages.values()),
+        "cached_prompt_tokens": sum(row["cached_prompt_tokens"] for row in stages.values()),
+        "wall_s": round(wall, 3),
+        "stories_per_min": round(60.0 * (n - errors) / wall, 2) if wall else 0.0,
+        "peak_mem_mb": round(peak / (1024 * 1024), 2),
+        "db": {
+            "rows": writer.rows,
+            "mb": round(writer.bytes / (1024 * 1024), 2),
+            "submit_ms_total": round(writer.submit_s * 1000, 2),
+            "insert_ms_total": round(writer.insert_s * 1000, 2),
+        },
+        "hedging": hedging,
+        "stages": stages,
+    }
+
+
+def print_report(report, label=""):
+    print(f"\n=== Prism bench {label}===")
+    print(f"examples={report['examples']} errors={report['errors']} workers={report['workers']} "
+          f"spectral_workers={report['spectral_workers']} llm_calls={report['llm_calls']}")
+    print(f"wall={report['wall_s']}s  throughput={report['stories_per_min']} stories/min  "
+          f"peak_mem={report['peak_mem_mb']}MB")
+    if report.get("prompt_tokens"):
+        share = 100.0 * report["cached_prompt_tokens"] / report["prompt_tokens"]
+        print(f"prompt_tokens={report['prompt_tokens']}  cached_prompt_tokens={report['cached_prompt_tokens']} ({share:.1f}%)")
+    db = report["db"]
+    print(f"log rows={db['rows']} ({db['mb']}MB)  submit={db['submit_ms_total']}ms  insert={db['insert_ms_total']}ms")
+    hedging = report.get("hedging")
+    if hedging:
+        calls = hedging["by_family"].values()
+        print(f"llm calls p95={max((f['p95_s'] for f in calls), default=0):.3f}s "
+              f"p99={max((f['p99_s'] for f in calls), default=0):.3f}s (worst family)  "
+              f"hedged={hedging['totals']['hedged']} wins={sum(f['hedge_wins'] for f in calls)} "
+              f"timeouts={sum(f['timeouts'] for f in calls)} extra_calls={hedging['totals']['extra_calls_pct']}%")
+    print(f"{'stage':32s} {'count':>6s} {'p50_s':>8s} {'p95_s':>8s} {'hedged':>7s}")
+    for name, row in report["stages"].items():
+        print(f"{str(name):32s} {row['count']:6d} {row['p50_s']:8.3f} {row['p95_s']:8.3f} {row.get('hedged', 0):7d}")
+
+
+# -------------------------
+# CLI
+# -------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline Prism pipeline benchmark with a fake LLM.")
+    parser.add_argument("--outputs", default=OUTPUTS_DIR, help="directory with recorded example_* outputs")
+    parser.add_argument("--examples", type=int, default=0, help="limit the number of examples (0 = all)")
+    parser.add_argument("--workers", type=int, default=1, help="examples run concurrently")
+    parser.add_argument("--spectral-workers", type=int, default=None, help="Spectral Analysis pool size (1 = sequential)")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake per-call latency in seconds")
+    parser.add_argument("--latency-per-kchar", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--response-chars", type=int, default=1200, help="size of synthesized responses")
+    parser.add_argument("--refine-rate", type=float, default=0.3, help="share of Focal Decisions asking for reforging")
+    parser.add_argument("--db", choices=["null", "mysql"], default="null")
+    parser.add_argument("--raw-client", action="store_true", help="skip the ResilientClient wrapper")
+    parser.add_argument("--compare", action="store_true", help="run sequential and concurrent modes")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="share of attempts that stall")
+    parser.add_argument("--tail-latency", type=float, default=0.0, help="extra seconds a stalled attempt takes")
+    parser.add_argument("--hedge", action="store_true", help="hedge calls slower than their stage's p95")
+    parser.add_argument("--hedge-budget", type=float, default=Hedge.HEDGE_BUDGET, help="max hedges per 100 calls")
+    parser.add_argument("--hedge-min-samples", type=int, default=Hedge.HEDGE_MIN_SAMPLES)
+    parser.add_argument("--stage-timeout", type=float, default=0.0, help="deadline per attempt in seconds (0 = none)")
+    parser.add_argument("--compare-hedge", action="store_true", help="run without and with hedging")
+    parser.add_argument("--out", default=None, help="write the JSON report here")
+    parser.add_argument("--baseline", default=None, help="previous JSON report to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop vs baseline")
+    args = parser.parse_args()
+
+    examples = load_recorded_examples(args.outputs)
+    if args.examples:
+        examples = dict(list(examples.items())[:args.examples])
+    if not examples:
+        examples = {f"synthetic_{i:03d}": {} for i in range(max(1, args.examples))}
+    fake_kwargs = {
+        "latency": args.latency, "latency_per_kchar": args.latency_per_kchar, "jitter": args.jitter,
+        "response_chars": args.response_chars, "refine_rate": args.refine_rate,
+        "tail_rate": args.tail_rate, "tail_latency": args.tail_latency,
+    }
+    common = {"fake_kwargs": fake_kwargs, "use_db": args.db == "mysql", "wrap_client": not args.raw_client}
+
+    def hedge_policy(hedge):
+        # bench latencies are far below the production PRISM_HEDGE_MIN_DELAY
+        if not hedge and not args.stage_timeout:
+            return None
+        return Hedge.HedgePolicy(hedge=hedge, budget=args.hedge_budget, min_samples=args.hedge_min_samples,
+                                 min_delay=0.0, timeouts={}, default_timeout=args.stage_timeout)
+
+    if args.compare_hedge:
+        reports = {
+            "no_hedge": run_bench(examples, workers=args.workers, spectral_workers=args.spectral_workers,
+                                  hedge_policy=hedge_policy(False), **common),
+            "hedge": run_bench(examples, workers=args.workers, spectral_workers=args.spectral_workers,
+                               hedge_policy=hedge_policy(True), **common),
+        }
+        for label, report in reports.items():
+            print_report(report, f"({label}) ")
+        speedup = reports["no_hedge"]["wall_s"] / max(1e-9, reports["hedge"]["wall_s"])
+        print(f"\nspeedup hedge vs none: {speedup:.2f}x  "
+              f"extra calls: {reports['hedge']['llm_calls'] - reports['no_hedge']['llm_calls']}")
+        result = reports["hedge"]
+        output = reports
+    elif args.compare:
+        reports = {
+            "sequential": run_bench(examples, workers=1, spectral_workers=1, **common),
+            "concurrent": run_bench(examples, workers=args.workers, spectral_workers=args.spectral_workers or 5, **common),
+        }
+        for label, report in reports.items():
+            print_report(report, f"({label}) ")
+        speedup = reports["sequential"]["wall_s"] / max(1e-9, reports["concurrent"]["wall_s"])
+        print(f"\nspeedup concurrent vs sequential: {speedup:.2f}x")
+        result = reports["concurrent"]
+        output = reports
+    else:
+        result = run_bench(examples, workers=args.workers, spectral_workers=args.spectral_workers,
+                           hedge_policy=hedge_policy(args.hedge), **common)
+        print_report(result)
+        output = result
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        print(f"[INFO] Bench report written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        baseline = baseline.get("concurrent", baseline)
+        floor = baseline["stories_per_min"] * (1 - args.tolerance)
+        if result["stories_per_min"] < floor:
+            print(f"[ERROR] throughput regression: {result['stories_per_min']} < {floor:.2f} stories/min")
+            sys.exit(1)
+        print(f"[INFO] throughput OK vs baseline ({result['stories_per_min']} >= {floor:.2f} stories/min)")
@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import threading
+
+# -------------------------
+# Prompt/context token budgeting and per-call token accounting
+#   PRISM_CONTEXT_TOKENS       - model context window in tokens (0 = measure only, never trim)
+#   PRISM_COMPLETION_RESERVE   - tokens kept free for the completion when trimming
+# -------------------------
+CONTEXT_WINDOW_TOKENS = int(os.getenv("PRISM_CONTEXT_TOKENS", "0"))
+COMPLETION_RESERVE_TOKENS = int(os.getenv("PRISM_COMPLETION_RESERVE", "4096"))
+
+SECTIONS = ["Exposition", "Rising Action", "Climax", "Falling Action", "Resolution"]
+DIMENSIONS = ["Story Structure", "Originality", "Depth", "Style", "Task Alignment"]
+
+# context fields built by Plan/Write; "Original Task" is never trimmed
+CONTEXT_LABELS = [
+    "Original Task", "Plan so far", "Current Plan", "Plan", "Beam Focused Summary",
+    "Spectrum Conference Transcript", "Spectrum Conference", "Focal Decision Suggestions",
+    "Decision Suggestions", "Spectral Analyses", "Previous Sections Summary", "Previous Sections",
+    "Current Story Sections", "Refined Sections", "Full Sections Summary", "Story Summary So Far",
+    "New Section", "Section Beats",
+]
+PROTECTED_LABELS = ("Original Task",)
+FIELD_SPLIT_RE = re.compile(
+    r"\n\n(?=(?:" + "|".join(re.escape(label) for label in CONTEXT_LABELS) + r")(?: \([^)]*\))?: )"
+)
+TRIM_MARKER = "\n[... trimmed {n} chars to fit the context budget ...]\n"
+
+
+# -------------------------
+# token estimates (CJK ~1 token per char, other text ~4 chars per token)
+# -------------------------
+def count_tokens(text):
+    if not text:
+        return 0
+    wide = sum(1 for ch in text if ord(ch) > 0x2E7F)
+    return wide + (len(text) - wide) // 4 + 1
+
+
+def stage_family(log_type):
+    # prism_spectral_analysis_Climax_Depth -> prism_spectral_analysis
+    family = log_type or ""
+    for name in DIMENSIONS + SECTIONS:
+        family = family.replace(f"_{name}", "")
+    return family
+
+
+# -------------------------
+# context trimming: shrink the largest fields (middle-out) until
+# prompt + context fits the window minus the completion reserve
+# -------------------------
+def prompt_budget(window=None, reserve=None):
+    window = CONTEXT_WINDOW_TOKENS if window is None else window
+    reserve = COMPLETION_RESERVE_TOKENS if reserve is None else reserve
+    return max(0, window - reserve) if window else 0
+
+
+def trim_middle(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    cut = len(text) - max_chars
+    marker = TRIM_MARKER.format(n=cut)
+    keep = max(0, max_chars - len(marker))
+    head = keep * 2 // 3
+    return text[:head] + marker + text[len(text) - (keep - head):]
+
+
+def fit_context(prompt, context_text, log_type=None, budget=None):
+    budget = prompt_budget() if budget is None else budget
+    used = count_tokens(prompt) + count_tokens(context_text)
+    if not budget or used <= budget:
+        return context_text, 0
+
+    fields = FIELD_SPLIT_RE.split(context_text)
+    available_tokens = max(0, budget - count_tokens(prompt))
+    chars_per_token = len(context_text) / max(1, count_tokens(context_text))
+    char_budget = int(available_tokens * chars_per_token)
+
+    fixed = sum(len(f) for f in fields if f.startswith(PROTECTED_LABELS)) + 2 * (len(fields) - 1)
+    trimmable = [i for i, f in enumerate(fields) if not f.startswith(PROTECTED_LABELS)]
+    remaining = max(0, char_budget - fixed)
+
+    # water-filling: every trimmable field gets at most `cap` chars
+    sizes = sorted(len(fields[i]) for i in trimmable)
+    cap = remaining
+    for n, size in enumerate(sizes):
+        share = remaining // (len(sizes) - n)
+        if size > share:
+            cap = share
+            break
+        remaining -= size
+    for i in trimmable:
+        fields[i] = trim_middle(fields[i], max(cap, 0))
+
+    trimmed = "\n\n".join(fields)
+    removed = len(context_text) - len(trimmed)
+    print(f"[WARN] context for {log_type} trimmed by {removed} chars ({used} > {budget} tokens)")
+    return trimmed, removed
+
+
+# -------------------------
+# per-example usage report
+# -------------------------
+# summed into totals / by_family / by_model; hedged_calls and timeouts are the extra requests
+REPORT_COUNTERS = ("calls", "prompt_tokens", "completion_tokens", "cached_prompt_tokens", "hedged_calls", "timeouts")
+_reports = {}
+_reports_lock = threading.Lock()
+
+
+def _stage_entry(story_id, log_type):
+    stages = _reports.setdefault(story_id, {})
+    return stages.setdefault(log_type, {
+        "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_prompt_tokens": 0, "cached_calls": 0,
+        "estimated_calls": 0, "prompt_chars": 0, "trimmed_chars": 0, "hedged_calls": 0, "hedge_wins": 0,
+        "timeouts": 0,
+    })
+
+
+def record_usage(story_id, log_type, usage, prompt_chars=0, trimmed_chars=0):
+    usage = usage or {}
+    with _reports_lock:
+        entry = _stage_entry(story_id, log_type)
+        entry["calls"] += 1
+        entry["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        entry["completion_tokens"] += usage.get("completion_tokens") or 0
+        entry["cached_prompt_tokens"] += usage.get("cached_prompt_tokens") or 0
+        entry["cached_calls"] += 1 if usage.get("cached") else 0
+        entry["estimated_calls"] += 1 if usage.get("estimated") else 0
+        entry["prompt_chars"] += prompt_chars
+        entry["trimmed_chars"] += trimmed_chars
+        entry["hedged_calls"] += 1 if usage.get("hedged") else 0
+        entry["hedge_wins"] += 1 if usage.get("hedge_won") else 0
+        entry["timeouts"] += usage.get("timeouts") or 0
+        if usage.get("model"):
+            entry["model"] = usage["model"]
+
+
+def record_parse(story_id, log_type, outcome):
+    # structured-output parse outcome of a stage: json / text / repaired / failed
+    with _reports_lock:
+        entry = _stage_entry(story_id, log_type)
+        key = f"parse_{outcome}"
+        entry[key] = entry.get(key, 0) + 1
+
+
+def usage_report(story_id):
+    with _reports_lock:
+        stages = {k: dict(v) for k, v in _reports.get(story_id, {}).items()}
+    return build_report(story_id, stages)
+
+
+def build_report(story_id, stages):
+    families = {}
+    totals = dict.fromkeys(REPORT_COUNTERS, 0)
+    parses = {}
+    models = {}
+    for log_type, entry in stages.items():
+        fam = families.setdefault(stage_family(log_type), dict.fromkeys(REPORT_COUNTERS, 0))
+        model = models.setdefault(entry.get("model") or "unknown", dict.fromkeys(REPORT_COUNTERS, 0))
+        for key in totals:
+            fam[key] += entry.get(key, 0)
+            model[key] += entry.get(key, 0)
+            totals[key] += entry.get(key, 0)
+        for key, value in entry.items():
+            if key.startswith("parse_"):
+                parses[key[len("parse_"):]] = parses.get(key[len("parse_"):], 0) + value
+    report = {"example_id": story_id, "totals": totals, "by_family": families, "by_model": models, "stages": stages}
+    if parses:
+        report["structured_output"] = parses
+    return report
+
+
+def pop_usage_report(story_id):
+    # report of a run that keeps its results in memory (no usage_report.json)
+    with _reports_lock:
+        stages = _reports.pop(story_id, {})
+    return build_report(story_id, stages)
+
+
+def write_usage_report(story_id, path):
+    # merges with an existing report so Plan and Write accumulate into one file
+    stages = usage_report(story_id)["stages"]
+    try:
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                previous = json.load(f).get("stages", {})
+            previous.update(stages)
+            stages = previous
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(build_report(story_id, stages), f, ensure_ascii=False, indent=2)
+        print(f"[INFO] Usage report written to {path}")
+    except Exception as e:
+        print(f"[WARN] cannot write usage report to {path}: {e}")
+    with _reports_lock:
+        _reports.pop(story_id, None)
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# -------------------------
+# Content-addressed LLM response cache (SQLite)
+# Key = sha256 over (model, messages), i.e. the system message and the full
+# request_text. Modes (PRISM_CACHE_MODE):
+#   off       - no caching (default)
+#   readwrite - serve hits, store misses
+#   readonly  - serve hits, never store (misses go to the LLM)
+#   replay    - serve hits, a miss raises CacheMiss (deterministic reruns)
+# -------------------------
+CACHE_MODES = ("off", "readwrite", "readonly", "replay")
+CACHE_MODE = os.getenv("PRISM_CACHE_MODE", "off")
+CACHE_PATH = os.getenv("PRISM_CACHE_PATH", os.path.join(os.getcwd(), "prism_llm_cache.sqlite3"))
+CACHE_MAX_BYTES = int(os.getenv("PRISM_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+CACHE_MAX_AGE_DAYS = float(os.getenv("PRISM_CACHE_MAX_AGE_DAYS", "30"))
+CACHE_EVICT_EVERY = 100  # run eviction every N stores
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def cache_key(model, messages):
+    payload = json.dumps({"model": model, "messages": messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, mode="readwrite", max_bytes=CACHE_MAX_BYTES, max_age_days=CACHE_MAX_AGE_DAYS):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"unknown cache mode {mode!r}, expected one of {CACHE_MODES}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                log_type TEXT,
+                response TEXT,
+                size INTEGER,
+                created_at REAL,
+                last_access REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses(last_access)")
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            # replay mode ignores age so recorded runs stay reproducible
+            if row and self.max_age and self.mode != "replay" and now - row[1] > self.max_age:
+                row = None
+            if row is None:
+                self.misses += 1
+                if self.mode == "replay":
+                    raise CacheMiss(f"no cached response for key {key[:12]}")
+                return None
+            self.hits += 1
+            if self.mode == "readwrite":
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            return row[0]
+
+    def put(self, key, model, log_type, response):
+        if self.mode != "readwrite":
+            return
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, log_type, response, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, log_type, response, len(response.encode("utf-8")), now, now),
+            )
+            self._conn.commit()
+            self.stores += 1
+            if self.stores % CACHE_EVICT_EVERY == 0:
+                self._evict(now)
+
+    def evict(self):
+        with self._lock:
+            return self._evict(time.time())
+
+    def _evict(self, now):
+        removed = 0
+        if self.max_age:
+            removed += self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age,)).rowcount
+        if self.max_bytes:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # least-recently-used first until we are back under the limit
+                doomed = []
+                for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                    if total <= self.max_bytes:
+                        break
+                    doomed.append((key,))
+                    total -= size
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+                removed += len(doomed)
+        self._conn.commit()
+        self.evictions += removed
+        return removed
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# -------------------------
+# process-wide cache configured from env
+# -------------------------
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if CACHE_MODE == "off" and _cache is None:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(CACHE_PATH, CACHE_MODE)
+        return _cache
+
+
+def set_cache(cache):
+    # install (or remove with None) the process-wide cache, e.g. from a batch runner
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+
+# -------------------------
+# CLI: print counters / force eviction
+# -------------------------
+if __name__ == "__main__":
+    c = ResponseCache(CACHE_PATH, "readwrite")
+    print(f"[INFO] evicted {c.evict()} entries from {CACHE_PATH}")
+    rows, size = c._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+    print(f"[INFO] {rows} cached responses, {size} bytes")
+    c.close()
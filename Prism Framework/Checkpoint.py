@@ -0,0 +1,140 @@
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# -------------------------
+# Stage-level checkpoint journal
+# One append-only, fsync'd JSONL file per example. Every completed LLM stage
+# is appended as {"key": log_type, "request_sha": ..., "output": ...}. On a
+# rerun acall_agent_for_plan / acall_agent_for_write replay journaled outputs
+# whose request matches, so the pipeline rebuilds plan_dict / story_dict /
+# summaries without calling the LLM and resumes at the first missing stage.
+#   PRISM_CHECKPOINT=0          - disable journaling in Plan.main / Write.main
+#   PRISM_KEEP_CHECKPOINTS=1    - keep the journal after a successful run
+# -------------------------
+CHECKPOINT_ENABLED = os.getenv("PRISM_CHECKPOINT", "1") == "1"
+KEEP_CHECKPOINTS = os.getenv("PRISM_KEEP_CHECKPOINTS", "0") == "1"
+CHECKPOINT_FILE = "checkpoint_{stage}.jsonl"  # stage = plan | write
+
+
+def request_sha(request_text):
+    return hashlib.sha256(request_text.encode("utf-8")).hexdigest()
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.replayed = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        good_end = 0  # byte offset just past the last newline-terminated line
+        skipped = 0
+        for raw in data.splitlines(keepends=True):
+            if not raw.endswith(b"\n"):
+                break  # torn last line from a crash mid-write; truncated below
+            good_end += len(raw)
+            try:
+                entry = json.loads(raw.decode("utf-8"))
+                self.entries[entry["key"]] = entry  # later entries win
+            except (UnicodeDecodeError, ValueError, KeyError, TypeError):
+                skipped += 1
+        if skipped:
+            print(f"[WARN] checkpoint {self.path}: skipped {skipped} unreadable entries")
+        if good_end < len(data):
+            # drop the torn tail so the next append starts on a fresh line
+            print(f"[WARN] checkpoint {self.path}: dropping {len(data) - good_end} bytes of a torn entry")
+            with open(self.path, "r+b") as f:
+                f.truncate(good_end)
+                f.flush()
+                os.fsync(f.fileno())
+        if self.entries:
+            print(f"[INFO] checkpoint {self.path}: {len(self.entries)} completed stages")
+
+    def lookup(self, key, request_text):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.get("request_sha") != request_sha(request_text):
+                return None
+            self.replayed += 1
+            return entry["output"]
+
+    def append(self, key, request_text, output):
+        entry = {
+            "key": key,
+            "request_sha": request_sha(request_text),
+            "output": output,
+            "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.entries[key] = entry
+
+    def close(self, completed=False):
+        with self._lock:
+            self._file.close()
+        if completed and not KEEP_CHECKPOINTS:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+# -------------------------
+# active journals, keyed by story_id
+# -------------------------
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal(story_id):
+    with _journals_lock:
+        return _journals.get(story_id)
+
+
+@contextmanager
+def checkpointing(story_id, path, enabled=None):
+    enabled = CHECKPOINT_ENABLED if enabled is None else enabled
+    if not enabled or not path:
+        yield None
+        return
+    journal = Journal(path)
+    with _journals_lock:
+        _journals[story_id] = journal
+    completed = False
+    try:
+        yield journal
+        completed = True
+    finally:
+        with _journals_lock:
+            _journals.pop(story_id, None)
+        if journal.replayed:
+            print(f"[INFO] resumed {story_id}: {journal.replayed} stages replayed from checkpoint")
+        journal.close(completed=completed)
+
+
+def replay_stage(story_id, log_type, request_text):
+    journal = get_journal(story_id)
+    return journal.lookup(log_type, request_text) if journal is not None else None
+
+
+def record_stage(story_id, log_type, request_text, output):
+    journal = get_journal(story_id)
+    if journal is not None:
+        try:
+            journal.append(log_type, request_text, output)
+        except Exception as e:
+            print(f"[WARN] cannot write checkpoint for {log_type}: {e}")
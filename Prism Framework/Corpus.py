@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import argparse
+
+from Budget import SECTIONS
+
+# -------------------------
+# Single-file corpus of finished examples
+# Streams outputs/example_*/ (story_plan.json, story_write.json, story_text.txt,
+# usage_report.json, progress.json) into one record per example:
+#   {"example_id", "task", "plan": {...}, "sections": {...}, "story", "meta": {...}}
+# The final story is stored once (story_write.json keeps it twice), and no
+# absolute paths are kept. JSONL is append-only: re-exporting adds only new
+# examples. Parquet (needs pyarrow) is written as a fresh file in row groups.
+# iter_corpus() / iter_examples() yield records lazily, one example in memory at a time.
+# -------------------------
+PLAN_FIELDS = ["Central Conflict", "Character Descriptions", "Setting", "Key Plot Points"]
+PARQUET_ROW_GROUP = 256
+# progress.json fields worth keeping (paths are machine-specific and dropped)
+PROGRESS_FIELDS = ("status", "plan_done", "write_done", "errors", "plan_finished_at", "write_finished_at")
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"[WARN] cannot read {path}: {e}")
+        return None
+
+
+def _example_dirs(outputs_dir):
+    for name in sorted(os.listdir(outputs_dir)):
+        path = os.path.join(outputs_dir, name)
+        if os.path.isdir(path) and (
+            os.path.exists(os.path.join(path, "story_plan.json")) or os.path.exists(os.path.join(path, "story_write.json"))
+        ):
+            yield name, path
+
+
+def build_record(example_id, example_dir, progress_entry=None):
+    plan_data = _read_json(os.path.join(example_dir, "story_plan.json")) or {}
+    write_data = _read_json(os.path.join(example_dir, "story_write.json")) or {}
+    plan = plan_data.get("plan") or {}
+    story_dict = write_data.get("story_dict") or {}
+
+    story = story_dict.get("Full Story") or write_data.get("full_story")
+    if not story:
+        text_path = os.path.join(example_dir, "story_text.txt")
+        if os.path.exists(text_path):
+            with open(text_path, "r", encoding="utf-8") as f:
+                story = f.read()
+    sections = {s: story_dict[s] for s in SECTIONS if s in story_dict}
+
+    meta = {"generated_at": write_data.get("generated_at")}
+    for key in PROGRESS_FIELDS:
+        if progress_entry and key in progress_entry:
+            meta[key] = progress_entry[key]
+    usage = _read_json(os.path.join(example_dir, "usage_report.json"))
+    if usage:
+        meta["usage"] = {"totals": usage.get("totals"), "by_family": usage.get("by_family")}
+        if "structured_output" in usage:
+            meta["usage"]["structured_output"] = usage["structured_output"]
+
+    return {
+        "example_id": plan_data.get("example_id") or write_data.get("example_id") or example_id,
+        "task": plan_data.get("task", ""),
+        "plan": plan,
+        "sections": sections,
+        "story": (story or "").strip(),
+        "meta": meta,
+    }
+
+
+def iter_examples(outputs_dir, progress_path=None):
+    # lazy: reads one example directory per step
+    progress = _read_json(progress_path or os.path.join(outputs_dir, "progress.json")) or {}
+    for example_id, example_dir in _example_dirs(outputs_dir):
+        yield build_record(example_id, example_dir, progress.get(example_id))
+
+
+# -------------------------
+# JSONL / Parquet writers
+# -------------------------
+def _jsonl_ids(path):
+    ids = set()
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        ids.add(json.loads(line)["example_id"])
+                    except (json.JSONDecodeError, KeyError):
+                        pass  # torn last line from an interrupted export
+    return ids
+
+
+def export_jsonl(records, path):
+    seen = _jsonl_ids(path)
+    written = 0
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            if record["example_id"] in seen:
+                continue
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            seen.add(record["example_id"])
+            written += 1
+    return written
+
+
+def _column(name):
+    return name.lower().replace(" ", "_")
+
+
+def _flatten(record):
+    row = {"example_id": record["example_id"], "task": record["task"], "story": record["story"]}
+    for key in PLAN_FIELDS:
+        row[f"plan_{_column(key)}"] = record["plan"].get(key)
+    for key in SECTIONS:
+        row[f"section_{_column(key)}"] = record["sections"].get(key)
+    row["meta"] = json.dumps(record["meta"], ensure_ascii=False)
+    return row
+
+
+def export_parquet(records, path, row_group=PARQUET_ROW_GROUP):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = (["example_id", "task", "story"] + [f"plan_{_column(k)}" for k in PLAN_FIELDS]
+               + [f"section_{_column(k)}" for k in SECTIONS] + ["meta"])
+    schema = pa.schema([(name, pa.string()) for name in columns])
+    written = 0
+    batch = []
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for record in records:
+            batch.append(_flatten(record))
+            if len(batch) >= row_group:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                written += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            written += len(batch)
+    return written
+
+
+def export_corpus(outputs_dir, path, fmt=None, progress_path=None):
+    fmt = fmt or ("parquet" if path.endswith(".parquet") else "jsonl")
+    records = iter_examples(outputs_dir, progress_path)
+    if fmt == "parquet":
+        return export_parquet(records, path)
+    return export_jsonl(records, path)
+
+
+# -------------------------
+# lazy reader
+# -------------------------
+def iter_corpus(path):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=PARQUET_ROW_GROUP):
+            for row in batch.to_pylist():
+                yield {
+                    "example_id": row["example_id"],
+                    "task": row["task"],
+                    "plan": {k: row[f"plan_{_column(k)}"] for k in PLAN_FIELDS if row.get(f"plan_{_column(k)}") is not None},
+                    "sections": {k: row[f"section_{_column(k)}"] for k in SECTIONS if row.get(f"section_{_column(k)}") is not None},
+                    "story": row["story"],
+                    "meta": json.loads(row["meta"]) if row.get("meta") else {},
+                }
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+# -------------------------
+# CLI: python Corpus.py outputs/ corpus.jsonl [--format jsonl|parquet]
+# -------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export outputs/example_* into a single corpus file.")
+    parser.add_argument("outputs", help="directory with example_* folders")
+    parser.add_argument("corpus", help="target file (.jsonl, or .parquet with pyarrow installed)")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default=None)
+    parser.add_argument("--progress", default=None, help="progress file (default <outputs>/progress.json)")
+    args = parser.parse_args()
+
+    try:
+        count = export_corpus(args.outputs, args.corpus, fmt=args.format, progress_path=args.progress)
+    except ImportError as e:
+        print(f"[ERROR] parquet export needs pyarrow: {e}")
+        sys.exit(1)
+    print(f"[INFO] {count} examples written to {args.corpus}")
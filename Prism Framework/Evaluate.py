@@ -0,0 +1,313 @@
+import os
+import re
+import sys
+import json
+import zlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from Budget import SECTIONS, stage_family
+from Trace import load_spans, span_name
+
+# -------------------------
+# Bulk evaluation of generated stories (needs numpy)
+# Loads the corpus once (outputs/example_* folders or a Corpus.py export) and scores
+# every story without an LLM:
+#   distinct_1/2/3       - unique n-grams / n-grams (lexical diversity)
+#   repetition_4         - share of 4-grams that repeat an earlier one; repeated_sentences likewise
+#   section_cv           - coefficient of variation of the five section lengths (0 = balanced)
+#   entity_coverage      - plan characters / proper nouns that the story mentions
+#   max_similarity       - highest MinHash Jaccard estimate against any other story of the batch
+# Tokens are hashed to integer arrays on worker processes (--jobs); n-gram counts, MinHash
+# signatures and the all-pairs similarity are numpy array operations. Each example is joined
+# with its stage cost: seconds per stage family from a trace file (--trace) and calls / tokens
+# from usage_report.json, and the summary compares metrics of examples that did and did not
+# run each stage (e.g. beam_reforging), to show which refinement stages pay for themselves.
+#   python Evaluate.py outputs/ [--trace trace.jsonl] [--report outputs/evaluation_report.json]
+#   python Evaluate.py corpus.jsonl --jobs 8
+# -------------------------
+MINHASH_PERMUTATIONS = 128
+MINHASH_SHINGLE = 5             # tokens per shingle
+NEAR_DUPLICATE = 0.5            # max_similarity at or above this counts as a near-duplicate
+SIMILARITY_BLOCK = 64           # stories compared per block (memory: block x n x permutations)
+PARALLEL_MIN_STORIES = 32       # below this, featurize in-process
+METRICS = ["distinct_1", "distinct_2", "distinct_3", "repetition_4", "repeated_sentences",
+           "section_cv", "entity_coverage", "max_similarity"]
+
+TOKEN_RE = re.compile(r"[A-Za-z0-9]+(?:['’][A-Za-z]+)?|[一-鿿]")
+SENTENCE_RE = re.compile(r"(?<=[.!?。！？])\s+|\n+")
+BULLET_NAME_RE = re.compile(r"^\s*[-*•]\s*([^:\n(]+)", re.M)
+PROPER_NOUN_RE = re.compile(r"\b[A-Z][a-z]{2,}(?:[- ][A-Z][a-z]+)*")
+ENTITY_STOPWORDS = {
+    "The", "This", "That", "These", "Those", "His", "Her", "Their", "Its", "She", "They", "When", "While",
+    "As", "After", "Before", "With", "And", "But", "For", "From", "Into", "Through", "During", "Despite",
+    "Dr", "Mr", "Mrs", "Ms", "Professor", "Central", "Conflict", "Setting", "Key", "Plot", "Points",
+}
+
+
+# -------------------------
+# per-story features (run on worker processes)
+# -------------------------
+def _hash_tokens(np, tokens):
+    # crc32 of each distinct token, scattered back over the token sequence
+    if not tokens:
+        return np.zeros(0, dtype=np.uint64), []
+    vocabulary, inverse = np.unique(np.array(tokens), return_inverse=True)
+    hashes = np.fromiter((zlib.crc32(t.encode("utf-8")) for t in vocabulary.tolist()), dtype=np.uint64,
+                         count=vocabulary.size)
+    return hashes[inverse.ravel()], vocabulary.tolist()
+
+
+def _ngrams(np, ids, n):
+    # rolling combination of n consecutive token hashes (uint64 arithmetic wraps)
+    if ids.size < n:
+        return ids[:0]
+    grams = ids[:ids.size - n + 1].copy()
+    for j in range(1, n):
+        grams = grams * np.uint64(1000003) ^ ids[j:ids.size - n + 1 + j]
+    return grams
+
+
+def _distinct(np, grams):
+    return float(np.unique(grams).size / grams.size) if grams.size else 0.0
+
+
+def _minhash(np, ids, a, b):
+    # multiply-shift hash family: the top 32 bits of a * shingle + b (mod 2**64), one row per permutation
+    shingles = _ngrams(np, ids, MINHASH_SHINGLE) & np.uint64(0xFFFFFFFF)
+    if not shingles.size:
+        shingles = ids[:1] if ids.size else np.zeros(1, dtype=np.uint64)
+    signature = np.full(a.size, 0xFFFFFFFF, dtype=np.uint64)
+    for start in range(0, shingles.size, 4096):
+        block = shingles[start:start + 4096]
+        values = (a[:, None] * block[None, :] + b[:, None]) >> np.uint64(32)
+        signature = np.minimum(signature, values.min(axis=1))
+    return signature.astype(np.uint32)
+
+
+def plan_entities(plan):
+    # characters named in "- Name: ..." bullets, then proper nouns from the other plan fields
+    entities = {}
+    for name in BULLET_NAME_RE.findall(plan.get("Character Descriptions") or ""):
+        words = [w for w in re.findall(r"[A-Za-z][A-Za-z'-]+", name) if w not in ENTITY_STOPWORDS and len(w) > 2]
+        if words:
+            entities[name.strip()] = words
+    for key in ("Central Conflict", "Setting", "Key Plot Points"):
+        text = plan.get(key) or ""
+        for match in PROPER_NOUN_RE.finditer(text):
+            before = text[:match.start()].rstrip()
+            if not before or before[-1] in ".!?:\n-":
+                continue  # capitalised only because it starts a sentence or bullet
+            noun = match.group(0)
+            words = [w for w in re.split(r"[- ]", noun) if w not in ENTITY_STOPWORDS]
+            if words and not any(set(words) & set(known) for known in entities.values()):
+                entities[noun] = words
+    return entities
+
+
+def featurize(record, seed=0):
+    import numpy as np
+
+    story = record.get("story") or ""
+    tokens = TOKEN_RE.findall(story.lower())
+    ids, vocabulary = _hash_tokens(np, tokens)
+    features = {"example_id": record["example_id"], "tokens": len(tokens)}
+    for n in (1, 2, 3):
+        features[f"distinct_{n}"] = round(_distinct(np, _ngrams(np, ids, n)), 4)
+    features["repetition_4"] = round(1.0 - _distinct(np, _ngrams(np, ids, 4)), 4) if ids.size >= 4 else 0.0
+
+    sentences = [" ".join(s.lower().split()) for s in SENTENCE_RE.split(story)]
+    sentences = [s for s in sentences if s.count(" ") >= 3]  # skip fragments and headings
+    features["repeated_sentences"] = round(1.0 - len(set(sentences)) / len(sentences), 4) if sentences else 0.0
+
+    sections = record.get("sections") or {}
+    lengths = np.array([len((sections.get(s) or "").split()) for s in SECTIONS], dtype=np.float64)
+    features["section_tokens"] = {s: int(n) for s, n in zip(SECTIONS, lengths)}
+    present = lengths[lengths > 0]
+    features["section_cv"] = round(float(present.std() / present.mean()), 4) if present.size > 1 else None
+
+    entities = plan_entities(record.get("plan") or {})
+    vocabulary = set(vocabulary) | {t.partition("'")[0].partition("’")[0] for t in vocabulary}  # Egypt's -> egypt
+    missing = [name for name, words in entities.items() if not any(w.lower() in vocabulary for w in words)]
+    features["entities"] = len(entities)
+    features["entity_coverage"] = round(1.0 - len(missing) / len(entities), 4) if entities else None
+    features["entities_missing"] = missing[:10]
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 2 ** 64, MINHASH_PERMUTATIONS, dtype=np.uint64, endpoint=False) | np.uint64(1)  # odd
+    b = rng.integers(0, 2 ** 64, MINHASH_PERMUTATIONS, dtype=np.uint64, endpoint=False)
+    features["minhash"] = _minhash(np, ids, a, b)
+    return features
+
+
+def _featurize_chunk(records):
+    return [featurize(r) for r in records]
+
+
+def featurize_all(records, jobs=None):
+    jobs = jobs or os.cpu_count() or 1
+    if jobs <= 1 or len(records) < PARALLEL_MIN_STORIES:
+        return _featurize_chunk(records)
+    size = max(1, len(records) // (jobs * 4))
+    chunks = [records[i:i + size] for i in range(0, len(records), size)]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return [f for chunk in pool.map(_featurize_chunk, chunks) for f in chunk]
+
+
+# -------------------------
+# cross-story similarity: all pairs of MinHash signatures, one block of rows at a time
+# -------------------------
+def nearest_neighbours(signatures):
+    import numpy as np
+
+    n = signatures.shape[0]
+    best = np.zeros(n)
+    nearest = np.full(n, -1)
+    if n < 2:
+        return best, nearest
+    for start in range(0, n, SIMILARITY_BLOCK):
+        block = signatures[start:start + SIMILARITY_BLOCK]
+        similarity = (block[:, None, :] == signatures[None, :, :]).mean(axis=2)
+        rows = np.arange(block.shape[0])
+        similarity[rows, rows + start] = -1.0  # not against itself
+        nearest[start:start + block.shape[0]] = similarity.argmax(axis=1)
+        best[start:start + block.shape[0]] = similarity[rows, nearest[start:start + block.shape[0]]]
+    return best, nearest
+
+
+# -------------------------
+# stage costs: trace spans (seconds) and usage reports (calls / tokens), keyed by span family
+# -------------------------
+def stage_costs_from_trace(path):
+    costs = {}
+    for s in load_spans(path):
+        stages = costs.setdefault(s.get("story_id"), {})
+        entry = stages.setdefault(s.get("family"), {"calls": 0, "seconds": 0.0})
+        entry["calls"] += 1
+        entry["seconds"] = round(entry["seconds"] + (s.get("duration_s") or 0.0), 4)
+    return costs
+
+
+def stage_costs_from_usage(record):
+    stages = {}
+    for family, row in (((record.get("meta") or {}).get("usage") or {}).get("by_family") or {}).items():
+        stages[span_name(stage_family(family))] = {
+            "calls": row.get("calls", 0),
+            "tokens": (row.get("prompt_tokens") or 0) + (row.get("completion_tokens") or 0),
+        }
+    return stages
+
+
+def join_stages(record, trace_costs):
+    stages = stage_costs_from_usage(record)
+    for family, entry in (trace_costs or {}).get(record["example_id"], {}).items():
+        stages.setdefault(family, {}).update(entry)
+    return stages
+
+
+def stage_value(examples):
+    # per stage family: what it costs, and the metric means of examples with / without it
+    import numpy as np
+
+    families = sorted({f for e in examples for f in e["stages"]})
+    matrix = np.array([[np.nan if e[m] is None else e[m] for m in METRICS] for e in examples], dtype=np.float64)
+    report = {}
+    for family in families:
+        calls = np.array([e["stages"].get(family, {}).get("calls", 0) for e in examples], dtype=np.float64)
+        seconds = np.array([e["stages"].get(family, {}).get("seconds", 0.0) for e in examples], dtype=np.float64)
+        tokens = np.array([e["stages"].get(family, {}).get("tokens", 0) for e in examples], dtype=np.float64)
+        ran = calls > 0
+        entry = {"examples": int(ran.sum()), "mean_calls": round(float(calls.mean()), 2),
+                 "mean_seconds": round(float(seconds.mean()), 3), "mean_tokens": round(float(tokens.mean()), 1)}
+        if 0 < ran.sum() < len(examples):
+            with_stage = np.nanmean(matrix[ran], axis=0)
+            without = np.nanmean(matrix[~ran], axis=0)
+            entry["metric_delta"] = {m: round(float(d), 4) for m, d in zip(METRICS, with_stage - without) if not np.isnan(d)}
+        if calls.std() > 0:
+            correlations = {}
+            for i, metric in enumerate(METRICS):
+                column = matrix[:, i]
+                valid = ~np.isnan(column)
+                if valid.sum() > 2 and column[valid].std() > 0 and calls[valid].std() > 0:
+                    correlations[metric] = round(float(np.corrcoef(calls[valid], column[valid])[0, 1]), 3)
+            entry["calls_correlation"] = correlations
+        report[family] = entry
+    return report
+
+
+# -------------------------
+# batch report
+# -------------------------
+def load_records(source):
+    from Corpus import iter_corpus, iter_examples
+    if os.path.isdir(source):
+        return list(iter_examples(source))
+    return list(iter_corpus(source))
+
+
+def evaluate(records, trace_path=None, jobs=None):
+    import numpy as np
+
+    features = featurize_all(records, jobs)
+    if features:
+        similarity, nearest = nearest_neighbours(np.stack([f.pop("minhash") for f in features]))
+    trace_costs = stage_costs_from_trace(trace_path) if trace_path else None
+
+    examples = []
+    for i, (record, f) in enumerate(zip(records, features)):
+        f["max_similarity"] = round(float(similarity[i]), 4) if len(features) > 1 else None
+        f["most_similar"] = features[nearest[i]]["example_id"] if len(features) > 1 else None
+        f["stages"] = join_stages(record, trace_costs)
+        examples.append(f)
+
+    summary = {"examples": len(examples)}
+    for metric in METRICS:
+        values = np.array([e[metric] for e in examples if e[metric] is not None], dtype=np.float64)
+        if values.size:
+            summary[metric] = {"mean": round(float(values.mean()), 4), "p10": round(float(np.percentile(values, 10)), 4),
+                               "p90": round(float(np.percentile(values, 90)), 4)}
+    summary["near_duplicates"] = sum(1 for e in examples if (e["max_similarity"] or 0) >= NEAR_DUPLICATE)
+    return {"summary": summary, "stage_value": stage_value(examples) if examples else {}, "examples": examples}
+
+
+def write_evaluation_report(report, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[INFO] Evaluation report written to {path}")
+
+
+# -------------------------
+# CLI
+# -------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score a batch of generated stories (needs numpy).")
+    parser.add_argument("source", help="outputs directory with example_* folders, or a corpus .jsonl / .parquet")
+    parser.add_argument("--trace", default=None, help="span trace (PRISM_TRACE_PATH) to join stage timings from")
+    parser.add_argument("--report", default=None, help="report path (default <outputs>/evaluation_report.json)")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    try:
+        import numpy  # noqa: F401
+    except ImportError as e:
+        print(f"[ERROR] evaluation needs numpy: {e}")
+        sys.exit(1)
+    records = load_records(args.source)
+    if not records:
+        print(f"[ERROR] no examples found in {args.source}")
+        sys.exit(1)
+    report = evaluate(records, trace_path=args.trace, jobs=args.jobs)
+    base = args.source if os.path.isdir(args.source) else os.path.dirname(os.path.abspath(args.source))
+    write_evaluation_report(report, args.report or os.path.join(base, "evaluation_report.json"))
+
+    summary = report["summary"]
+    print(f"[INFO] {summary['examples']} examples, {summary['near_duplicates']} near-duplicates")
+    for metric in METRICS:
+        if metric in summary:
+            row = summary[metric]
+            print(f"{metric:20s} mean={row['mean']:.4f}  p10={row['p10']:.4f}  p90={row['p90']:.4f}")
+    for family, row in report["stage_value"].items():
+        if "metric_delta" in row:
+            print(f"{family:32s} in {row['examples']} examples, {row['mean_seconds']:.1f}s / {row['mean_tokens']:.0f} tokens; "
+                  f"delta {row['metric_delta']}")
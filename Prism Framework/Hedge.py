@@ -0,0 +1,342 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+from Budget import stage_family
+from Trace import percentile
+from Router import parse_mapping, lookup_stage
+from Limiter import LLMCallError, last_retries, set_send_hook, set_request_timeout
+
+# -------------------------
+# Per-stage deadlines and hedged requests (non-streaming completions)
+#   PRISM_STAGE_TIMEOUT         - deadline per attempt in seconds for every stage (0 = none)
+#   PRISM_STAGE_TIMEOUTS        - stage family -> seconds, e.g. "prism_spectral_analysis=60,prism_write_synthesis=240"
+#                                 (or a JSON file); same matching as PRISM_MODEL_ROUTES
+#   PRISM_STAGE_TIMEOUT_RETRIES - fresh attempts after a deadline expires (default 2)
+#   PRISM_HEDGE=1               - send a duplicate request when a call outlives its stage's observed
+#                                 latency quantile; the first answer wins, the other one is dropped
+#   PRISM_HEDGE_QUANTILE        - hedge trigger (default 0.95)
+#   PRISM_HEDGE_BUDGET          - at most this many hedges per 100 calls, process-wide (default 5)
+#   PRISM_HEDGE_MIN_SAMPLES     - calls a family must have seen before it hedges (default 20)
+#   PRISM_HEDGE_MIN_DELAY       - never hedge earlier than this many seconds (default 1)
+# Deadline and hedge timers start when the request is sent, not while it waits for a Limiter
+# slot. A losing or expired attempt is dropped: async requests are cancelled, a sync request
+# still queued is never sent, and one already sent gives its concurrency slot back at once and
+# runs with the stage deadline as its transport timeout, so its daemon thread ends soon after
+# with the answer discarded. Streaming calls are not hedged or retried (their chunks are
+# already forwarded), but the stage deadline bounds the whole stream, first request to last chunk.
+# -------------------------
+STAGE_TIMEOUT = float(os.getenv("PRISM_STAGE_TIMEOUT", "0"))
+STAGE_TIMEOUT_RETRIES = int(os.getenv("PRISM_STAGE_TIMEOUT_RETRIES", "2"))
+HEDGE_ENABLED = os.getenv("PRISM_HEDGE", "0") == "1"
+HEDGE_QUANTILE = float(os.getenv("PRISM_HEDGE_QUANTILE", "0.95"))
+HEDGE_BUDGET = float(os.getenv("PRISM_HEDGE_BUDGET", "5"))
+HEDGE_MIN_SAMPLES = int(os.getenv("PRISM_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.getenv("PRISM_HEDGE_MIN_DELAY", "1"))
+LATENCY_WINDOW = 200  # recent latencies kept per family
+QUEUED_POLL_INTERVAL = 0.05  # re-check a request still waiting for a limiter slot
+
+
+class HedgePolicy:
+    def __init__(self, hedge=HEDGE_ENABLED, quantile=HEDGE_QUANTILE, budget=HEDGE_BUDGET,
+                 min_samples=HEDGE_MIN_SAMPLES, min_delay=HEDGE_MIN_DELAY, timeouts=None,
+                 default_timeout=STAGE_TIMEOUT, timeout_retries=STAGE_TIMEOUT_RETRIES):
+        self.hedge = hedge
+        self.quantile = quantile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.timeouts = parse_mapping(os.getenv("PRISM_STAGE_TIMEOUTS"), float) if timeouts is None else dict(timeouts)
+        self.default_timeout = default_timeout
+        self.timeout_retries = timeout_retries
+        self.calls = 0
+        self.hedges = 0
+        self._families = {}
+        self._lock = threading.Lock()
+
+    # ---- configuration / observed latencies ----
+    def timeout_for(self, log_type):
+        return lookup_stage(self.timeouts, log_type, self.default_timeout) or None
+
+    def _family(self, family):
+        return self._families.setdefault(family, {
+            "calls": 0, "hedged": 0, "hedge_wins": 0, "timeouts": 0, "failed": 0,
+            "latencies": deque(maxlen=LATENCY_WINDOW),
+        })
+
+    def hedge_delay(self, family):
+        if not self.hedge:
+            return None
+        with self._lock:
+            latencies = list(self._family(family)["latencies"])
+        if len(latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, percentile(latencies, self.quantile))
+
+    def try_hedge(self):
+        # budget: hedges stay within `budget` percent of all calls so far
+        with self._lock:
+            if (self.hedges + 1) * 100.0 > self.budget * max(1, self.calls):
+                return False
+            self.hedges += 1
+            return True
+
+    def observe(self, family, latency, outcome, failed=False):
+        with self._lock:
+            self.calls += 1
+            entry = self._family(family)
+            entry["calls"] += 1
+            entry["hedged"] += 1 if outcome["hedged"] else 0
+            entry["hedge_wins"] += 1 if outcome["hedge_won"] else 0
+            entry["timeouts"] += outcome["timeouts"]
+            entry["failed"] += 1 if failed else 0
+            if not failed:
+                entry["latencies"].append(latency)
+
+    def report(self):
+        # per family: hedges and timeouts (extra calls) next to the latency tail they bought
+        with self._lock:
+            families = {k: dict(v, latencies=list(v["latencies"])) for k, v in self._families.items()}
+            totals = {"calls": self.calls, "hedged": self.hedges}
+        for entry in families.values():
+            latencies = entry.pop("latencies")
+            entry["extra_calls_pct"] = round(100.0 * (entry["hedged"] + entry["timeouts"]) / max(1, entry["calls"]), 2)
+            for q in (0.50, 0.95, 0.99):
+                entry[f"p{int(q * 100)}_s"] = round(percentile(latencies, q), 4)
+        totals["extra_calls_pct"] = round(100.0 * (totals["hedged"] + sum(e["timeouts"] for e in families.values()))
+                                          / max(1, totals["calls"]), 2)
+        return {"totals": totals, "by_family": families}
+
+    # ---- timers: both run from the moment the primary request is actually sent ----
+    def _next_step(self, primary, timeout, delay, hedged):
+        # -> ("expired" | "hedge" | "wait", seconds to wait or None)
+        now = time.monotonic()
+        started = primary.started_at()
+        if started is None:
+            # still waiting for a rate-limit / concurrency slot: the clock has not started
+            return "wait", QUEUED_POLL_INTERVAL
+        deadline = started + timeout if timeout else None
+        hedge_at = started + delay if delay is not None and not hedged else None
+        if deadline is not None and now >= deadline:
+            return "expired", None
+        if hedge_at is not None and now >= hedge_at:
+            return "hedge", None
+        wake = min([t for t in (deadline, hedge_at) if t is not None], default=None)
+        return "wait", None if wake is None else wake - now
+
+    def _expired(self, log_type, family, timeout, attempt, outcome):
+        outcome["timeouts"] += 1
+        print(f"[WARN] {log_type} exceeded its {timeout:g}s deadline (attempt {attempt + 1}/{self.timeout_retries + 1})")
+        if attempt == self.timeout_retries:
+            self.observe(family, 0.0, outcome, failed=True)
+            raise LLMCallError(f"{log_type}: no answer within {timeout:g}s in {self.timeout_retries + 1} attempts")
+
+    def _won(self, family, start, outcome, attempt, retries):
+        outcome["hedge_won"] = attempt.role == "hedge"
+        outcome["retries"] = retries
+        outcome["latency_s"] = round(time.perf_counter() - start, 4)
+        self.observe(family, outcome["latency_s"], outcome)
+        return outcome
+
+    # ---- streaming calls: one deadline for the whole stream ----
+    def stream_deadline(self, log_type):
+        # -> (monotonic deadline, timeout) or (None, None) when the stage has none
+        timeout = self.timeout_for(log_type)
+        return (time.monotonic() + timeout, timeout) if timeout else (None, None)
+
+    def stream_expired(self, log_type, timeout):
+        # counts the timeout and returns the error for the caller to raise
+        outcome = {"hedged": False, "hedge_won": False, "timeouts": 1}
+        print(f"[WARN] {log_type} stream exceeded its {timeout:g}s deadline")
+        self.observe(stage_family(log_type), 0.0, outcome, failed=True)
+        return LLMCallError(f"{log_type}: stream not finished within {timeout:g}s")
+
+    # ---- sync calls ----
+    def call(self, create, log_type):
+        # create() issues one request; returns (response, outcome)
+        family = stage_family(log_type)
+        timeout = self.timeout_for(log_type)
+        delay = self.hedge_delay(family)
+        outcome = {"hedged": False, "hedge_won": False, "timeouts": 0}
+        start = time.perf_counter()
+        if timeout is None and delay is None:
+            response = create()
+            outcome["latency_s"] = round(time.perf_counter() - start, 4)
+            self.observe(family, outcome["latency_s"], outcome)
+            return response, outcome
+
+        for attempt in range(self.timeout_retries + 1):
+            primary = _Attempt("primary")
+            pending = {_spawn(create, primary, timeout): primary}
+            error = None
+            while pending:
+                step, wait_s = self._next_step(primary, timeout, delay, outcome["hedged"])
+                if step == "expired":
+                    break
+                if step == "hedge":
+                    if self.try_hedge():
+                        outcome["hedged"] = True
+                        hedge = _Attempt("hedge")
+                        pending[_spawn(create, hedge, timeout)] = hedge
+                    else:
+                        delay = None  # over budget: this call waits it out
+                    continue
+                done, _ = wait(pending, timeout=wait_s, return_when=FIRST_COMPLETED)
+                for future in done:
+                    winner = pending.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    for loser in pending.values():
+                        loser.abandon()  # a running request cannot be interrupted; its answer is dropped
+                    response, retries = future.result()
+                    return response, self._won(family, start, outcome, winner, retries)
+            if not pending:
+                # every request of this attempt failed (after the client's own retries)
+                self.observe(family, 0.0, outcome, failed=True)
+                raise error
+            for expired in pending.values():
+                expired.abandon()
+            self._expired(log_type, family, timeout, attempt, outcome)
+
+    # ---- async calls (asyncio engine) ----
+    async def acall(self, create, log_type):
+        # create() returns a coroutine issuing one request; returns (response, outcome)
+        family = stage_family(log_type)
+        timeout = self.timeout_for(log_type)
+        delay = self.hedge_delay(family)
+        outcome = {"hedged": False, "hedge_won": False, "timeouts": 0}
+        start = time.perf_counter()
+        if timeout is None and delay is None:
+            response = await create()
+            outcome["latency_s"] = round(time.perf_counter() - start, 4)
+            self.observe(family, outcome["latency_s"], outcome)
+            return response, outcome
+
+        async def attempt_call(state):
+            # every task runs in its own context copy: hook and retries stay per request
+            set_send_hook(state.hook)
+            return await create(), last_retries()
+
+        for attempt in range(self.timeout_retries + 1):
+            primary = _Attempt("primary")
+            pending = {asyncio.ensure_future(attempt_call(primary)): primary}
+            error = None
+            try:
+                while pending:
+                    step, wait_s = self._next_step(primary, timeout, delay, outcome["hedged"])
+                    if step == "expired":
+                        break
+                    if step == "hedge":
+                        if self.try_hedge():
+                            outcome["hedged"] = True
+                            hedge = _Attempt("hedge")
+                            pending[asyncio.ensure_future(attempt_call(hedge))] = hedge
+                        else:
+                            delay = None
+                        continue
+                    done, _ = await asyncio.wait(pending, timeout=wait_s, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        winner = pending.pop(task)
+                        if task.exception() is not None:
+                            error = error or task.exception()
+                            continue
+                        response, retries = task.result()
+                        return response, self._won(family, start, outcome, winner, retries)
+            finally:
+                for task in pending:
+                    task.cancel()  # the loser, or every request of an expired attempt
+            if not pending:
+                self.observe(family, 0.0, outcome, failed=True)
+                raise error
+            self._expired(log_type, family, timeout, attempt, outcome)
+
+
+class AttemptAbandoned(Exception):
+    pass
+
+
+class _Attempt:
+    # one request in flight; Limiter's Resilient clients report when it is queued / sent
+    def __init__(self, role):
+        self.role = role
+        self.spawned_at = time.monotonic()
+        self.queued = False
+        self.sent_at = None
+        self.abandoned = False
+        self.lease = None  # Limiter.SlotLease of the request in flight
+        self._lock = threading.Lock()
+
+    def hook(self, event, lease=None):
+        with self._lock:
+            if self.abandoned:
+                # lost the race or expired while still waiting for a slot: never send it
+                raise AttemptAbandoned(f"{self.role} request abandoned")
+            if event == "queued":
+                self.queued = True
+                self.lease = None
+            else:
+                self.queued = False
+                self.sent_at = time.monotonic()
+                self.lease = lease
+
+    def abandon(self):
+        # a request already sent keeps running, but no longer counts against the AIMD limit
+        with self._lock:
+            self.abandoned = True
+            lease, self.lease = self.lease, None
+        if lease is not None:
+            lease.release()
+
+    def started_at(self):
+        # None while queued in the limiters; clients without the hook count from spawn
+        if self.sent_at is not None:
+            return self.sent_at
+        return None if self.queued else self.spawned_at
+
+
+def _spawn(create, state, timeout=None):
+    # run one sync request on a daemon thread, so an abandoned one never blocks shutdown;
+    # the stage deadline doubles as its transport timeout, bounding the thread's lifetime
+    future = Future()
+    context = contextvars.copy_context()
+
+    def attempt_call():
+        set_send_hook(state.hook)
+        set_request_timeout(timeout)
+        return create(), last_retries()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(attempt_call))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="prism-llm-attempt", daemon=True).start()
+    return future
+
+
+# -------------------------
+# process-wide policy, shared by Plan and Write (the latency history is global)
+# -------------------------
+_policy = HedgePolicy()
+
+
+def get_hedge_policy():
+    return _policy
+
+
+def set_hedge_policy(policy):
+    global _policy
+    _policy = policy or HedgePolicy(hedge=False, default_timeout=0, timeouts={})
+    return _policy
+
+
+def hedge_report():
+    return _policy.report()
@@ -0,0 +1,498 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import threading
+
+import Limiter
+from Batch import now_str, load_tasks, init_worker
+
+# -------------------------
+# Shared multi-host job queue with leases (prism_jobs), so several machines
+# can work through one batch. Backends: the MySQL agent_room database
+# (LogWriter.db_config) or a SQLite file for local testing.
+#   PRISM_QUEUE_DB           - mysql (default) | sqlite:///path/to/queue.db
+#   PRISM_QUEUE_LEASE        - lease length in seconds (default 120), renewed every lease/3
+#   PRISM_QUEUE_MAX_ATTEMPTS - claims per example before it is marked failed (default 3)
+#   PRISM_QUEUE_POLL         - idle poll interval in seconds (default 5)
+# Rows are keyed by (queue, example_id): the same example can sit in several queues.
+# A worker claims an example with a compare-and-set on (lease_owner, lease_until),
+# runs its remaining stages and stores each stage result in the row, so the
+# write stage can continue on any host without a shared filesystem. Execution
+# is at-least-once: the lease of a crashed or partitioned worker expires and
+# the example is claimed again. Result writes are first-writer-wins
+# (... WHERE plan_done = 0), so a duplicate stage run is a no-op, and a worker whose
+# plan lost that race writes the story from the stored plan instead of its own.
+# Workers register in prism_workers; the global --rpm budget is split evenly
+# across workers with a live heartbeat.
+#   python JobQueue.py enqueue tasks.json [--queue NAME]
+#   python JobQueue.py work [--workers 4] [--rpm 600] [--output-dir outputs] [--follow]
+#   python JobQueue.py status [--json | --progress progress.json]
+#   python JobQueue.py requeue-failed
+# -------------------------
+QUEUE_DB = os.getenv("PRISM_QUEUE_DB", "mysql")
+QUEUE_LEASE = float(os.getenv("PRISM_QUEUE_LEASE", "120"))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("PRISM_QUEUE_MAX_ATTEMPTS", "3"))
+QUEUE_POLL = float(os.getenv("PRISM_QUEUE_POLL", "5"))
+DEFAULT_QUEUE = "default"
+
+MYSQL_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS prism_jobs (
+      queue VARCHAR(64) NOT NULL,
+      example_id VARCHAR(255) NOT NULL,
+      task MEDIUMTEXT NOT NULL,
+      status VARCHAR(16) NOT NULL DEFAULT 'pending',
+      plan_done TINYINT NOT NULL DEFAULT 0,
+      write_done TINYINT NOT NULL DEFAULT 0,
+      plan_result LONGTEXT NULL,
+      story_result LONGTEXT NULL,
+      lease_owner VARCHAR(255) NULL,
+      lease_until DOUBLE NOT NULL DEFAULT 0,
+      attempts INT NOT NULL DEFAULT 0,
+      errors TEXT NULL,
+      plan_finished_at VARCHAR(19) NULL,
+      write_finished_at VARCHAR(19) NULL,
+      updated_at VARCHAR(19) NULL,
+      PRIMARY KEY (queue, example_id),
+      INDEX idx_jobs_queue_status (queue, status, lease_until)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS prism_workers (
+      worker_id VARCHAR(255) PRIMARY KEY,
+      host VARCHAR(255) NULL,
+      pid INT NULL,
+      started_at VARCHAR(19) NULL,
+      heartbeat_at DOUBLE NOT NULL DEFAULT 0,
+      rpm_share DOUBLE NOT NULL DEFAULT 0
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """,
+]
+
+SQLITE_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS prism_jobs (
+      queue TEXT NOT NULL,
+      example_id TEXT NOT NULL,
+      task TEXT NOT NULL,
+      status TEXT NOT NULL DEFAULT 'pending',
+      plan_done INTEGER NOT NULL DEFAULT 0,
+      write_done INTEGER NOT NULL DEFAULT 0,
+      plan_result TEXT NULL,
+      story_result TEXT NULL,
+      lease_owner TEXT NULL,
+      lease_until REAL NOT NULL DEFAULT 0,
+      attempts INTEGER NOT NULL DEFAULT 0,
+      errors TEXT NULL,
+      plan_finished_at TEXT NULL,
+      write_finished_at TEXT NULL,
+      updated_at TEXT NULL,
+      PRIMARY KEY (queue, example_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_jobs_queue_status ON prism_jobs (queue, status, lease_until)",
+    """
+    CREATE TABLE IF NOT EXISTS prism_workers (
+      worker_id TEXT PRIMARY KEY,
+      host TEXT NULL,
+      pid INTEGER NULL,
+      started_at TEXT NULL,
+      heartbeat_at REAL NOT NULL DEFAULT 0,
+      rpm_share REAL NOT NULL DEFAULT 0
+    )
+    """,
+]
+
+
+# -------------------------
+# backends: statements are written with "?" placeholders; MySQL gets "%s"
+# -------------------------
+class SQLiteBackend:
+    insert_ignore = "INSERT OR IGNORE"
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self.connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for ddl in SQLITE_DDL:
+                conn.execute(ddl)
+        finally:
+            conn.close()
+
+    def connect(self):
+        # one short-lived connection per statement: sqlite3 connections are not shared across threads
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def execute(self, sql, params=(), fetch=False):
+        conn = self.connect()
+        try:
+            cursor = conn.execute(sql, params)
+            return cursor.fetchall() if fetch else cursor.rowcount
+        finally:
+            conn.close()
+
+
+class MySQLBackend:
+    insert_ignore = "INSERT IGNORE"
+
+    def __init__(self, config=None, pool_size=4):
+        from mysql.connector import pooling
+        from LogWriter import db_config
+        self.pool = pooling.MySQLConnectionPool(
+            pool_name=f"prism_queue_{uuid.uuid4().hex[:6]}", pool_size=pool_size, **(config or db_config)
+        )
+        for ddl in MYSQL_DDL:
+            self.execute(ddl)
+
+    def execute(self, sql, params=(), fetch=False):
+        conn = self.pool.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql.replace("?", "%s"), params)
+            result = cursor.fetchall() if fetch else cursor.rowcount
+            conn.commit()
+            cursor.close()
+            return result
+        finally:
+            conn.close()  # back to the pool
+
+
+def open_backend(url=None, pool_size=4):
+    url = url or QUEUE_DB
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///"):])
+    if url == "mysql":
+        return MySQLBackend(pool_size=pool_size)
+    raise ValueError(f"unknown queue backend {url!r} (expected mysql or sqlite:///path)")
+
+
+# -------------------------
+# JobQueue: enqueue / claim / complete / fail / heartbeat / status
+# -------------------------
+class JobQueue:
+    def __init__(self, backend, queue=DEFAULT_QUEUE, lease=QUEUE_LEASE, max_attempts=QUEUE_MAX_ATTEMPTS,
+                 worker_id=None):
+        self.db = backend
+        self.queue = queue
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.held = set()  # example_ids this worker currently holds a lease on
+        self._held_lock = threading.Lock()
+
+    def enqueue(self, tasks):
+        added = 0
+        for example_id, task in tasks:
+            added += self.db.execute(
+                f"{self.db.insert_ignore} INTO prism_jobs (example_id, queue, task, errors, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (example_id, self.queue, task, "[]", now_str()),
+            )
+        return added
+
+    def claim(self):
+        # returns the claimed row as a dict, or None when nothing is claimable right now
+        now = time.time()
+        # expired leases that used up their attempts are failed, not handed out again
+        self.db.execute(
+            "UPDATE prism_jobs SET status = 'failed', lease_owner = NULL, lease_until = 0, updated_at = ? "
+            "WHERE queue = ? AND status = 'running' AND lease_until < ? AND attempts >= ?",
+            (now_str(), self.queue, now, self.max_attempts),
+        )
+        candidates = self.db.execute(
+            "SELECT example_id FROM prism_jobs WHERE queue = ? AND status IN ('pending', 'running') "
+            "AND lease_until < ? AND attempts < ? ORDER BY attempts, example_id LIMIT 8",
+            (self.queue, now, self.max_attempts), fetch=True,
+        )
+        for (example_id,) in candidates:
+            # compare-and-set: only one worker wins an expired / free lease
+            won = self.db.execute(
+                "UPDATE prism_jobs SET status = 'running', lease_owner = ?, lease_until = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE queue = ? AND example_id = ? AND status IN ('pending', 'running') AND lease_until < ?",
+                (self.worker_id, now + self.lease, now_str(), self.queue, example_id, now),
+            )
+            if won:
+                with self._held_lock:
+                    self.held.add(example_id)
+                rows = self.db.execute(
+                    "SELECT example_id, task, plan_done, write_done, plan_result, attempts FROM prism_jobs "
+                    "WHERE queue = ? AND example_id = ?",
+                    (self.queue, example_id), fetch=True,
+                )
+                example_id, task, plan_done, write_done, plan_result, attempts = rows[0]
+                return {"example_id": example_id, "task": task, "plan_done": bool(plan_done),
+                        "write_done": bool(write_done), "plan": json.loads(plan_result) if plan_result else None,
+                        "attempts": attempts}
+        return None
+
+    def complete_plan(self, example_id, plan):
+        # first writer wins; returns the stored plan, which is another worker's
+        # when this duplicate run of the stage lost the race
+        if self.db.execute(
+            "UPDATE prism_jobs SET plan_done = 1, plan_result = ?, plan_finished_at = ?, updated_at = ? "
+            "WHERE queue = ? AND example_id = ? AND plan_done = 0",
+            (json.dumps(plan, ensure_ascii=False), now_str(), now_str(), self.queue, example_id),
+        ):
+            return plan
+        stored = self.results(example_id)
+        if stored is None or stored["plan"] is None:
+            raise RuntimeError(f"{example_id}: plan already marked done but no stored plan")
+        print(f"[INFO] {example_id} plan was stored by another worker first; writing from that plan")
+        return stored["plan"]
+
+    def complete_write(self, example_id, story):
+        written = self.db.execute(
+            "UPDATE prism_jobs SET write_done = 1, story_result = ?, write_finished_at = ?, status = 'completed', "
+            "updated_at = ? WHERE queue = ? AND example_id = ? AND write_done = 0",
+            (json.dumps(story, ensure_ascii=False), now_str(), now_str(), self.queue, example_id),
+        )
+        self.release(example_id)
+        return written
+
+    def fail(self, example_id, stage, error):
+        rows = self.db.execute("SELECT errors, attempts FROM prism_jobs WHERE queue = ? AND example_id = ?",
+                               (self.queue, example_id), fetch=True)
+        errors = json.loads(rows[0][0] or "[]") if rows else []
+        errors.append(f"{stage}: {error}")
+        status = "failed" if rows and rows[0][1] >= self.max_attempts else "pending"
+        self.db.execute(
+            "UPDATE prism_jobs SET status = ?, errors = ?, lease_owner = NULL, lease_until = 0, updated_at = ? "
+            "WHERE queue = ? AND example_id = ? AND lease_owner = ? AND write_done = 0",
+            (status, json.dumps(errors, ensure_ascii=False), now_str(), self.queue, example_id, self.worker_id),
+        )
+        self._drop(example_id)
+        return status
+
+    def release(self, example_id):
+        self.db.execute(
+            "UPDATE prism_jobs SET lease_owner = NULL, lease_until = 0 WHERE queue = ? AND example_id = ? AND lease_owner = ?",
+            (self.queue, example_id, self.worker_id),
+        )
+        self._drop(example_id)
+
+    def _drop(self, example_id):
+        with self._held_lock:
+            self.held.discard(example_id)
+
+    def renew(self):
+        # heartbeat: extend every held lease; a lease taken over by another worker is dropped
+        with self._held_lock:
+            held = list(self.held)
+        lost = []
+        for example_id in held:
+            if not self.db.execute(
+                "UPDATE prism_jobs SET lease_until = ? WHERE queue = ? AND example_id = ? AND lease_owner = ?",
+                (time.time() + self.lease, self.queue, example_id, self.worker_id),
+            ):
+                lost.append(example_id)
+                self._drop(example_id)
+        return lost
+
+    def remaining(self):
+        rows = self.db.execute(
+            "SELECT COUNT(*) FROM prism_jobs WHERE queue = ? AND status IN ('pending', 'running')", (self.queue,), fetch=True
+        )
+        return rows[0][0]
+
+    def requeue_failed(self):
+        return self.db.execute(
+            "UPDATE prism_jobs SET status = 'pending', attempts = 0, updated_at = ? WHERE queue = ? AND status = 'failed'",
+            (now_str(), self.queue),
+        )
+
+    # ---- workers and rate shares ----
+    def register(self, rpm=0):
+        now = time.time()
+        share = self.rpm_share(rpm, now)
+        if not self.db.execute(
+            "UPDATE prism_workers SET heartbeat_at = ?, rpm_share = ? WHERE worker_id = ?", (now, share, self.worker_id)
+        ):
+            host, pid = socket.gethostname(), os.getpid()
+            self.db.execute(
+                "INSERT INTO prism_workers (worker_id, host, pid, started_at, heartbeat_at, rpm_share) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.worker_id, host, pid, now_str(), now, share),
+            )
+        return share
+
+    def rpm_share(self, rpm, now=None):
+        if not rpm:
+            return 0
+        now = now or time.time()
+        rows = self.db.execute(
+            "SELECT COUNT(*) FROM prism_workers WHERE heartbeat_at >= ? AND worker_id <> ?",
+            (now - self.lease, self.worker_id), fetch=True,
+        )
+        return rpm / (rows[0][0] + 1)
+
+    def unregister(self):
+        self.db.execute("DELETE FROM prism_workers WHERE worker_id = ?", (self.worker_id,))
+
+    # ---- status view (same fields as progress.json) ----
+    def status(self):
+        rows = self.db.execute(
+            "SELECT example_id, status, plan_done, write_done, errors, plan_finished_at, write_finished_at, "
+            "lease_owner, attempts, updated_at FROM prism_jobs WHERE queue = ? ORDER BY example_id",
+            (self.queue,), fetch=True,
+        )
+        view = {}
+        for example_id, status, plan_done, write_done, errors, plan_at, write_at, owner, attempts, updated in rows:
+            entry = {"status": status, "plan_done": bool(plan_done), "write_done": bool(write_done),
+                     "errors": json.loads(errors or "[]"), "attempts": attempts, "updated_at": updated}
+            if plan_at:
+                entry["plan_finished_at"] = plan_at
+            if write_at:
+                entry["write_finished_at"] = write_at
+            if owner:
+                entry["lease_owner"] = owner
+            view[example_id] = entry
+        return view
+
+    def results(self, example_id):
+        rows = self.db.execute(
+            "SELECT plan_result, story_result FROM prism_jobs WHERE queue = ? AND example_id = ?",
+            (self.queue, example_id), fetch=True
+        )
+        if not rows:
+            return None
+        return {"plan": json.loads(rows[0][0]) if rows[0][0] else None,
+                "story": json.loads(rows[0][1]) if rows[0][1] else None}
+
+
+# -------------------------
+# worker: `workers` threads claim examples and run their remaining stages;
+# a heartbeat thread renews leases and re-splits the rate budget
+# -------------------------
+def run_stages(job_queue, job, output_dir=None):
+    import Plan
+    import Write
+    from Budget import pop_usage_report
+
+    example_id = job["example_id"]
+    example_dir = os.path.abspath(os.path.join(output_dir, example_id)) if output_dir else None
+    stage = "plan"
+    try:
+        plan = job["plan"]
+        if not job["plan_done"] or plan is None:
+            plan = Plan.main(example_id=example_id, creative_input=job["task"], output_dir=example_dir)
+            plan = job_queue.complete_plan(example_id, plan)
+        stage = "write"
+        story = Write.main(example_id=example_id, plan=plan, output_dir=example_dir, write_files=bool(example_dir))
+        job_queue.complete_write(example_id, story)
+        print(f"[INFO] {example_id} completed by {job_queue.worker_id}")
+    except Exception as e:
+        status = job_queue.fail(example_id, stage, e)
+        print(f"[ERROR] {example_id} {stage} stage failed (attempt {job['attempts']}, now {status}): {e}")
+    finally:
+        if not example_dir:
+            pop_usage_report(example_id)  # no usage_report.json to write it to
+
+
+def work(job_queue, workers=4, rpm=0, output_dir=None, follow=False, poll=QUEUE_POLL, trace_path=None):
+    share = job_queue.register(rpm)
+    init_worker(share, trace_path)
+    stop = threading.Event()
+
+    def heartbeat():
+        current = share
+        while not stop.wait(job_queue.lease / 3):
+            try:
+                for example_id in job_queue.renew():
+                    print(f"[WARN] lease on {example_id} lost; its result is kept only if no other worker finished first")
+                new_share = job_queue.register(rpm)
+                if rpm and abs(new_share - current) > 1e-6:
+                    Limiter.set_rate_limit(new_share)
+                    print(f"[INFO] rate share now {new_share:.1f} rpm")
+                    current = new_share
+            except Exception as e:
+                print(f"[WARN] queue heartbeat failed: {e}")
+
+    def loop():
+        while not stop.is_set():
+            try:
+                job = job_queue.claim()
+            except Exception as e:
+                print(f"[WARN] queue claim failed: {e}")
+                job = None
+            if job is not None:
+                run_stages(job_queue, job, output_dir)
+                continue
+            if not follow and job_queue.remaining() == 0:
+                return
+            stop.wait(poll)  # other workers' leases may still expire
+
+    print(f"[INFO] worker {job_queue.worker_id} on queue {job_queue.queue!r}: {workers} threads, {share or 'unlimited'} rpm")
+    beat = threading.Thread(target=heartbeat, name="prism-queue-heartbeat", daemon=True)
+    beat.start()
+    threads = [threading.Thread(target=loop, name=f"prism-queue-{i}") for i in range(max(1, workers))]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+    except KeyboardInterrupt:
+        print("[INFO] stopping after the running stages finish")
+        stop.set()
+        for t in threads:
+            t.join()
+    finally:
+        stop.set()
+        job_queue.unregister()
+        import LogWriter
+        LogWriter.flush_logs()
+
+
+# -------------------------
+# CLI entry
+# -------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared Prism job queue with leases (MySQL or SQLite).")
+    parser.add_argument("--db", default=QUEUE_DB, help="mysql or sqlite:///path/to/queue.db")
+    parser.add_argument("--queue", default=DEFAULT_QUEUE, help="queue name (one batch)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    enqueue = sub.add_parser("enqueue", help="add a task list (existing example_ids are kept)")
+    enqueue.add_argument("tasks", help="task list (JSON list/dict or JSONL)")
+    worker = sub.add_parser("work", help="claim and run examples until the queue is drained")
+    worker.add_argument("--workers", type=int, default=int(os.environ.get("PRISM_BATCH_WORKERS", "4")))
+    worker.add_argument("--rpm", type=float, default=float(os.environ.get("PRISM_LLM_RPM", "0")),
+                        help="global LLM requests per minute, split across live workers (0 = unlimited)")
+    worker.add_argument("--output-dir", default=os.environ.get("OUTPUT_DIR") or None,
+                        help="also write example folders here (results are always stored in the queue)")
+    worker.add_argument("--follow", action="store_true", help="keep polling for new work when the queue is empty")
+    worker.add_argument("--trace", default=os.environ.get("PRISM_TRACE_PATH") or None, help="span trace file")
+    status = sub.add_parser("status", help="per-example status (progress.json fields)")
+    status.add_argument("--json", action="store_true", help="print the full status view")
+    status.add_argument("--progress", default=None, help="write the status view to this progress.json")
+    sub.add_parser("requeue-failed", help="reset failed examples to pending")
+    args = parser.parse_args()
+
+    pool_size = args.workers + 2 if args.command == "work" else 2
+    job_queue = JobQueue(open_backend(args.db, pool_size=pool_size), queue=args.queue)
+    if args.command == "enqueue":
+        tasks = load_tasks(args.tasks)
+        print(f"[INFO] {job_queue.enqueue(tasks)} of {len(tasks)} tasks added to queue {args.queue!r}")
+    elif args.command == "work":
+        work(job_queue, workers=args.workers, rpm=args.rpm, output_dir=args.output_dir, follow=args.follow,
+             trace_path=args.trace)
+    elif args.command == "status":
+        view = job_queue.status()
+        if args.progress:
+            with open(args.progress, "w", encoding="utf-8") as f:
+                json.dump(view, f, ensure_ascii=False, indent=2)
+            print(f"[INFO] status of {len(view)} examples written to {args.progress}")
+        if args.json:
+            print(json.dumps(view, ensure_ascii=False, indent=2))
+        else:
+            counts = {}
+            for entry in view.values():
+                counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+            print(f"[INFO] queue {args.queue!r}: {len(view)} examples {counts}")
+    elif args.command == "requeue-failed":
+        print(f"[INFO] {job_queue.requeue_failed()} failed examples requeued")
+    sys.exit(0)
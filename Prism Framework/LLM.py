@@ -0,0 +1,290 @@
+import os
+import time
+import asyncio
+import contextvars
+from Cache import get_cache, cache_key
+from Budget import count_tokens
+from Limiter import last_retries, reset_retries, is_async_client
+# per-stage model routing over pluggable backends (see Router.py)
+from Router import resolve_route
+# per-stage deadlines and hedged requests (see Hedge.py)
+from Hedge import get_hedge_policy
+
+# -------------------------
+# Single choke point for every chat completion issued by Plan and Write.
+# Cross-cutting concerns (response cache, token usage, ...) hook in here so that
+# acall_agent_for_plan / acall_agent_for_write stay unchanged in shape.
+# -------------------------
+SYSTEM_PROMPT = "You are a creative writing assistant following the given prompt strictly."
+
+# -------------------------
+# Prompt layout (PRISM_PROMPT_LAYOUT). Stages that share a context (the five
+# Spectral Analysis bands, the section summaries of one draft, ...) differ only
+# in their instruction, so putting the context first gives them a byte-identical
+# prefix that provider-side prefix / KV caches can reuse:
+#   split  - (default) context in a leading user message, instruction in a final one
+#   single - one user message, context first and instruction last (for backends
+#            that reject consecutive user messages)
+#   inline - the old layout: "instruction\ncontext" in one user message
+# -------------------------
+PROMPT_LAYOUT = os.getenv("PRISM_PROMPT_LAYOUT", "split")
+
+
+# per thread / per asyncio task, so concurrent coroutines never see each other's usage
+_usage = contextvars.ContextVar("prism_llm_usage", default=None)
+
+
+def cached_prompt_tokens(usage):
+    # prompt tokens served from the provider's prefix cache (usage.prompt_tokens_details.cached_tokens)
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+def usage_from_response(usage, messages, output):
+    # provider usage when present, otherwise a local estimate
+    if usage is not None and getattr(usage, "prompt_tokens", None) is not None:
+        return {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "cached_prompt_tokens": cached_prompt_tokens(usage),
+            "estimated": False,
+            "cached": False,
+        }
+    return {
+        "prompt_tokens": sum(count_tokens(m.get("content")) for m in messages),
+        "completion_tokens": count_tokens(output),
+        "cached_prompt_tokens": 0,
+        "estimated": True,
+        "cached": False,
+    }
+
+
+def cached_usage():
+    return {"prompt_tokens": 0, "completion_tokens": 0, "cached_prompt_tokens": 0, "estimated": False, "cached": True}
+
+
+def _finish_usage(usage, model, outcome=None):
+    # outcome: hedging / deadline result of the call (Hedge.HedgePolicy)
+    outcome = outcome or {}
+    usage["retries"] = outcome.get("retries", last_retries())
+    usage["model"] = model
+    for key in ("latency_s", "hedged", "hedge_won", "timeouts"):
+        if key in outcome:
+            usage[key] = outcome[key]
+    _usage.set(usage)
+
+
+def last_usage():
+    # usage of the most recent completion issued from the calling thread / task
+    return _usage.get()
+
+
+def build_messages(request_text, system_prompt=SYSTEM_PROMPT):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": request_text}
+    ]
+
+
+def build_stage_messages(prompt, context_text, layout=None, system_prompt=SYSTEM_PROMPT):
+    # stable part (system prompt, shared context) first, stage instruction last
+    layout = layout or PROMPT_LAYOUT
+    if layout == "inline" or not context_text:
+        return build_messages(f"{prompt}\n{context_text}", system_prompt)
+    if layout == "single":
+        return build_messages(f"{context_text}\n\n{prompt}", system_prompt)
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": context_text},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def chat_completion(client, messages, model=None, log_type=None):
+    client, model = resolve_route(client, model, log_type)
+    cache = get_cache()
+    key = None
+    if cache is not None:
+        key = cache_key(model, messages)
+        cached = cache.get(key)
+        if cached is not None:
+            _finish_usage(cached_usage(), model)
+            return cached
+
+    reset_retries()
+    response, outcome = get_hedge_policy().call(
+        lambda: client.chat.completions.create(model=model, messages=messages),
+        log_type,
+    )
+    output = response.choices[0].message.content
+    usage = usage_from_response(getattr(response, "usage", None), messages, output)
+    _finish_usage(usage, model, outcome)
+
+    if cache is not None:
+        cache.put(key, model, log_type, output)
+    return output
+
+
+def stream_chat_completion(client, messages, model=None, log_type=None):
+    # generator variant: yields text chunks as they arrive (client stream option)
+    client, model = resolve_route(client, model, log_type)
+    cache = get_cache()
+    key = None
+    if cache is not None:
+        key = cache_key(model, messages)
+        cached = cache.get(key)
+        if cached is not None:
+            _finish_usage(cached_usage(), model)
+            yield cached
+            return
+
+    reset_retries()
+    # the stage deadline bounds the whole stream; it is also the transport timeout of each read
+    policy = get_hedge_policy()
+    deadline, timeout = policy.stream_deadline(log_type)
+    response = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        **({"timeout": timeout} if timeout else {}),
+    )
+    parts = []
+    usage = None
+    for chunk in response:
+        if deadline is not None and time.monotonic() > deadline:
+            close = getattr(response, "close", None)
+            if close is not None:
+                close()
+            raise policy.stream_expired(log_type, timeout)
+        usage = getattr(chunk, "usage", None) or usage  # sent on the final chunk
+        choices = getattr(chunk, "choices", None)
+        if not choices:
+            continue
+        delta = getattr(choices[0], "delta", None)
+        text = getattr(delta, "content", None) if delta is not None else None
+        if text:
+            parts.append(text)
+            yield text
+
+    usage = usage_from_response(usage, messages, "".join(parts))
+    _finish_usage(usage, model)
+    if cache is not None:
+        cache.put(key, model, log_type, "".join(parts))
+
+
+# -------------------------
+# async variants (used by the asyncio engine in Plan / Write)
+# An async-native client (Limiter.AsyncResilientClient) is awaited directly;
+# a synchronous client is driven on a worker thread so existing clients and
+# test doubles keep working.
+# -------------------------
+async def achat_completion(client, messages, model=None, log_type=None):
+    client, model = resolve_route(client, model, log_type)
+    if not is_async_client(client):
+        def call():
+            return chat_completion(client, messages, model, log_type), last_usage()
+        output, usage = await asyncio.to_thread(call)
+        _usage.set(usage)
+        return output
+
+    cache = get_cache()
+    key = None
+    if cache is not None:
+        key = cache_key(model, messages)
+        cached = cache.get(key)
+        if cached is not None:
+            _finish_usage(cached_usage(), model)
+            return cached
+
+    reset_retries()
+    response, outcome = await get_hedge_policy().acall(
+        lambda: client.chat.completions.create(model=model, messages=messages),
+        log_type,
+    )
+    output = response.choices[0].message.content
+    usage = usage_from_response(getattr(response, "usage", None), messages, output)
+    _finish_usage(usage, model, outcome)
+
+    if cache is not None:
+        cache.put(key, model, log_type, output)
+    return output
+
+
+async def astream_chat_completion(client, messages, model=None, log_type=None):
+    client, model = resolve_route(client, model, log_type)
+    if not is_async_client(client):
+        # bridge the blocking generator through a queue fed from a worker thread
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        done = object()
+
+        def pump():
+            try:
+                for chunk in stream_chat_completion(client, messages, model, log_type):
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+                loop.call_soon_threadsafe(chunks.put_nowait, (done, last_usage(), None))
+            except BaseException as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, (done, None, e))
+
+        worker = loop.run_in_executor(None, pump)
+        while True:
+            item = await chunks.get()
+            if isinstance(item, tuple) and item[0] is done:
+                await worker
+                if item[2] is not None:
+                    raise item[2]
+                _usage.set(item[1])
+                return
+            yield item
+
+    cache = get_cache()
+    key = None
+    if cache is not None:
+        key = cache_key(model, messages)
+        cached = cache.get(key)
+        if cached is not None:
+            _finish_usage(cached_usage(), model)
+            yield cached
+            return
+
+    reset_retries()
+    policy = get_hedge_policy()
+    deadline, timeout = policy.stream_deadline(log_type)
+
+    async def within_deadline(awaitable):
+        if deadline is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise policy.stream_expired(log_type, timeout) from None
+
+    response = await within_deadline(client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+    ))
+    parts = []
+    usage = None
+    chunks = response.__aiter__()
+    while True:
+        try:
+            chunk = await within_deadline(chunks.__anext__())
+        except StopAsyncIteration:
+            break
+        usage = getattr(chunk, "usage", None) or usage
+        choices = getattr(chunk, "choices", None)
+        if not choices:
+            continue
+        delta = getattr(choices[0], "delta", None)
+        text = getattr(delta, "content", None) if delta is not None else None
+        if text:
+            parts.append(text)
+            yield text
+
+    usage = usage_from_response(usage, messages, "".join(parts))
+    _finish_usage(usage, model)
+    if cache is not None:
+        cache.put(key, model, log_type, "".join(parts))
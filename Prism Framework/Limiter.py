@@ -0,0 +1,420 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+import types
+from Budget import count_tokens
+
+# -------------------------
+# Client-side LLM rate limiting (shared by every chat completion)
+#   PRISM_LLM_RPM / PRISM_LLM_TPM  - requests / tokens per minute (0 = unlimited)
+#   PRISM_LLM_CONCURRENCY          - initial in-flight limit for the AIMD controller
+#   PRISM_LLM_MAX_CONCURRENCY      - ceiling the controller may grow back to
+#   PRISM_LLM_MAX_RETRIES          - retries for 429 / timeout / 5xx / connection errors
+# -------------------------
+LLM_RPM = float(os.getenv("PRISM_LLM_RPM", "0"))
+LLM_TPM = float(os.getenv("PRISM_LLM_TPM", "0"))
+LLM_CONCURRENCY = int(os.getenv("PRISM_LLM_CONCURRENCY", "8"))
+LLM_MAX_CONCURRENCY = int(os.getenv("PRISM_LLM_MAX_CONCURRENCY", "32"))
+LLM_MAX_RETRIES = int(os.getenv("PRISM_LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("PRISM_LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.getenv("PRISM_LLM_BACKOFF_MAX", "60"))
+
+
+class LLMCallError(Exception):
+    pass
+
+
+# per thread / per asyncio task (a ContextVar behaves like a thread-local in threads)
+_retries = contextvars.ContextVar("prism_llm_retries", default=0)
+# hook(event, lease=None) called by create() with "queued" before waiting for the limiters and
+# "sent" (plus the SlotLease) once a slot is held; raising from it drops the request, releasing
+# the lease frees the slot early (Hedge.py uses both for abandoned attempts)
+_send_hook = contextvars.ContextVar("prism_llm_send_hook", default=None)
+# transport timeout in seconds handed to the raw sync client as `timeout=` (None = client default)
+_request_timeout = contextvars.ContextVar("prism_llm_request_timeout", default=None)
+
+# async waiters poll the shared (thread-based) limiters at this interval
+ASYNC_POLL_INTERVAL = 0.02
+
+
+def last_retries():
+    # retries spent by the most recent create() on the calling thread / task
+    return _retries.get()
+
+
+def reset_retries():
+    _retries.set(0)
+
+
+def set_retries(count):
+    # carry the retries of a call made on another thread / task (see Hedge.py)
+    _retries.set(count)
+
+
+def set_send_hook(hook):
+    _send_hook.set(hook)
+
+
+def set_request_timeout(seconds):
+    _request_timeout.set(seconds)
+
+
+class RateLimiter:
+    # token bucket: `rate_per_min` units refill continuously, up to `burst`
+    def __init__(self, rate_per_min, burst=None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = float(burst or max(1.0, rate_per_min / 60.0))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1.0):
+        # requests larger than the bucket only wait for a full bucket
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    async def acquire_async(self, amount=1.0):
+        # same bucket as acquire(), but waits on the event loop instead of the thread
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def debit(self, amount):
+        # charge usage known only after the call; the bucket may go negative
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+
+class AdaptiveConcurrency:
+    # AIMD: halve the in-flight limit on 429/timeouts, add ~1 per window of successes
+    def __init__(self, initial=LLM_CONCURRENCY, minimum=1, maximum=LLM_MAX_CONCURRENCY):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.in_flight = 0
+        self.throttled = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    async def acquire_async(self):
+        # shares the in-flight budget with threaded callers; polls instead of blocking the loop
+        while not self.try_acquire():
+            await asyncio.sleep(ASYNC_POLL_INTERVAL)
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.limit = max(float(self.minimum), self.limit / 2.0)
+            self.throttled += 1
+
+
+class SlotLease:
+    # one held concurrency slot; released exactly once, by whoever gets there first
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.held = True
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if not self.held:
+                return
+            self.held = False
+        self.concurrency.release()
+
+
+# -------------------------
+# error classification
+# -------------------------
+def error_status(e):
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status
+
+
+def is_throttle_error(e):
+    name = type(e).__name__.lower()
+    return (
+        error_status(e) == 429
+        or isinstance(e, TimeoutError)
+        or "timeout" in name
+        or "ratelimit" in name
+        or "reachlimit" in name
+        or "flowexceed" in name
+    )
+
+
+def is_retryable_error(e):
+    if is_throttle_error(e):
+        return True
+    status = error_status(e)
+    if status is not None:
+        return status >= 500
+    name = type(e).__name__.lower()
+    return isinstance(e, ConnectionError) or "connection" in name
+
+
+def backoff_delay(attempt, base=LLM_BACKOFF_BASE, cap=LLM_BACKOFF_MAX):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def estimate_tokens(messages):
+    # rough prompt size used before the real usage is known
+    return sum(count_tokens(m.get("content")) for m in messages)
+
+
+# -------------------------
+# ResilientClient: wraps a ZhipuAI-style client and exposes the same
+# `client.chat.completions.create(...)` surface with rate limiting,
+# retries and adaptive concurrency. Works with any fake client that
+# implements chat.completions.create.
+# -------------------------
+class ResilientClient:
+    def __init__(self, client, request_limiter=None, token_limiter=None, concurrency=None,
+                 max_retries=LLM_MAX_RETRIES, sleep=time.sleep):
+        self.client = client
+        self._request_limiter = request_limiter
+        self._token_limiter = token_limiter
+        self._concurrency = concurrency
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.retries = 0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    @property
+    def request_limiter(self):
+        return self._request_limiter if self._request_limiter is not None else get_rate_limiter()
+
+    @property
+    def token_limiter(self):
+        return self._token_limiter if self._token_limiter is not None else get_token_limiter()
+
+    @property
+    def concurrency(self):
+        return self._concurrency if self._concurrency is not None else get_concurrency()
+
+    def create(self, **kwargs):
+        request_limiter, token_limiter, concurrency = self.request_limiter, self.token_limiter, self.concurrency
+        attempt = 0
+        _retries.set(0)
+        hook = _send_hook.get()
+        timeout = _request_timeout.get()
+        if timeout and "timeout" not in kwargs:
+            kwargs = dict(kwargs, timeout=timeout)
+        while True:
+            if hook is not None:
+                hook("queued")
+            if request_limiter is not None:
+                request_limiter.acquire()
+            if token_limiter is not None:
+                token_limiter.acquire(estimate_tokens(kwargs.get("messages") or []))
+            concurrency.acquire()
+            lease = SlotLease(concurrency)
+            held_by_stream = False
+            try:
+                if hook is not None:
+                    hook("sent", lease)
+                response = self.client.chat.completions.create(**kwargs)
+                if kwargs.get("stream"):
+                    # keep the concurrency slot until the stream is consumed
+                    response = self._hold_slot(response, lease)
+                    held_by_stream = True
+            except Exception as e:
+                if not lease.held:
+                    # abandoned: the slot is already given back and nobody waits for an answer
+                    raise
+                if is_throttle_error(e):
+                    concurrency.on_throttle()
+                if not is_retryable_error(e) or attempt >= self.max_retries:
+                    raise LLMCallError(f"{type(e).__name__}: {e} (after {attempt} retries)") from e
+                delay = backoff_delay(attempt)
+                print(f"[WARN] LLM call failed ({type(e).__name__}: {e}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                attempt += 1
+                self.retries += 1
+                _retries.set(attempt)
+                self.sleep(delay)
+                continue
+            finally:
+                if not held_by_stream:
+                    lease.release()
+
+            concurrency.on_success()
+            usage = getattr(response, "usage", None)
+            if token_limiter is not None and usage is not None:
+                token_limiter.debit(getattr(usage, "completion_tokens", 0) or 0)
+            return response
+
+    @staticmethod
+    def _hold_slot(stream, lease):
+        # retries only cover opening the stream; a mid-stream failure propagates
+        try:
+            for chunk in stream:
+                yield chunk
+        finally:
+            lease.release()
+
+    def __getattr__(self, name):
+        # anything else (e.g. other client resources) passes straight through
+        return getattr(self.client, name)
+
+
+# -------------------------
+# AsyncResilientClient: the same policy for an async-native client whose
+# `chat.completions.create(...)` is a coroutine (see AsyncClient.py).
+# Limiters and the concurrency budget are shared with the threaded path.
+# -------------------------
+class AsyncResilientClient:
+    is_async = True
+
+    def __init__(self, client, request_limiter=None, token_limiter=None, concurrency=None,
+                 max_retries=LLM_MAX_RETRIES):
+        self.client = client
+        self._request_limiter = request_limiter
+        self._token_limiter = token_limiter
+        self._concurrency = concurrency
+        self.max_retries = max_retries
+        self.retries = 0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    request_limiter = ResilientClient.request_limiter
+    token_limiter = ResilientClient.token_limiter
+    concurrency = ResilientClient.concurrency
+
+    async def create(self, **kwargs):
+        request_limiter, token_limiter, concurrency = self.request_limiter, self.token_limiter, self.concurrency
+        attempt = 0
+        _retries.set(0)
+        hook = _send_hook.get()
+        while True:
+            if hook is not None:
+                hook("queued")
+            if request_limiter is not None:
+                await request_limiter.acquire_async()
+            if token_limiter is not None:
+                await token_limiter.acquire_async(estimate_tokens(kwargs.get("messages") or []))
+            await concurrency.acquire_async()
+            lease = SlotLease(concurrency)
+            held_by_stream = False
+            try:
+                if hook is not None:
+                    hook("sent", lease)
+                response = await self.client.chat.completions.create(**kwargs)
+                if kwargs.get("stream"):
+                    response = self._hold_slot(response, lease)
+                    held_by_stream = True
+            except Exception as e:
+                if is_throttle_error(e):
+                    concurrency.on_throttle()
+                if not is_retryable_error(e) or attempt >= self.max_retries:
+                    raise LLMCallError(f"{type(e).__name__}: {e} (after {attempt} retries)") from e
+                delay = backoff_delay(attempt)
+                print(f"[WARN] LLM call failed ({type(e).__name__}: {e}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                attempt += 1
+                self.retries += 1
+                _retries.set(attempt)
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                if not held_by_stream:
+                    lease.release()
+
+            concurrency.on_success()
+            usage = getattr(response, "usage", None)
+            if token_limiter is not None and usage is not None:
+                token_limiter.debit(getattr(usage, "completion_tokens", 0) or 0)
+            return response
+
+    @staticmethod
+    async def _hold_slot(stream, lease):
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            lease.release()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def is_async_client(client):
+    return getattr(client, "is_async", False) is True
+
+
+# -------------------------
+# process-wide limiters, shared by Plan and Write
+# -------------------------
+_limiter = RateLimiter(LLM_RPM) if LLM_RPM > 0 else None
+_token_limiter = RateLimiter(LLM_TPM, burst=LLM_TPM) if LLM_TPM > 0 else None
+_concurrency = AdaptiveConcurrency()
+
+
+def get_rate_limiter():
+    return _limiter
+
+
+def get_token_limiter():
+    return _token_limiter
+
+
+def get_concurrency():
+    return _concurrency
+
+
+def set_rate_limit(requests_per_min, tokens_per_min=None):
+    global _limiter, _token_limiter
+    _limiter = RateLimiter(requests_per_min) if requests_per_min and requests_per_min > 0 else None
+    if tokens_per_min is not None:
+        _token_limiter = RateLimiter(tokens_per_min, burst=tokens_per_min) if tokens_per_min > 0 else None
+    return _limiter
+
+
+def set_concurrency(initial, maximum=None):
+    global _concurrency
+    _concurrency = AdaptiveConcurrency(initial, maximum=maximum or max(initial, LLM_MAX_CONCURRENCY))
+    return _concurrency
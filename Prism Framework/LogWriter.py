@@ -0,0 +1,293 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+from RunStore import RunStore
+
+# -------------------------
+# Database connection config (shared by Plan and Write)
+# -------------------------
+db_config = {
+    "host": "localhost",
+    "user": "root",
+    "password": "123456",
+    "database": "agent_room",
+    "auth_plugin": "mysql_native_password"
+}
+
+INSERT_SQL = """
+    INSERT INTO story_logs (story_id, request_message, response_message, timestamp, type, prompt_tokens, completion_tokens)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+"""
+# used while story_logs predates the token columns (see `python LogWriter.py --migrate`)
+LEGACY_INSERT_SQL = """
+    INSERT INTO story_logs (story_id, request_message, response_message, timestamp, type)
+    VALUES (%s, %s, %s, %s, %s)
+"""
+# explicit migration only; the writer never alters story_logs on its own
+TOKEN_COLUMNS_DDL = "ALTER TABLE story_logs ADD COLUMN prompt_tokens INT NULL, ADD COLUMN completion_tokens INT NULL"
+
+# -------------------------
+# Tunables (env overrides)
+# -------------------------
+LOG_POOL_SIZE = int(os.getenv("PRISM_LOG_POOL_SIZE", "2"))
+LOG_BATCH_SIZE = int(os.getenv("PRISM_LOG_BATCH_SIZE", "50"))
+LOG_FLUSH_INTERVAL = float(os.getenv("PRISM_LOG_FLUSH_INTERVAL", "2.0"))
+LOG_DRAIN_TIMEOUT = float(os.getenv("PRISM_LOG_DRAIN_TIMEOUT", "30"))
+LOG_SPOOL_PATH = os.getenv("PRISM_LOG_SPOOL", os.path.join(os.getcwd(), "prism_log_spool.jsonl"))
+# story_logs (LONGTEXT per call), runstore (deduplicated tables, see RunStore.py) or both
+LOG_SCHEMA = os.getenv("PRISM_LOG_SCHEMA", "story_logs")
+
+
+# -------------------------
+# Background log writer: callers enqueue rows and return immediately;
+# a single daemon thread flushes them with executemany on a pooled
+# connection, by batch size or flush interval, whichever comes first.
+# Rows that cannot reach MySQL are appended to a local JSONL spool file
+# and replayed on the next successful flush (or via `python LogWriter.py`).
+# -------------------------
+class LogWriter:
+    def __init__(self, config=None, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL,
+                 pool_size=LOG_POOL_SIZE, spool_path=LOG_SPOOL_PATH, schema=LOG_SCHEMA):
+        if schema not in ("story_logs", "runstore", "both"):
+            raise ValueError(f"unknown log schema {schema!r}")
+        self.config = dict(config or db_config)
+        self.schema = schema
+        self._run_store = RunStore() if schema in ("runstore", "both") else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pool_size = pool_size
+        self.spool_path = spool_path
+        self._pool = None
+        self._has_token_columns = None
+        self._queue = queue.Queue()
+        self._spool_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="prism-log-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, story_id, request_msg, response_msg, log_type, timestamp=None, usage=None, duration_s=None):
+        timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        usage = usage or {}
+        row = (story_id, request_msg, response_msg, timestamp, log_type,
+               usage.get("prompt_tokens"), usage.get("completion_tokens"), duration_s)
+        if self._closed:
+            # writer already drained (e.g. late call during interpreter exit)
+            self._spool([row])
+            return
+        self._queue.put(row)
+
+    def close(self, timeout=LOG_DRAIN_TIMEOUT):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print(f"[DB WARN] log writer did not drain within {timeout}s; remaining rows are spooled")
+            self._spool(self._drain_nowait())
+
+    # -------------------------
+    # worker loop
+    # -------------------------
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                row = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                row = False
+            if row is None:
+                self._flush(batch + self._drain_nowait())
+                return
+            if row:
+                batch.append(row)
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _drain_nowait(self):
+        rows = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                return rows
+            if row:
+                rows.append(row)
+
+    def _get_pool(self):
+        if self._pool is None:
+            # imported on first flush so importing Plan / Write does not load the driver
+            from mysql.connector import pooling
+            self._pool = pooling.MySQLConnectionPool(
+                pool_name="prism_logs", pool_size=self.pool_size, **self.config
+            )
+        return self._pool
+
+    def _probe_token_columns(self, cursor):
+        # does story_logs have the prompt/completion token columns? checked once per pool
+        if self._has_token_columns is None:
+            cursor.execute("SHOW COLUMNS FROM story_logs LIKE 'prompt_tokens'")
+            self._has_token_columns = bool(cursor.fetchall())
+            if not self._has_token_columns:
+                print("[DB WARN] story_logs has no token columns, logging without them "
+                      "(run `python LogWriter.py --migrate` to add them)")
+        return self._has_token_columns
+
+    def _insert(self, rows):
+        conn = self._get_pool().get_connection()
+        new_blobs = []
+        try:
+            cursor = conn.cursor()
+            try:
+                if self.schema in ("story_logs", "both"):
+                    if self._probe_token_columns(cursor):
+                        sql = INSERT_SQL
+                        log_rows = [(tuple(row) + (None,) * (7 - len(row)))[:7] for row in rows]  # old 5-field spool rows
+                    else:
+                        sql = LEGACY_INSERT_SQL
+                        log_rows = [tuple(row[:5]) for row in rows]
+                    for start in range(0, len(log_rows), self.batch_size):
+                        cursor.executemany(sql, log_rows[start:start + self.batch_size])
+                if self._run_store is not None:
+                    for start in range(0, len(rows), self.batch_size):
+                        new_blobs.extend(self._run_store.insert_rows(cursor, rows[start:start + self.batch_size]))
+                conn.commit()
+            finally:
+                cursor.close()
+        finally:
+            conn.close()  # returns the connection to the pool
+        if self._run_store is not None:
+            self._run_store.committed(new_blobs)
+
+    def _flush(self, rows):
+        if not rows:
+            return
+        try:
+            self._insert(rows)
+        except Exception as e:
+            print(f"[DB ERROR] failed to write {len(rows)} log rows, spooling to {self.spool_path}: {e}")
+            self._pool = None  # rebuild the pool (and re-probe the schema) on the next attempt
+            self._has_token_columns = None
+            self._spool(rows)
+            return
+        self.replay_spool()
+
+    # -------------------------
+    # local spool fallback
+    # -------------------------
+    def _spool(self, rows):
+        if not rows:
+            return
+        with self._spool_lock:
+            try:
+                os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+                with open(self.spool_path, "a", encoding="utf-8") as f:
+                    for row in rows:
+                        f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print(f"[DB ERROR] failed to spool {len(rows)} log rows: {e}")
+
+    def replay_spool(self):
+        with self._spool_lock:
+            if not os.path.exists(self.spool_path):
+                return 0
+            replay_path = self.spool_path + ".replay"
+            try:
+                os.replace(self.spool_path, replay_path)
+                with open(replay_path, "r", encoding="utf-8") as f:
+                    rows = [tuple(json.loads(line)) for line in f if line.strip()]
+            except Exception as e:
+                print(f"[DB ERROR] cannot read log spool {self.spool_path}: {e}")
+                return 0
+        try:
+            self._insert(rows)
+        except Exception as e:
+            print(f"[DB ERROR] spool replay failed, keeping {len(rows)} rows spooled: {e}")
+            self._spool(rows)
+            os.remove(replay_path)
+            return 0
+        os.remove(replay_path)
+        print(f"[INFO] replayed {len(rows)} spooled log rows")
+        return len(rows)
+
+
+# -------------------------
+# process-wide writer shared by Plan and Write
+# -------------------------
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = LogWriter()
+            atexit.register(_writer.close)
+        return _writer
+
+
+def set_log_writer(writer):
+    # install a writer (e.g. a benchmark or test double); the previous one is drained
+    global _writer
+    with _writer_lock:
+        previous, _writer = _writer, writer
+    if previous is not None and previous is not writer:
+        previous.close()
+
+
+def save_log(story_id, request_msg, response_msg, log_type, usage=None, duration_s=None):
+    try:
+        get_log_writer().submit(story_id, request_msg, response_msg, log_type, usage=usage, duration_s=duration_s)
+    except Exception as e:
+        print(f"[DB ERROR] failed to queue log: {e}")
+
+
+def flush_logs(timeout=LOG_DRAIN_TIMEOUT):
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.close(timeout)
+
+
+def migrate_token_columns(config=None):
+    # add prompt_tokens / completion_tokens to an existing story_logs table; returns True if altered
+    import mysql.connector
+    conn = mysql.connector.connect(**(config or db_config))
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SHOW COLUMNS FROM story_logs LIKE 'prompt_tokens'")
+        if cursor.fetchall():
+            cursor.close()
+            return False
+        cursor.execute(TOKEN_COLUMNS_DDL)
+        conn.commit()
+        cursor.close()
+        return True
+    finally:
+        conn.close()
+
+
+# -------------------------
+# CLI: replay a spool file into MySQL once the database is reachable again;
+# --migrate adds the token columns to an existing story_logs table first
+# -------------------------
+if __name__ == "__main__":
+    if "--migrate" in sys.argv[1:]:
+        if migrate_token_columns():
+            print("[INFO] story_logs: added prompt_tokens / completion_tokens columns")
+        else:
+            print("[INFO] story_logs already has the token columns")
+    writer = LogWriter()
+    replayed = writer.replay_spool()
+    writer.close()
+    print(f"[INFO] spool replay finished ({replayed} rows)")
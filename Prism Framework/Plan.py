@@ -1,53 +1,43 @@
 import os
-import re
-from datetime import datetime
-import mysql.connector
-from zhipuai import ZhipuAI
+import asyncio
 import json
+from Spectrum import arun_spectral_bands, parse_grade, aresolve_focal_decision
+# save_log queues rows to the shared pooled/batched writer (see LogWriter.py)
+from LogWriter import save_log
+# every completion goes through LLM.achat_completion (response cache, ...)
+from LLM import build_stage_messages, achat_completion, last_usage
+# per-stage model routing over pluggable backends (see Router.py)
+from Router import get_router
+from Budget import fit_context, record_usage, record_parse, write_usage_report
+# Beam Reforging output format, tolerant parser and format-only repair (see Reforge.py)
+import Reforge
+# per-stage spans and opt-in verbose echo (see Trace.py)
+from Trace import span, span_name, annotate, echo
+from Checkpoint import CHECKPOINT_FILE, checkpointing, replay_stage, record_stage
 
 # -------------------------
-# Database connection config (same as original)
+# LLM client config
 # -------------------------
-db_config = {
-    "host": "localhost",
-    "user": "root",
-    "password": "123456",
-    "database": "agent_room",
-    "auth_plugin": "mysql_native_password"
-}
+# routes each stage to its model / backend; every backend client is wrapped with
+# rate limiting, retry/backoff and adaptive concurrency (see Router.py, Limiter.py)
+client = get_router()
+# asyncio engine: with PRISM_ASYNC_CLIENT=1 calls go through the async-native HTTP
+# clients; otherwise the synchronous clients above are driven on worker threads
+aclient = get_router(is_async=True) if os.getenv("PRISM_ASYNC_CLIENT", "0") == "1" else None
 
-# -------------------------
-# ZhipuAI client config
-# -------------------------
-API_KEY = os.getenv("ZHIPUAI_API_KEY", "Your api key")
-client = ZhipuAI(api_key=API_KEY)
 
-# -------------------------
-# Helper: save logs to database
-# -------------------------
-def save_log(story_id, request_msg, response_msg, log_type):
-    try:
-        conn = mysql.connector.connect(**db_config)
-        cursor = conn.cursor()
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        sql = """
-            INSERT INTO story_logs (story_id, request_message, response_message, timestamp, type)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        cursor.execute(sql, (story_id, request_msg, response_msg, timestamp, log_type))
-        conn.commit()
-    except Exception as e:
-        print(f"[DB ERROR] failed to write log: {e}")
-    finally:
-        try:
-            cursor.close()
-            conn.close()
-        except Exception:
-            pass
+def engine_client():
+    return aclient if aclient is not None else client
 
 # -------------------------
 # Plan internal utilities
 # -------------------------
+PLAN_KEYS = ["Central Conflict", "Character Descriptions", "Setting", "Key Plot Points"]
+PLAN_REFORGE_FORMAT = (
+    "Output in exact format:\n"
+    "Central Conflict: <refined text>\nCharacter Descriptions: <refined text>\nSetting: <refined text>\nKey Plot Points: <refined text>\n"
+)
+
 def extract_plan_identifiers(plan_dict):
     sections = list(plan_dict.keys())
     if sections:
@@ -56,30 +46,35 @@ def extract_plan_identifiers(plan_dict):
         )
     return "a Creative Writing Task"
 
-def call_agent_for_plan(client, prompt, context_text, story_id, log_type="plans"):
+# LLM call wrapper: checkpoint replay, span, usage accounting and logging around each stage
+async def acall_agent_for_plan(client, prompt, context_text, story_id, log_type="plans"):
+    # trim oversized context fields to the configured window (no-op by default)
+    context_text, trimmed_chars = fit_context(prompt, context_text, log_type)
     request_text = f"{prompt}\n{context_text}"
-    messages = [
-        {"role": "system", "content": "You are a creative writing assistant following the given prompt strictly."},
-        {"role": "user", "content": request_text}
-    ]
-    try:
-        response = client.chat.completions.create(
-            model="glm-4-air",
-            messages=messages,
-        )
-        output = response.choices[0].message.content
-    except Exception as e:
-        print(f"[ERROR] LLM call failed: {e}")
-        output = f"[ERROR] LLM call failed: {e}"
+    messages = build_stage_messages(prompt, context_text)
+    # stage completed by an interrupted earlier run: replay it from the checkpoint journal
+    replayed = replay_stage(story_id, log_type, request_text)
+    if replayed is not None:
+        return replayed
+
+    with span(span_name(log_type), story_id, log_type=log_type) as record:
+        try:
+            output = await achat_completion(client, messages, log_type=log_type)
+        except Exception as e:
+            # never hand error text downstream as if it were plan content
+            print(f"[ERROR] LLM call failed: {e}")
+            save_log(story_id, request_text, f"[ERROR] LLM call failed: {e}", log_type)
+            raise
+        usage = last_usage()
+        annotate(record, usage, trimmed_chars)
 
-    print(f"\n=== {log_type.upper()} STAGE OUTPUT (story_id={story_id}) ===")
-    print("REQUEST:\n", request_text)
-    print("RESPONSE:\n", output)
+    echo(f"\n=== {log_type.upper()} STAGE OUTPUT (story_id={story_id}) ===")
+    echo("REQUEST:\n", request_text)
+    echo("RESPONSE:\n", output)
 
-    try:
-        save_log(story_id, request_text, output, log_type)
-    except Exception as e:
-        print(f"[WARN] failed to save log: {e}")
+    record_stage(story_id, log_type, request_text, output)
+    record_usage(story_id, log_type, usage, prompt_chars=len(request_text), trimmed_chars=trimmed_chars)
+    save_log(story_id, request_text, output, log_type, usage=usage, duration_s=record.get("duration_s"))
 
     return output
 
@@ -88,7 +83,8 @@ def call_agent_for_plan(client, prompt, context_text, story_id, log_type="plans"
 # NOTE: logic unchanged; only terms/prompts/log tags updated to Prism terminology:
 # Beam Focusing, Spectrum Conference, Spectral Analysis, Focal Decision, Beam Reforging
 # -------------------------
-def generate_plan_only(story_id, creative_writing_task):
+async def agenerate_plan_only(story_id, creative_writing_task):
+    llm = engine_client()
     plan_dict = {}
 
     # Draft: Initial Central Conflict
@@ -100,7 +96,7 @@ def generate_plan_only(story_id, creative_writing_task):
         "⋆ What’s stopping them from achieving it?"
     ).replace("<identifiers found in the plan>", extract_plan_identifiers(plan_dict))
     conflict_context = f"Original Task: {creative_writing_task}"
-    conflict_output = call_agent_for_plan(client, conflict_prompt, conflict_context, story_id, log_type="prism_devise_conflict")
+    conflict_output = await acall_agent_for_plan(llm, conflict_prompt, conflict_context, story_id, log_type="prism_devise_conflict")
     plan_dict["Central Conflict"] = conflict_output
 
     # Draft: Initial Character Descriptions (subscribe to Conflict)
@@ -113,7 +109,7 @@ def generate_plan_only(story_id, creative_writing_task):
         "How will they change and grow over the course of this story?"
     ).replace("<identifiers found in the plan>", extract_plan_identifiers(plan_dict))
     character_context = f"Original Task: {creative_writing_task}\n\nPlan so far: {json.dumps(plan_dict, ensure_ascii=False)}"
-    character_output = call_agent_for_plan(client, character_prompt, character_context, story_id, log_type="prism_devise_character")
+    character_output = await acall_agent_for_plan(llm, character_prompt, character_context, story_id, log_type="prism_devise_character")
     plan_dict["Character Descriptions"] = character_output
 
     # Draft: Initial Setting (subscribe to upstream)
@@ -124,7 +120,7 @@ def generate_plan_only(story_id, creative_writing_task):
         "⋆ When does the story take place? What decade is it set in? How much time elapses over the course of the story?"
     ).replace("<identifiers found in the plan>", extract_plan_identifiers(plan_dict))
     setting_context = f"Original Task: {creative_writing_task}\n\nPlan so far: {json.dumps(plan_dict, ensure_ascii=False)}"
-    setting_output = call_agent_for_plan(client, setting_prompt, setting_context, story_id, log_type="prism_devise_setting")
+    setting_output = await acall_agent_for_plan(llm, setting_prompt, setting_context, story_id, log_type="prism_devise_setting")
     plan_dict["Setting"] = setting_output
 
     # Draft: Initial Key Plot Points (subscribe to all upstream)
@@ -132,7 +128,7 @@ def generate_plan_only(story_id, creative_writing_task):
         "Given <identifiers found in the plan>, describe the key plot points in detailed bullet points."
     ).replace("<identifiers found in the plan>", extract_plan_identifiers(plan_dict))
     plot_context = f"Original Task: {creative_writing_task}\n\nPlan so far: {json.dumps(plan_dict, ensure_ascii=False)}"
-    plot_output = call_agent_for_plan(client, plot_prompt, plot_context, story_id, log_type="prism_devise_plot")
+    plot_output = await acall_agent_for_plan(llm, plot_prompt, plot_context, story_id, log_type="prism_devise_plot")
     plan_dict["Key Plot Points"] = plot_output
 
     # Prism calibration (max 1 iteration)
@@ -145,7 +141,7 @@ def generate_plan_only(story_id, creative_writing_task):
         "Focus on the essential information needed to support downstream spectrum analysis and generation. Keep it concise but retain details required for expansive story generation. Output a compact summary for subsequent agents."
     )
     beam_focusing_context = f"Original Task: {creative_writing_task}\n\nCurrent Plan: {json.dumps(plan_dict, ensure_ascii=False)}"
-    beam_focusing_output = call_agent_for_plan(client, beam_focusing_prompt, beam_focusing_context, story_id, log_type="prism_beam_focusing")
+    beam_focusing_output = await acall_agent_for_plan(llm, beam_focusing_prompt, beam_focusing_context, story_id, log_type="prism_beam_focusing")
 
     # Spectrum Conference (single-round debate)
     spectrum_conf_prompt = (
@@ -155,102 +151,108 @@ def generate_plan_only(story_id, creative_writing_task):
         "Produce a transcript (more than 10 exchanges) and conclude with consolidated, actionable suggestions aligned with the original task."
     )
     spectrum_conf_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {beam_focusing_output}"
-    spectrum_conf_output = call_agent_for_plan(client, spectrum_conf_prompt, spectrum_conf_context, story_id, log_type="prism_spectrum_conference")
+    spectrum_conf_output = await acall_agent_for_plan(llm, spectrum_conf_prompt, spectrum_conf_context, story_id, log_type="prism_spectrum_conference")
 
     # Spectral Analysis (parallel critiques)
     spectral_critiques = ""
-    grades = []
-    grade_map = {"A": 3, "B": 2, "C": 1}
-    for dim in spectrum_dimensions:
+    grade_counts = {"A": 0, "B": 0, "C": 0}
+    spectral_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {beam_focusing_output}\n\nSpectrum Conference Transcript: {spectrum_conf_output}"
+
+    async def run_spectral_band(dim):
         spectral_prompt = (
             f"Perform Spectral Analysis for one spectrum band: {dim}. "
             f"For the {dim} Analyst: provide an assessment (grade A/B/C with evidence) focused on {'coherence, consistency, and progression' if dim=='Story Structure' else 'innovation and avoidance of clichés' if dim=='Originality' else 'character/setting richness and believability' if dim=='Depth' else 'variety, devices, and expressiveness' if dim=='Style' else 'adherence to the original task (key elements, perspective, implications)'}."
             " Start with Grade: X\nThen provide bullet-pointed suggestions."
         )
-        spectral_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {beam_focusing_output}\n\nSpectrum Conference Transcript: {spectrum_conf_output}"
-        spectral_output = call_agent_for_plan(client, spectral_prompt, spectral_context, story_id, log_type=f"prism_spectral_analysis_{dim}")
+        return await acall_agent_for_plan(llm, spectral_prompt, spectral_context, story_id, log_type=f"prism_spectral_analysis_{dim}")
+
+    # bands run concurrently; critiques/grades are still assembled in band order
+    spectral_outputs = await arun_spectral_bands(spectrum_dimensions, run_spectral_band)
+    for dim, spectral_output in zip(spectrum_dimensions, spectral_outputs):
+        if spectral_output is None:
+            continue  # band failed after retries; judge on the remaining bands
         spectral_critiques += f"\n{dim} Spectral Analysis:\n{spectral_output}"
-        grade_match = re.search(r'Grade: (A|B|C)', spectral_output, re.IGNORECASE)
-        if grade_match:
-            grade = grade_match.group(1).upper()
-            grades.append(grade_map.get(grade, 0))
-
-    # Focal Decision phase
-    focal_decision_prompt = (
-        "Conduct a Focal Decision: given the spectral analyses, determine revision category. Compute average grade (or majority). "
-        "Output category as one of: 'Severe (majority C)' / 'Major (majority B)' / 'Minor (majority A with B)' / 'No Issue (all A)'. "
-        "Provide reasons and confidence (High/Medium/Low). If category is below B, list targeted fixes."
-    )
-    focal_decision_context = f"Spectral Analyses: {spectral_critiques}"
-    focal_decision_output = call_agent_for_plan(client, focal_decision_prompt, focal_decision_context, story_id, log_type="prism_focal_decision")
-
-    category_match = re.search(r'category: \'(Severe|Major|Minor|No Issue)\'', focal_decision_output, re.IGNORECASE)
-    if category_match:
-        category = category_match.group(1).upper()
-        if category in ['SEVERE', 'MAJOR']:
-            need_refine = True
-            suggestions = re.search(r'suggest targeted fixes:\s*(.*)', focal_decision_output, re.DOTALL | re.IGNORECASE)
-            refine_suggestions = suggestions.group(1).strip() if suggestions else ""
-        else:
-            need_refine = False
-            refine_suggestions = ""
-    else:
-        need_refine = True
-        refine_suggestions = ""
+        grade = parse_grade(spectral_output)
+        if grade:
+            grade_counts[grade] += 1
+
+    # Focal Decision phase: decided from the grades; the LLM is only asked when
+    # they are ambiguous or targeted fixes are needed (see Spectrum.DecisionPolicy)
+    async def run_focal_decision():
+        focal_decision_prompt = (
+            "Conduct a Focal Decision: given the spectral analyses, determine revision category. Compute average grade (or majority). "
+            "Output category as one of: 'Severe (majority C)' / 'Major (majority B)' / 'Minor (majority A with B)' / 'No Issue (all A)'. "
+            "Provide reasons and confidence (High/Medium/Low). If category is below B, list targeted fixes."
+        )
+        focal_decision_context = f"Spectral Analyses: {spectral_critiques}"
+        return await acall_agent_for_plan(llm, focal_decision_prompt, focal_decision_context, story_id, log_type="prism_focal_decision")
+
+    decision = await aresolve_focal_decision(grade_counts, list(zip(spectrum_dimensions, spectral_outputs)), run_focal_decision)
+    print(f"[INFO] {story_id} plan Focal Decision: {decision['category']} (from {decision['source']}, grades {grade_counts})")
+    need_refine = decision["need_refine"]
+    refine_suggestions = decision["suggestions"]
 
     # Beam Reforging (refine if needed)
     if need_refine:
         beam_reforge_prompt = (
             "Perform Beam Reforging: based on the beam-focused summary, spectral analyses, and focal decision suggestions, refine each plan element (Central Conflict, Character Descriptions, Setting, Key Plot Points). "
-            "Produce detailed, expanded refinements that support longer story generation. Output in exact format:\n"
-            "Central Conflict: <refined text>\nCharacter Descriptions: <refined text>\nSetting: <refined text>\nKey Plot Points: <refined text>\n"
+            "Produce detailed, expanded refinements that support longer story generation. " + Reforge.output_format(PLAN_KEYS, PLAN_REFORGE_FORMAT) +
             "Ensure refinements enhance all relevant spectrum dimensions and strictly follow the original task."
         )
         beam_reforge_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {beam_focusing_output}\n\nFocal Decision Suggestions: {refine_suggestions}\n\nSpectral Analyses: {spectral_critiques}\n\nSpectrum Conference: {spectrum_conf_output}"
-        beam_reforge_output = call_agent_for_plan(client, beam_reforge_prompt, beam_reforge_context, story_id, log_type="prism_beam_reforging")
-
-        refined_conflict_match = re.search(r'Central Conflict\s*:\s*(.*?)(?=\s*Character Descriptions\s*:|\Z)', beam_reforge_output, re.DOTALL | re.IGNORECASE)
-        refined_character_match = re.search(r'Character Descriptions\s*:\s*(.*?)(?=\s*Setting\s*:|\Z)', beam_reforge_output, re.DOTALL | re.IGNORECASE)
-        refined_setting_match = re.search(r'Setting\s*:\s*(.*?)(?=\s*Key Plot Points\s*:|\Z)', beam_reforge_output, re.DOTALL | re.IGNORECASE)
-        refined_plot_match = re.search(r'Key Plot Points\s*:\s*(.*)', beam_reforge_output, re.DOTALL | re.IGNORECASE)
-
-        if refined_conflict_match and refined_character_match and refined_setting_match and refined_plot_match:
-            plan_dict["Central Conflict"] = refined_conflict_match.group(1).strip()
-            plan_dict["Character Descriptions"] = refined_character_match.group(1).strip()
-            plan_dict["Setting"] = refined_setting_match.group(1).strip()
-            plan_dict["Key Plot Points"] = refined_plot_match.group(1).strip()
-        else:
-            print(f"[WARN] Beam Reforging parse failed. Keeping current plan_dict.")
-            retry_reforge_prompt = beam_reforge_prompt + " Strictly follow the exact output keys and format."
-            retry_reforge_output = call_agent_for_plan(client, retry_reforge_prompt, beam_reforge_context, story_id, log_type="prism_beam_reforging_retry")
-            retry_conflict_match = re.search(r'Central Conflict\s*:\s*(.*?)(?=\s*Character Descriptions\s*:|\Z)', retry_reforge_output, re.DOTALL | re.IGNORECASE)
-            retry_character_match = re.search(r'Character Descriptions\s*:\s*(.*?)(?=\s*Setting\s*:|\Z)', retry_reforge_output, re.DOTALL | re.IGNORECASE)
-            retry_setting_match = re.search(r'Setting\s*:\s*(.*?)(?=\s*Key Plot Points\s*:|\Z)', retry_reforge_output, re.DOTALL | re.IGNORECASE)
-            retry_plot_match = re.search(r'Key Plot Points\s*:\s*(.*)', retry_reforge_output, re.DOTALL | re.IGNORECASE)
-            if retry_conflict_match and retry_character_match and retry_setting_match and retry_plot_match:
-                plan_dict["Central Conflict"] = retry_conflict_match.group(1).strip()
-                plan_dict["Character Descriptions"] = retry_character_match.group(1).strip()
-                plan_dict["Setting"] = retry_setting_match.group(1).strip()
-                plan_dict["Key Plot Points"] = retry_plot_match.group(1).strip()
+        beam_reforge_output = await acall_agent_for_plan(llm, beam_reforge_prompt, beam_reforge_context, story_id, log_type="prism_beam_reforging")
+
+        refined, parse_method = Reforge.parse_reforge(beam_reforge_output, PLAN_KEYS)
+        if refined is None:
+            if Reforge.REFORGE_REPAIR == "full":
+                print(f"[WARN] Beam Reforging parse failed. Retrying the full reforge prompt.")
+                retry_reforge_prompt = beam_reforge_prompt + " Strictly follow the exact output keys and format."
+                retry_reforge_output = await acall_agent_for_plan(llm, retry_reforge_prompt, beam_reforge_context, story_id, log_type="prism_beam_reforging_retry")
             else:
-                print(f"[WARN] Beam Reforging retry failed. Keeping current plan_dict.")
+                # send back only the malformed output, not the whole reforge context
+                print(f"[WARN] Beam Reforging parse failed. Repairing the output format.")
+                repair_prompt, repair_context = Reforge.repair_request(beam_reforge_output, PLAN_KEYS, PLAN_REFORGE_FORMAT)
+                retry_reforge_output = await acall_agent_for_plan(llm, repair_prompt, repair_context, story_id, log_type="prism_beam_reforging_repair")
+            refined, _ = Reforge.parse_reforge(retry_reforge_output, PLAN_KEYS)
+            parse_method = "repaired" if refined is not None else "failed"
+        record_parse(story_id, "prism_beam_reforging", parse_method)
+
+        if refined is not None:
+            plan_dict.update(refined)
+        else:
+            print(f"[WARN] Beam Reforging retry failed. Keeping current plan_dict.")
 
     return plan_dict
 
+
+def generate_plan_only(story_id, creative_writing_task):
+    # synchronous entry point: runs the asyncio engine on a private event loop
+    return asyncio.run(agenerate_plan_only(story_id, creative_writing_task))
+
 # -------------------------
 # main(...) to support batch_runner call
 # returns dict for upstream saving
 # supports various parameter names
+# amain(...) is the same entry point for callers already inside an event loop
 # -------------------------
 def main(example_id=None, story_id=None, creative_input=None, task=None, output_dir=None, plan_output_file=None, plan_file=None):
+    return asyncio.run(amain(example_id=example_id, story_id=story_id, creative_input=creative_input, task=task,
+                             output_dir=output_dir, plan_output_file=plan_output_file, plan_file=plan_file))
+
+
+async def amain(example_id=None, story_id=None, creative_input=None, task=None, output_dir=None, plan_output_file=None, plan_file=None):
     sid = example_id or story_id or "example_unknown"
     creative = creative_input or task or ""
     plan_path = plan_output_file or plan_file
     if not plan_path and output_dir:
         plan_path = os.path.join(output_dir, "story_plan.json")
 
-    plan_dict = generate_plan_only(sid, creative)
-    result = {"plan": plan_dict, "example_id": sid}
+    # journal every completed stage next to the plan so a rerun resumes where it died
+    checkpoint_path = os.path.join(os.path.dirname(plan_path), CHECKPOINT_FILE.format(stage="plan")) if plan_path else None
+    with span("plan", sid), checkpointing(sid, checkpoint_path):
+        plan_dict = await agenerate_plan_only(sid, creative)
+    # keep the task next to the plan so Write.main can pick it up from the file
+    result = {"plan": plan_dict, "example_id": sid, "task": creative}
 
     if plan_path:
         try:
@@ -260,6 +262,7 @@ def main(example_id=None, story_id=None, creative_input=None, task=None, output_
             print(f"[INFO] Plan written to {plan_path}")
         except Exception as e:
             print(f"[WARN] cannot write plan to {plan_path}: {e}")
+        write_usage_report(sid, os.path.join(os.path.dirname(plan_path), "usage_report.json"))
 
     return result
 
@@ -0,0 +1,115 @@
+import os
+import re
+import json
+
+# -------------------------
+# Beam Reforging output: structured format, tolerant parsing and cheap repair
+#   PRISM_REFORGE_FORMAT - text (default, "Key: <refined text>" as before) | json
+#                          (ask for a JSON object with exactly the expected keys)
+#   PRISM_REFORGE_REPAIR - format (default: on a parse miss send only the malformed
+#                          output back with a "fix the format only" request) |
+#                          full (old behaviour: re-issue the whole reforge prompt)
+# parse_reforge() accepts either shape regardless of the configured format:
+# a JSON object (optionally fenced), markdown headings, bold keys, missing colons.
+# -------------------------
+REFORGE_FORMAT = os.getenv("PRISM_REFORGE_FORMAT", "text")
+REFORGE_REPAIR = os.getenv("PRISM_REFORGE_REPAIR", "format")
+
+FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+# decoration around a key used as a heading: "## Setting", "**Setting:**", "__Setting__ -"
+HEADING_RE = r"^[ \t]*(?:#{{1,6}}[ \t]*)?(?:[*_]{{1,2}}[ \t]*)?{key}[ \t]*(?:[*_]{{1,2}})?[ \t]*(?:[:：\-–—][ \t]*(?:[*_]{{1,2}})?|(?=\n)|$)"
+INLINE_RE = r"{key}\s*(?:[*_]{{1,2}})?\s*[:：]"
+
+
+def output_format(keys, text_format, mode=None):
+    # text mode keeps the caller's original format line, so text prompts are unchanged
+    mode = mode or REFORGE_FORMAT
+    if mode != "json":
+        return text_format
+    key_list = ", ".join(json.dumps(k, ensure_ascii=False) for k in keys)
+    return (
+        f"Output only a JSON object (no markdown fences, no commentary) with exactly these keys: {key_list}; "
+        "each value is the complete refined text as a string.\n"
+    )
+
+
+def _clean(value):
+    value = value.strip()
+    value = re.sub(r"^(?:\*\*|__)(?=\s)", "", value)  # closing bold marker left after the key
+    value = re.sub(r"\s*(?:\*\*|__|-{3,})$", "", value)  # opening bold marker / rule before the next key
+    return value.strip()
+
+
+def parse_json_fields(output, keys):
+    text = output or ""
+    fence = FENCE_RE.search(text)
+    if fence:
+        text = fence.group(1)
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    # schema: every expected key present (case/space-insensitive) with a non-empty string
+    normalized = {re.sub(r"\s+", " ", str(k)).strip().lower(): v for k, v in data.items()}
+    fields = {}
+    for key in keys:
+        value = normalized.get(key.lower())
+        if not isinstance(value, str) or not value.strip():
+            return None
+        fields[key] = value.strip()
+    return fields
+
+
+def _split_at(output, keys, pattern, flags):
+    positions = []
+    for key in keys:
+        match = re.search(pattern.format(key=re.escape(key)), output, flags)
+        if match is None:
+            return None
+        positions.append((match.start(), match.end(), key))
+    positions.sort()
+    fields = {}
+    for i, (_, body_start, key) in enumerate(positions):
+        body_end = positions[i + 1][0] if i + 1 < len(positions) else len(output)
+        value = _clean(output[body_start:body_end])
+        if not value:
+            return None
+        fields[key] = value
+    return fields
+
+
+def parse_text_fields(output, keys):
+    output = output or ""
+    # headings at line start first (tolerates markdown and missing colons),
+    # then "Key:" anywhere, which is what the old lookahead regexes accepted
+    return (
+        _split_at(output, keys, HEADING_RE, re.IGNORECASE | re.MULTILINE)
+        or _split_at(output, keys, INLINE_RE, re.IGNORECASE)
+    )
+
+
+def parse_reforge(output, keys):
+    # returns (fields, method) with method "json" / "text", or (None, None)
+    fields = parse_json_fields(output, keys)
+    if fields is not None:
+        return fields, "json"
+    fields = parse_text_fields(output, keys)
+    if fields is not None:
+        return fields, "text"
+    return None, None
+
+
+def repair_request(output, keys, text_format, mode=None):
+    # only the malformed output goes back to the model, not the reforge context
+    prompt = (
+        "Reformat the text below into the required output format. Do not rewrite, shorten, summarize or add content; "
+        f"keep every sentence and only fix the structure so that each of these parts is clearly keyed: {', '.join(keys)}. "
+        + output_format(keys, text_format, mode)
+    )
+    context = f"Text to Reformat: {output}"
+    return prompt, context
@@ -0,0 +1,202 @@
+import os
+import json
+import types
+import threading
+import urllib.error
+import urllib.request
+from Budget import stage_family
+from Limiter import ResilientClient, AsyncResilientClient, AdaptiveConcurrency
+from AsyncClient import AsyncZhipuAI, APIStatusError, to_namespace, LLM_TIMEOUT
+
+# -------------------------
+# LLM backends and per-stage model routing
+#   PRISM_MODEL             - model used by every stage without a route (default glm-4-air)
+#   PRISM_MODEL_ROUTES      - stage family -> model, e.g.
+#                             "prism_beam_focusing=glm-4-flash,prism_spectral_analysis=glm-4-flash"
+#                             (or a path to a JSON file with the same mapping). A route covers
+#                             the family and its sub-families: prism_beam_focusing also routes
+#                             prism_beam_focusing_prior / _section / _rolling.
+#   PRISM_MODEL_CONCURRENCY - per-model in-flight limits, e.g. "glm-4-flash=32,openai:qwen2.5=4";
+#                             models without one share the global Limiter budget
+#   A model may carry a provider prefix ("openai:qwen2.5-7b-instruct"); no prefix = zhipuai.
+#   PRISM_OPENAI_BASE_URL / PRISM_OPENAI_API_KEY - OpenAI-compatible endpoint for "openai:"
+#                             models (vLLM, llama.cpp server, a local stand-in, ...)
+# -------------------------
+DEFAULT_MODEL = os.getenv("PRISM_MODEL", "glm-4-air")
+DEFAULT_PROVIDER = "zhipuai"
+OPENAI_BASE_URL = os.getenv("PRISM_OPENAI_BASE_URL", "http://localhost:8000/v1")
+OPENAI_API_KEY = os.getenv("PRISM_OPENAI_API_KEY", "")
+
+
+def parse_mapping(spec, value_type=str):
+    # "key=value,key=value" or a path to a JSON object
+    if not spec:
+        return {}
+    if os.path.exists(spec):
+        with open(spec, "r", encoding="utf-8") as f:
+            return {k: value_type(v) for k, v in json.load(f).items()}
+    mapping = {}
+    for item in spec.split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            mapping[key.strip()] = value_type(value.strip())
+    return mapping
+
+
+def lookup_stage(mapping, log_type, default=None):
+    # exact log_type first, then the longest key covering its stage family
+    if not log_type:
+        return default
+    if log_type in mapping:
+        return mapping[log_type]
+    family = stage_family(log_type)
+    best = None
+    for key in mapping:
+        if (family == key or family.startswith(key + "_")) and (best is None or len(key) > len(best)):
+            best = key
+    return mapping[best] if best is not None else default
+
+
+# -------------------------
+# OpenAI-compatible HTTP client (stdlib only, sync). The async engine uses
+# AsyncClient.AsyncZhipuAI with a different base URL: it speaks the same wire format.
+# -------------------------
+class OpenAICompatibleClient:
+    def __init__(self, base_url=OPENAI_BASE_URL, api_key=OPENAI_API_KEY, timeout=LLM_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, stream=False, timeout=None, **kwargs):
+        # timeout: per-request override (Hedge.py passes the stage deadline through Limiter)
+        payload = dict(kwargs, model=model, messages=messages, stream=stream)
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(
+            f"{self.base_url}/chat/completions", data=json.dumps(payload).encode("utf-8"), headers=headers
+        )
+        try:
+            response = urllib.request.urlopen(request, timeout=timeout or self.timeout)
+        except urllib.error.HTTPError as e:
+            raise APIStatusError(e.code, e.read().decode("utf-8", "replace")) from e
+        except urllib.error.URLError as e:
+            # surfaces as a retryable connection error to Limiter
+            raise ConnectionError(f"{self.base_url}: {e.reason}") from e
+        if stream:
+            return self._stream(response)
+        with response:
+            return to_namespace(json.loads(response.read().decode("utf-8")))
+
+    @staticmethod
+    def _stream(response):
+        # server-sent events: "data: {...}" lines, terminated by "data: [DONE]"
+        with response:
+            for raw in response:
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                yield to_namespace(json.loads(data))
+
+
+# -------------------------
+# provider registry: name -> (sync factory, async factory); factories take no
+# arguments and are called once, on the first call routed to that provider
+# -------------------------
+def _zhipuai():
+    from zhipuai import ZhipuAI
+    return ZhipuAI(api_key=os.getenv("ZHIPUAI_API_KEY", "Your api key"))
+
+
+def _async_zhipuai():
+    return AsyncZhipuAI(api_key=os.getenv("ZHIPUAI_API_KEY", "Your api key"))
+
+
+PROVIDERS = {
+    "zhipuai": (_zhipuai, _async_zhipuai),
+    "openai": (OpenAICompatibleClient, lambda: AsyncZhipuAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)),
+}
+
+
+def register_provider(name, factory, async_factory=None):
+    # async_factory=None: the async engine drives the sync client on worker threads
+    PROVIDERS[name] = (factory, async_factory)
+
+
+def split_model(spec):
+    # "openai:qwen2.5:7b" -> ("openai", "qwen2.5:7b"); unknown prefixes stay part of the name
+    provider, sep, name = spec.partition(":")
+    if sep and provider in PROVIDERS:
+        return provider, name
+    return DEFAULT_PROVIDER, spec
+
+
+# -------------------------
+# ModelRouter: resolves a log_type to (client, model). LLM.chat_completion and
+# friends route through it, so Plan / Write call sites keep passing one client.
+# One raw client per provider (shared connection pool), one Resilient wrapper
+# per model (own concurrency limit when configured).
+# -------------------------
+class ModelRouter:
+    def __init__(self, routes=None, default_model=None, concurrency=None, is_async=False):
+        self.routes = parse_mapping(os.getenv("PRISM_MODEL_ROUTES")) if routes is None else dict(routes)
+        self.default_model = default_model or DEFAULT_MODEL
+        self.limits = parse_mapping(os.getenv("PRISM_MODEL_CONCURRENCY"), int) if concurrency is None else dict(concurrency)
+        self.is_async = is_async
+        self._providers = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def model_for(self, log_type):
+        return lookup_stage(self.routes, log_type, self.default_model)
+
+    def _provider_client(self, provider):
+        if provider not in self._providers:
+            factory, async_factory = PROVIDERS[provider]
+            if self.is_async and async_factory is not None:
+                self._providers[provider] = (async_factory(), True)
+            else:
+                self._providers[provider] = (factory(), False)
+        return self._providers[provider]
+
+    def client_for(self, spec):
+        with self._lock:
+            if spec not in self._clients:
+                provider, _ = split_model(spec)
+                raw, native_async = self._provider_client(provider)
+                limit = self.limits.get(spec)
+                concurrency = AdaptiveConcurrency(limit, maximum=limit) if limit else None
+                wrapper = AsyncResilientClient if native_async else ResilientClient
+                self._clients[spec] = wrapper(raw, concurrency=concurrency)
+            return self._clients[spec]
+
+    def route(self, log_type, model=None):
+        # an explicit model wins over the routing table
+        spec = model or self.model_for(log_type)
+        _, name = split_model(spec)
+        return self.client_for(spec), name
+
+
+def resolve_route(client, model, log_type):
+    # plain clients (and test doubles) pass through with the default model
+    if isinstance(client, ModelRouter):
+        return client.route(log_type, model)
+    return client, model or DEFAULT_MODEL
+
+
+# -------------------------
+# process-wide routers shared by Plan and Write (per-model limits are global)
+# -------------------------
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(is_async=False):
+    with _routers_lock:
+        if is_async not in _routers:
+            _routers[is_async] = ModelRouter(is_async=is_async)
+        return _routers[is_async]
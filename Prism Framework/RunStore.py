@@ -0,0 +1,355 @@
+import os
+import re
+import sys
+import json
+import zlib
+import uuid
+import socket
+import hashlib
+import argparse
+from collections import OrderedDict
+
+from Budget import CONTEXT_LABELS, stage_family
+
+# -------------------------
+# Deduplicated run store (compact alternative to LONGTEXT-per-call story_logs rows)
+#   prism_blobs - content-addressed text segments (sha256 of the text), optionally compressed
+#   prism_runs  - one row per example per process run
+#   prism_calls - one row per LLM call: stage, timing, tokens and blob references
+# A request is split in front of its labelled context fields ("Plan: ...",
+# "Previous Sections: ...", ...), so the plan JSON and section texts embedded
+# in dozens of requests of a story are stored once. The segments concatenated
+# in order give back the exact request_message.
+#   PRISM_LOG_SCHEMA      - story_logs (default) | runstore | both   (used by LogWriter)
+#   PRISM_RUNSTORE_CODEC  - auto (zstd if installed, else zlib) | zstd | zlib | none
+# CLI: python RunStore.py init | migrate | export <story_id> | stats
+# -------------------------
+RUNSTORE_CODEC = os.getenv("PRISM_RUNSTORE_CODEC", "auto")
+MIN_COMPRESS_BYTES = 256  # shorter segments are stored as-is
+KNOWN_BLOBS_MAX = 100000  # blob hashes remembered as already stored (skips re-sending them)
+
+SCHEMA_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS prism_blobs (
+      hash CHAR(64) PRIMARY KEY,
+      codec VARCHAR(8) NOT NULL,
+      size INT NOT NULL,
+      body LONGBLOB NOT NULL
+    ) ENGINE=InnoDB
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS prism_runs (
+      run_id CHAR(32) PRIMARY KEY,
+      story_id VARCHAR(255) NOT NULL,
+      host VARCHAR(255) NULL,
+      pid INT NULL,
+      started_at DATETIME(3) NULL,
+      last_call_at DATETIME(3) NULL,
+      calls INT NOT NULL DEFAULT 0,
+      INDEX idx_runs_story (story_id)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS prism_calls (
+      id BIGINT AUTO_INCREMENT PRIMARY KEY,
+      run_id CHAR(32) NOT NULL,
+      story_id VARCHAR(255) NOT NULL,
+      log_type VARCHAR(255) NOT NULL,
+      family VARCHAR(255) NOT NULL,
+      called_at DATETIME(3) NULL,
+      duration_ms INT NULL,
+      prompt_tokens INT NULL,
+      completion_tokens INT NULL,
+      is_error TINYINT NOT NULL DEFAULT 0,
+      request_parts TEXT NOT NULL,
+      response_hash CHAR(64) NOT NULL,
+      source_id BIGINT NULL,
+      UNIQUE KEY uq_calls_source (source_id),
+      INDEX idx_calls_story_family (story_id, family),
+      INDEX idx_calls_family_time (family, called_at),
+      INDEX idx_calls_run (run_id)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """,
+]
+
+BLOB_SQL = "INSERT IGNORE INTO prism_blobs (hash, codec, size, body) VALUES (%s, %s, %s, %s)"
+RUN_SQL = """
+    INSERT INTO prism_runs (run_id, story_id, host, pid, started_at, last_call_at, calls)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE calls = calls + VALUES(calls), last_call_at = VALUES(last_call_at)
+"""
+CALL_SQL = """
+    INSERT IGNORE INTO prism_calls (run_id, story_id, log_type, family, called_at, duration_ms, prompt_tokens,
+                                    completion_tokens, is_error, request_parts, response_hash, source_id)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+SEGMENT_RE = re.compile(
+    r"(?=\n(?:" + "|".join(re.escape(label) for label in CONTEXT_LABELS) + r")(?: \([^)]*\))?: )"
+)
+
+
+def split_request(text):
+    return [part for part in SEGMENT_RE.split(text or "") if part]
+
+
+def blob_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# -------------------------
+# blob codecs
+# -------------------------
+def resolve_codec(codec):
+    if codec == "auto":
+        try:
+            import zstandard  # noqa: F401
+            return "zstd"
+        except ImportError:
+            return "zlib"
+    if codec == "zstd":
+        import zstandard  # noqa: F401  (fail early when requested but missing)
+    if codec not in ("zstd", "zlib", "none"):
+        raise ValueError(f"unknown run store codec {codec!r}")
+    return codec
+
+
+def encode(text, codec):
+    raw = text.encode("utf-8")
+    if codec == "none" or len(raw) < MIN_COMPRESS_BYTES:
+        return "none", raw
+    if codec == "zstd":
+        import zstandard
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(raw)
+    return "zlib", zlib.compress(raw, 6)
+
+
+def decode(codec, body):
+    body = bytes(body)
+    if codec == "zstd":
+        import zstandard
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif codec == "zlib":
+        body = zlib.decompress(body)
+    return body.decode("utf-8")
+
+
+class RunStore:
+    # writes LogWriter rows (story_id, request, response, timestamp, log_type,
+    # prompt_tokens, completion_tokens, duration_s) on the caller's cursor;
+    # the caller commits and then calls committed(pending)
+    def __init__(self, codec=RUNSTORE_CODEC, run_namespace=None, known_blobs_max=KNOWN_BLOBS_MAX):
+        self.codec = resolve_codec(codec)
+        self.run_namespace = run_namespace  # fixed run ids (migration), else one fresh id per story per process
+        self.known_blobs_max = known_blobs_max
+        self.host = run_namespace or socket.gethostname()
+        self.pid = None if run_namespace else os.getpid()
+        self._runs = {}
+        self._known = OrderedDict()
+        self._schema_ready = False
+
+    def run_id(self, story_id):
+        run_id = self._runs.get(story_id)
+        if run_id is None:
+            if self.run_namespace:
+                run_id = hashlib.md5(f"{self.run_namespace}:{story_id}".encode("utf-8")).hexdigest()
+            else:
+                run_id = uuid.uuid4().hex
+            self._runs[story_id] = run_id
+        return run_id
+
+    def ensure_schema(self, cursor):
+        if not self._schema_ready:
+            for ddl in SCHEMA_DDL:
+                cursor.execute(ddl)
+            self._schema_ready = True
+
+    def insert_rows(self, cursor, rows, source_ids=None):
+        self.ensure_schema(cursor)
+        blobs = {}
+        calls = []
+        runs = {}
+        for i, row in enumerate(rows):
+            row = tuple(row) + (None,) * (8 - len(row))
+            story_id, request_msg, response_msg, timestamp, log_type, prompt_tokens, completion_tokens, duration_s = row[:8]
+            parts = []
+            for segment in split_request(request_msg):
+                h = blob_hash(segment)
+                parts.append(h)
+                if h not in self._known:
+                    blobs[h] = segment
+            response_msg = response_msg or ""
+            response_hash = blob_hash(response_msg)
+            if response_hash not in self._known:
+                blobs[response_hash] = response_msg
+
+            run_id = self.run_id(story_id)
+            run = runs.setdefault(run_id, [story_id, timestamp, timestamp, 0])
+            run[2] = timestamp or run[2]
+            run[3] += 1
+            calls.append((
+                run_id, story_id, log_type, stage_family(log_type), timestamp,
+                int(duration_s * 1000) if duration_s is not None else None,
+                prompt_tokens, completion_tokens, 1 if response_msg.startswith("[ERROR]") else 0,
+                json.dumps(parts), response_hash, source_ids[i] if source_ids else None,
+            ))
+
+        blob_rows = []
+        for h, text in blobs.items():
+            codec, body = encode(text, self.codec)
+            blob_rows.append((h, codec, len(text), body))
+        if blob_rows:
+            cursor.executemany(BLOB_SQL, blob_rows)
+        cursor.executemany(RUN_SQL, [
+            (run_id, story_id, self.host, self.pid, started, last, count)
+            for run_id, (story_id, started, last, count) in runs.items()
+        ])
+        cursor.executemany(CALL_SQL, calls)
+        return list(blobs)
+
+    def committed(self, hashes):
+        for h in hashes:
+            self._known[h] = True
+            self._known.move_to_end(h)
+        while len(self._known) > self.known_blobs_max:
+            self._known.popitem(last=False)
+
+
+# -------------------------
+# reading back
+# -------------------------
+def fetch_blobs(cursor, hashes, chunk=500):
+    texts = {}
+    hashes = list(dict.fromkeys(hashes))
+    for start in range(0, len(hashes), chunk):
+        batch = hashes[start:start + chunk]
+        cursor.execute(
+            f"SELECT hash, codec, body FROM prism_blobs WHERE hash IN ({', '.join(['%s'] * len(batch))})", batch
+        )
+        for h, codec, body in cursor.fetchall():
+            texts[h] = decode(codec, body)
+    return texts
+
+
+def iter_story_calls(cursor, story_id):
+    # yields story_logs-shaped dicts, request/response rebuilt from the blobs
+    cursor.execute(
+        "SELECT id, run_id, log_type, called_at, duration_ms, prompt_tokens, completion_tokens, request_parts, response_hash "
+        "FROM prism_calls WHERE story_id = %s ORDER BY id", (story_id,)
+    )
+    rows = cursor.fetchall()
+    hashes = []
+    for row in rows:
+        hashes.extend(json.loads(row[7]))
+        hashes.append(row[8])
+    texts = fetch_blobs(cursor, hashes)
+    for call_id, run_id, log_type, called_at, duration_ms, prompt_tokens, completion_tokens, parts, response_hash in rows:
+        yield {
+            "id": call_id,
+            "story_id": story_id,
+            "run_id": run_id,
+            "type": log_type,
+            "timestamp": str(called_at) if called_at is not None else None,
+            "duration_ms": duration_ms,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "request_message": "".join(texts.get(h, "") for h in json.loads(parts)),
+            "response_message": texts.get(response_hash, ""),
+        }
+
+
+# -------------------------
+# migration from story_logs (idempotent: calls remember their story_logs id)
+# -------------------------
+def migrate_story_logs(conn, batch_size=500, since_id=0, codec=RUNSTORE_CODEC):
+    store = RunStore(codec=codec, run_namespace="story_logs")
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SHOW COLUMNS FROM story_logs LIKE 'prompt_tokens'")
+        token_columns = "prompt_tokens, completion_tokens" if cursor.fetchall() else "NULL, NULL"
+        last_id, migrated = since_id, 0
+        while True:
+            cursor.execute(
+                f"SELECT id, story_id, request_message, response_message, timestamp, type, {token_columns} "
+                "FROM story_logs WHERE id > %s ORDER BY id LIMIT %s", (last_id, batch_size)
+            )
+            batch = cursor.fetchall()
+            if not batch:
+                break
+            rows = [(r[1], r[2], r[3], r[4], r[5], r[6], r[7], None) for r in batch]
+            pending = store.insert_rows(cursor, rows, source_ids=[r[0] for r in batch])
+            conn.commit()
+            store.committed(pending)
+            last_id = batch[-1][0]
+            migrated += len(batch)
+            print(f"[INFO] migrated {migrated} story_logs rows (last id {last_id})")
+        # recount from prism_calls, so re-running a migration never double counts
+        cursor.execute(
+            "UPDATE prism_runs r SET calls = (SELECT COUNT(*) FROM prism_calls c WHERE c.run_id = r.run_id) "
+            "WHERE r.host = %s", (store.host,)
+        )
+        conn.commit()
+        return migrated, last_id
+    finally:
+        cursor.close()
+
+
+def store_stats(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(body)), 0) FROM prism_blobs")
+        blobs, text_bytes, stored_bytes = cursor.fetchall()[0]
+        cursor.execute("SELECT COUNT(*), COUNT(DISTINCT story_id) FROM prism_calls")
+        calls, stories = cursor.fetchall()[0]
+        stats = {"calls": calls, "stories": stories, "blobs": blobs,
+                 "unique_text_bytes": int(text_bytes), "stored_bytes": int(stored_bytes)}
+        try:
+            cursor.execute("SELECT COALESCE(SUM(LENGTH(request_message) + LENGTH(response_message)), 0) FROM story_logs")
+            stats["story_logs_bytes"] = int(cursor.fetchall()[0][0])
+        except Exception:
+            pass
+        return stats
+    finally:
+        cursor.close()
+
+
+if __name__ == "__main__":
+    import mysql.connector
+    from LogWriter import db_config
+
+    parser = argparse.ArgumentParser(description="Deduplicated Prism run store.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("init", help="create the prism_blobs / prism_runs / prism_calls tables")
+    migrate = sub.add_parser("migrate", help="copy story_logs rows into the run store")
+    migrate.add_argument("--batch", type=int, default=500)
+    migrate.add_argument("--since-id", type=int, default=0, help="resume after this story_logs id")
+    export = sub.add_parser("export", help="write a story's calls as JSONL (story_logs columns)")
+    export.add_argument("story_id")
+    export.add_argument("out", nargs="?", default=None, help="output file (default stdout)")
+    sub.add_parser("stats", help="blob / call counts and size compared with story_logs")
+    args = parser.parse_args()
+
+    conn = mysql.connector.connect(**db_config)
+    try:
+        if args.command == "init":
+            cursor = conn.cursor()
+            RunStore().ensure_schema(cursor)
+            conn.commit()
+            cursor.close()
+            print("[INFO] run store tables ready")
+        elif args.command == "migrate":
+            migrate_story_logs(conn, batch_size=args.batch, since_id=args.since_id)
+        elif args.command == "export":
+            cursor = conn.cursor()
+            out = open(args.out, "w", encoding="utf-8") if args.out else sys.stdout
+            try:
+                for call in iter_story_calls(cursor, args.story_id):
+                    out.write(json.dumps(call, ensure_ascii=False) + "\n")
+            finally:
+                cursor.close()
+                if out is not sys.stdout:
+                    out.close()
+        else:
+            print(json.dumps(store_stats(conn), indent=2))
+    finally:
+        conn.close()
@@ -0,0 +1,350 @@
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import asyncio
+import argparse
+import threading
+import socketserver
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Plan
+import Write
+import LogWriter
+from Budget import pop_usage_report
+from Router import ModelRouter
+
+# -------------------------
+# Long-running Prism worker service: one process keeps the LLM clients (and
+# their HTTP connection pools), the log writer's MySQL pool and one asyncio
+# engine warm, and takes plan / write / story jobs over a local HTTP API (TCP
+# or a Unix socket). Results are returned in the job status; files are only
+# written when a job names an output_dir.
+#   POST   /jobs               {"kind": "plan" | "write" | "story", "example_id", "task",
+#                               "plan" (write: Plan result {"plan", "task"}), "plan_path",
+#                               "output_dir", "wait" (seconds to wait for the result)}
+#   GET    /jobs               job summaries
+#   GET    /jobs/<id>?wait=S   status, plus result / error once finished (waits up to S seconds)
+#   DELETE /jobs/<id>          cancel a queued or running job
+#   GET    /health             queue / running counts
+#   PRISM_SERVICE_WORKERS    - jobs run concurrently (default 8); the rest queue
+#   PRISM_SERVICE_THREADS    - worker threads for synchronous LLM clients (default 64)
+#   PRISM_SERVICE_KEEP_JOBS  - finished jobs kept for status queries (default 1000)
+#
+#   python Service.py --port 8780
+#   python Service.py --socket /tmp/prism.sock
+# -------------------------
+SERVICE_HOST = os.getenv("PRISM_SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("PRISM_SERVICE_PORT", "8780"))
+SERVICE_WORKERS = int(os.getenv("PRISM_SERVICE_WORKERS", "8"))
+SERVICE_THREADS = int(os.getenv("PRISM_SERVICE_THREADS", "64"))
+SERVICE_KEEP_JOBS = int(os.getenv("PRISM_SERVICE_KEEP_JOBS", "1000"))
+JOB_KINDS = ("plan", "write", "story")
+FINISHED = ("completed", "failed", "cancelled")
+
+
+def now_str():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class JobError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# -------------------------
+# JobManager: jobs are coroutines on one event loop running in a background
+# thread; a semaphore bounds how many run at once
+# -------------------------
+class JobManager:
+    def __init__(self, workers=SERVICE_WORKERS, threads=SERVICE_THREADS, keep_jobs=SERVICE_KEEP_JOBS):
+        self.workers = max(1, workers)
+        self.keep_jobs = keep_jobs
+        self.jobs = {}
+        self._events = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=threads, thread_name_prefix="prism-llm"))
+        self._slots = None
+        self._thread = threading.Thread(target=self._run_loop, name="prism-service-loop", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._init_slots(), self.loop).result()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _init_slots(self):
+        self._slots = asyncio.Semaphore(self.workers)
+
+    def warm_up(self):
+        # build the default backend client and the log writer now, not on the first job
+        for llm in (Plan.client, Plan.aclient):
+            if isinstance(llm, ModelRouter):
+                llm.client_for(llm.default_model)
+        LogWriter.get_log_writer()
+
+    # ---- job lifecycle ----
+    def submit(self, spec):
+        kind = spec.get("kind", "story")
+        if kind not in JOB_KINDS:
+            raise JobError(400, f"unknown job kind {kind!r} (expected one of {', '.join(JOB_KINDS)})")
+        if kind in ("plan", "story") and not spec.get("task"):
+            raise JobError(400, "task is required")
+        if kind == "write" and not (spec.get("plan") or spec.get("plan_path")):
+            raise JobError(400, "plan or plan_path is required")
+        job_id = uuid.uuid4().hex[:12]
+        example_id = spec.get("example_id") or f"job_{job_id}"
+        job = {
+            "job_id": job_id, "kind": kind, "example_id": example_id, "status": "queued",
+            "submitted_at": now_str(), "started_at": None, "finished_at": None,
+            "result": None, "error": None,
+        }
+        with self._lock:
+            # checkpoints and usage accounting are keyed by example_id
+            if any(j["example_id"] == example_id and j["status"] not in FINISHED for j in self.jobs.values()):
+                raise JobError(409, f"{example_id} already has an active job")
+            self.jobs[job_id] = job
+            self._events[job_id] = threading.Event()
+        future = asyncio.run_coroutine_threadsafe(self._run(job, spec), self.loop)
+        with self._lock:
+            if job["status"] not in FINISHED:
+                self._futures[job_id] = future
+        # also covers a job cancelled before its coroutine ever started
+        future.add_done_callback(lambda _: self._finish(job))
+        return self.get(job_id)
+
+    async def _run(self, job, spec):
+        try:
+            async with self._slots:
+                self._update(job, status="running", started_at=now_str())
+                start = time.perf_counter()
+                result = await self._execute(job, spec)
+                self._update(job, status="completed", result=result, duration_s=round(time.perf_counter() - start, 3))
+        except asyncio.CancelledError:
+            self._update(job, status="cancelled")
+            raise
+        except Exception as e:
+            print(f"[ERROR] job {job['job_id']} ({job['example_id']}) failed: {e}")
+            self._update(job, status="failed", error=f"{type(e).__name__}: {e}")
+
+    async def _execute(self, job, spec):
+        sid = job["example_id"]
+        output_dir = spec.get("output_dir")
+        try:
+            if job["kind"] == "write":
+                return await Write.amain(example_id=sid, plan=spec.get("plan"), plan_path=spec.get("plan_path"),
+                                         output_dir=output_dir, write_files=bool(output_dir))
+            plan = await Plan.amain(example_id=sid, task=spec["task"], output_dir=output_dir)
+            if job["kind"] == "plan":
+                return plan
+            story = await Write.amain(example_id=sid, plan=plan, output_dir=output_dir, write_files=bool(output_dir))
+            return {"plan": plan, "write": story}
+        finally:
+            if not output_dir:
+                # no usage_report.json was written: hand the report back with the job instead
+                job["usage"] = pop_usage_report(sid)
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+
+    def _finish(self, job):
+        with self._lock:
+            if job["status"] not in FINISHED:
+                job["status"] = "cancelled"
+            job["finished_at"] = job["finished_at"] or now_str()
+            event = self._events.pop(job["job_id"], None)
+            self._futures.pop(job["job_id"], None)
+            self._prune()
+        if event is not None:
+            event.set()
+
+    def _prune(self):
+        finished = [j for j in self.jobs.values() if j["status"] in FINISHED]
+        for job in finished[:max(0, len(finished) - self.keep_jobs)]:
+            self.jobs.pop(job["job_id"], None)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        future = self._futures.get(job_id)
+        if future is not None:
+            # delivered to the coroutine at its next await; an LLM call already
+            # running on a worker thread finishes but its result is discarded
+            self.loop.call_soon_threadsafe(future.cancel)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                raise JobError(404, f"unknown job {job_id}")
+            return dict(job)  # snapshot: the loop thread keeps updating the job
+
+    def wait(self, job_id, timeout):
+        self.get(job_id)
+        event = self._events.get(job_id)
+        if event is not None and timeout:
+            event.wait(timeout)
+        return self.get(job_id)
+
+    def summaries(self):
+        with self._lock:
+            return [{k: v for k, v in job.items() if k not in ("result", "usage")} for job in self.jobs.values()]
+
+    def health(self):
+        with self._lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"status": "ok", "workers": self.workers, "jobs": counts}
+
+    def close(self, timeout=30):
+        for future in list(self._futures.values()):
+            self.loop.call_soon_threadsafe(future.cancel)
+        deadline = time.monotonic() + timeout
+        while self._futures and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+
+# -------------------------
+# HTTP API
+# -------------------------
+class ServiceHandler(BaseHTTPRequestHandler):
+    manager = None  # set by make_server
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass  # one line per request would drown the stage logs
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        return parts, parse_qs(url.query)
+
+    def _handle(self, action):
+        try:
+            status, payload = action()
+        except JobError as e:
+            status, payload = e.status, {"error": str(e)}
+        except (ValueError, KeyError) as e:
+            status, payload = 400, {"error": f"bad request: {e}"}
+        except Exception as e:
+            print(f"[ERROR] service request failed: {e}")
+            status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+        self._send(status, payload)
+
+    def do_GET(self):
+        def action():
+            parts, query = self._route()
+            if parts == ["health"]:
+                return 200, self.manager.health()
+            if parts == ["jobs"]:
+                return 200, {"jobs": self.manager.summaries()}
+            if len(parts) == 2 and parts[0] == "jobs":
+                wait = float(query.get("wait", ["0"])[0])
+                return 200, self.manager.wait(parts[1], wait)
+            raise JobError(404, f"no route for GET {self.path}")
+        self._handle(action)
+
+    def do_POST(self):
+        def action():
+            parts, _ = self._route()
+            if parts != ["jobs"]:
+                raise JobError(404, f"no route for POST {self.path}")
+            length = int(self.headers.get("Content-Length") or 0)
+            spec = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+            if not isinstance(spec, dict):
+                raise ValueError("job spec must be a JSON object")
+            job = self.manager.submit(spec)
+            if spec.get("wait"):
+                job = self.manager.wait(job["job_id"], float(spec["wait"]))
+            return (200 if job["status"] in FINISHED else 202), job
+        self._handle(action)
+
+    def do_DELETE(self):
+        def action():
+            parts, _ = self._route()
+            if len(parts) == 2 and parts[0] == "jobs":
+                return 202, self.manager.cancel(parts[1])
+            raise JobError(404, f"no route for DELETE {self.path}")
+        self._handle(action)
+
+
+if hasattr(socketserver, "UnixStreamServer"):  # not on Windows
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            request, _ = super().get_request()
+            return request, ("unix", 0)  # BaseHTTPRequestHandler expects a (host, port) address
+
+
+def make_server(manager, host=SERVICE_HOST, port=SERVICE_PORT, socket_path=None):
+    handler = type("PrismServiceHandler", (ServiceHandler,), {"manager": manager})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # stale socket from a previous run
+        return UnixHTTPServer(socket_path, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT, socket_path=None, workers=SERVICE_WORKERS):
+    manager = JobManager(workers=workers)
+    manager.warm_up()
+    server = make_server(manager, host, port, socket_path)
+
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so call it off the main thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    where = socket_path or f"http://{host}:{port}"
+    print(f"[INFO] Prism service listening on {where} ({manager.workers} concurrent jobs)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("[INFO] Prism service stopping: cancelling jobs and draining logs")
+        server.server_close()
+        manager.close()
+        LogWriter.flush_logs()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+# -------------------------
+# CLI entry
+# -------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run Prism as a long-running local job service.")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--socket", default=os.environ.get("PRISM_SERVICE_SOCKET") or None,
+                        help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS, help="jobs run concurrently")
+    args = parser.parse_args()
+    if args.socket and not hasattr(socketserver, "UnixStreamServer"):
+        print("[ERROR] Unix sockets are not available on this platform, use --port")
+        sys.exit(1)
+    serve(args.host, args.port, args.socket, args.workers)
@@ -0,0 +1,167 @@
+import os
+import re
+import asyncio
+
+# -------------------------
+# Spectral Analysis band executor (shared by Plan and Write)
+# Bands are independent LLM calls, so they are gathered under a bounded
+# semaphore; results always come back in the given band order.
+# PRISM_SPECTRAL_WORKERS=1 restores the old sequential behaviour.
+# -------------------------
+SPECTRAL_MAX_WORKERS = int(os.getenv("PRISM_SPECTRAL_WORKERS", "5"))
+
+
+async def arun_spectral_bands(dimensions, run_band, max_workers=None):
+    # run_band(dim) is a coroutine function; a failed band yields None so its
+    # error text never reaches the critiques
+    workers = max_workers or SPECTRAL_MAX_WORKERS
+    workers = max(1, min(workers, len(dimensions)))
+    semaphore = asyncio.Semaphore(workers)
+
+    async def safe_run(dim):
+        async with semaphore:
+            try:
+                return await run_band(dim)
+            except Exception as e:
+                print(f"[ERROR] Spectral Analysis band {dim} failed: {e}")
+                return None
+
+    return list(await asyncio.gather(*(safe_run(dim) for dim in dimensions)))
+
+
+# -------------------------
+# Grade parsing and deterministic Focal Decision
+# The band grades usually decide the category on their own; the LLM Focal
+# Decision is only consulted when they are ambiguous or when targeted fixes
+# are needed for a reforge. Policy (env):
+#   PRISM_FOCAL_DECISION       - hybrid (default) | llm (always ask) | grades (never ask)
+#   PRISM_DECISION_FIX_SOURCE  - llm (ask for targeted fixes) | critiques (reuse B/C band critiques)
+#   PRISM_REFINE_CATEGORIES    - categories that trigger Beam Reforging (default Severe,Major)
+#   PRISM_DECISION_MIN_GRADES  - parsed grades required to decide without the LLM (default 4)
+# -------------------------
+GRADE_RE = re.compile(r"Grade\s*[:：]?\s*[*_]*\s*\(?([ABC])\b", re.IGNORECASE)
+CATEGORY_RE = re.compile(r"category\s*[*_]*\s*[:：]?\s*[*_]*\s*['\"(]?\s*(Severe|Major|Minor|No Issue)", re.IGNORECASE)
+FIXES_RE = re.compile(r"(?:suggest(?:ed)?\s+)?targeted fixes\s*[*_]*\s*[:：]\s*(.*)", re.DOTALL | re.IGNORECASE)
+GRADE_SCORES = {"A": 3, "B": 2, "C": 1}
+CATEGORIES = ("Severe", "Major", "Minor", "No Issue")
+
+
+class DecisionPolicy:
+    def __init__(self, mode=None, fix_source=None, refine_categories=None, min_grades=None):
+        self.mode = mode or os.getenv("PRISM_FOCAL_DECISION", "hybrid")
+        self.fix_source = fix_source or os.getenv("PRISM_DECISION_FIX_SOURCE", "llm")
+        categories = refine_categories or os.getenv("PRISM_REFINE_CATEGORIES", "Severe,Major").split(",")
+        self.refine_categories = {c.strip().lower() for c in categories if c.strip()}
+        self.min_grades = int(min_grades if min_grades is not None else os.getenv("PRISM_DECISION_MIN_GRADES", "4"))
+        if self.mode not in ("hybrid", "llm", "grades"):
+            raise ValueError(f"unknown Focal Decision mode {self.mode!r}")
+        if self.fix_source not in ("llm", "critiques"):
+            raise ValueError(f"unknown fix source {self.fix_source!r}")
+
+    def needs_refine(self, category):
+        return category is not None and category.lower() in self.refine_categories
+
+
+def parse_grade(text):
+    match = GRADE_RE.search(text or "")
+    return match.group(1).upper() if match else None
+
+
+def parse_category(text):
+    match = CATEGORY_RE.search(text or "")
+    if not match:
+        return None
+    return next(c for c in CATEGORIES if c.lower() == match.group(1).lower())
+
+
+def decide_from_grades(grade_counts, min_grades=4):
+    # returns (category, ambiguous)
+    total = sum(grade_counts.values())
+    if total == 0:
+        return None, True
+    a, b, c = grade_counts.get("A", 0), grade_counts.get("B", 0), grade_counts.get("C", 0)
+    if total >= min_grades:
+        if a == total:
+            return "No Issue", False
+        if c * 2 > total:
+            return "Severe", False
+        if b * 2 > total:
+            return "Major", False
+        if a * 2 > total and c == 0:
+            return "Minor", False
+    # no clear majority (or too few bands): best guess from the average score
+    average = (3 * a + 2 * b + c) / total
+    if a == total:
+        category = "No Issue"
+    elif average >= 2.5:
+        category = "Minor"
+    elif average >= 1.5:
+        category = "Major"
+    else:
+        category = "Severe"
+    return category, True
+
+
+def critique_fixes(band_outputs):
+    # targeted fixes taken straight from the bands that did not grade A
+    fixes = []
+    for dim, output in band_outputs:
+        if output is not None and parse_grade(output) in ("B", "C"):
+            fixes.append(f"{dim}:\n{output}")
+    return "\n\n".join(fixes)
+
+
+def focal_decision_needs_llm(grade_counts, policy=None):
+    policy = policy or DecisionPolicy()
+    category, ambiguous = decide_from_grades(grade_counts, policy.min_grades)
+    return (
+        policy.mode == "llm"
+        or (policy.mode == "hybrid" and ambiguous)
+        or (policy.mode != "grades" and policy.needs_refine(category) and policy.fix_source == "llm")
+    )
+
+
+async def aresolve_focal_decision(grade_counts, band_outputs, run_llm_decision, policy=None):
+    # run_llm_decision() is a coroutine function issuing the module's own
+    # Focal Decision call; it is only awaited when the grades are not enough
+    policy = policy or DecisionPolicy()
+    decision_output = await run_llm_decision() if focal_decision_needs_llm(grade_counts, policy) else None
+    return conclude_focal_decision(grade_counts, band_outputs, decision_output, policy)
+
+
+def conclude_focal_decision(grade_counts, band_outputs, decision_output=None, policy=None):
+    # decision_output: text of the LLM Focal Decision, or None when it was not needed
+    policy = policy or DecisionPolicy()
+    category, ambiguous = decide_from_grades(grade_counts, policy.min_grades)
+    source = "grades"
+
+    if decision_output is not None:
+        llm_category = parse_category(decision_output)
+        if llm_category and (ambiguous or policy.mode == "llm"):
+            category, source = llm_category, "llm"
+        elif ambiguous:
+            source = "fallback"
+            print(f"[WARN] Focal Decision category not parsed; using grade average ({category})")
+    elif ambiguous:
+        source = "fallback"
+
+    if category is None:
+        # nothing parsed at all: keep the historical default and refine
+        category, source = "Major", "fallback"
+
+    need_refine = policy.needs_refine(category)
+    suggestions = ""
+    if need_refine:
+        if decision_output is not None:
+            fixes = FIXES_RE.search(decision_output)
+            suggestions = fixes.group(1).strip() if fixes else decision_output.strip()
+        else:
+            suggestions = critique_fixes(band_outputs)
+    return {
+        "category": category,
+        "need_refine": need_refine,
+        "suggestions": suggestions,
+        "source": source,
+        "llm_called": decision_output is not None,
+        "output": decision_output,
+    }
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from Budget import stage_family
+
+# -------------------------
+# Stage-level tracing for the Prism pipeline
+#   PRISM_TRACE_PATH - JSONL file receiving one record per span (unset = no export)
+#   PRISM_VERBOSE=1  - echo every full request/response to stdout (off by default)
+# Span names follow the log_type without the "prism_" prefix, e.g.
+# devise_conflict, beam_focusing, spectral_analysis_Depth, weave_Climax, synthesis.
+# -------------------------
+TRACE_PATH = os.getenv("PRISM_TRACE_PATH", "")
+VERBOSE = os.getenv("PRISM_VERBOSE", "0") == "1"
+
+
+def echo(*args):
+    if VERBOSE:
+        print(*args)
+
+
+def span_name(log_type):
+    name = log_type[len("prism_"):] if log_type.startswith("prism_") else log_type
+    return "synthesis" if name == "write_synthesis" else name
+
+
+class Tracer:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def emit(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_tracer = Tracer(TRACE_PATH) if TRACE_PATH else None
+
+
+def get_tracer():
+    return _tracer
+
+
+def set_trace_path(path):
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = Tracer(path) if path else None
+    return _tracer
+
+
+@contextmanager
+def span(name, story_id=None, **attrs):
+    # the yielded dict can be filled in by the caller (tokens, cache hit, retries, ...)
+    record = {"span": name, "family": stage_family(name), "story_id": story_id,
+              "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]}
+    record.update(attrs)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record["duration_s"] = round(time.perf_counter() - start, 4)
+        tracer = _tracer
+        if tracer is not None:
+            try:
+                tracer.emit(record)
+            except Exception as e:
+                print(f"[WARN] cannot write trace span {name}: {e}")
+
+
+def annotate(record, usage, trimmed_chars=0):
+    usage = usage or {}
+    record["prompt_tokens"] = usage.get("prompt_tokens")
+    record["completion_tokens"] = usage.get("completion_tokens")
+    record["cached_prompt_tokens"] = usage.get("cached_prompt_tokens")
+    record["cache_hit"] = bool(usage.get("cached"))
+    record["retries"] = usage.get("retries", 0)
+    record["model"] = usage.get("model")
+    record["hedged"] = bool(usage.get("hedged"))
+    record["hedge_won"] = bool(usage.get("hedge_won"))
+    record["timeouts"] = usage.get("timeouts", 0)
+    record["trimmed_chars"] = trimmed_chars
+
+
+# -------------------------
+# aggregate report (p50/p95 per span name and per family)
+# -------------------------
+def load_spans(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def aggregate(spans, key="span"):
+    groups = {}
+    for s in spans:
+        groups.setdefault(s.get(key), []).append(s)
+    report = {}
+    for name, items in sorted(groups.items(), key=lambda kv: str(kv[0])):
+        durations = [s.get("duration_s", 0.0) for s in items]
+        report[name] = {
+            "count": len(items),
+            "p50_s": round(percentile(durations, 0.50), 4),
+            "p95_s": round(percentile(durations, 0.95), 4),
+            "mean_s": round(sum(durations) / len(durations), 4),
+            "max_s": round(max(durations), 4),
+            "total_s": round(sum(durations), 4),
+            "errors": sum(1 for s in items if s.get("error")),
+            "retries": sum(s.get("retries", 0) or 0 for s in items),
+            "cache_hits": sum(1 for s in items if s.get("cache_hit")),
+            "hedged": sum(1 for s in items if s.get("hedged")),
+            "hedge_wins": sum(1 for s in items if s.get("hedge_won")),
+            "timeouts": sum(s.get("timeouts", 0) or 0 for s in items),
+            "prompt_tokens": sum(s.get("prompt_tokens", 0) or 0 for s in items),
+            "completion_tokens": sum(s.get("completion_tokens", 0) or 0 for s in items),
+            "cached_prompt_tokens": sum(s.get("cached_prompt_tokens", 0) or 0 for s in items),
+        }
+    return report
+
+
+def trace_report(path):
+    spans = list(load_spans(path))
+    return {
+        "spans": len(spans),
+        "stories": len({s.get("story_id") for s in spans}),
+        "by_family": aggregate(spans, key="family"),
+        "by_span": aggregate(spans, key="span"),
+    }
+
+
+def write_trace_report(trace_path, report_path):
+    report = trace_report(trace_path)
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[INFO] Trace report written to {report_path}")
+    return report
+
+
+# -------------------------
+# CLI: python Trace.py trace.jsonl [report.json]
+# -------------------------
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python Trace.py <trace.jsonl> [report.json]")
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        write_trace_report(sys.argv[1], sys.argv[2])
+    else:
+        report = trace_report(sys.argv[1])
+        print(f"{'family':40s} {'count':>6s} {'p50_s':>8s} {'p95_s':>8s} {'total_s':>9s}")
+        for name, row in report["by_family"].items():
+            print(f"{str(name):40s} {row['count']:6d} {row['p50_s']:8.2f} {row['p95_s']:8.2f} {row['total_s']:9.1f}")
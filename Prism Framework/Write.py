@@ -1,46 +1,37 @@
 import os
 import re
 import json
+import asyncio
+import time
+import queue
+import threading
 from datetime import datetime
-import mysql.connector
-from zhipuai import ZhipuAI
+from Spectrum import arun_spectral_bands, parse_grade, aresolve_focal_decision
+# save_log queues rows to the shared pooled/batched writer (see LogWriter.py)
+from LogWriter import save_log
+# every completion goes through LLM.achat_completion (response cache, ...)
+from LLM import build_stage_messages, achat_completion, astream_chat_completion, last_usage
+# per-stage model routing over pluggable backends (see Router.py)
+from Router import get_router
+from Budget import SECTIONS, DIMENSIONS, fit_context, record_usage, record_parse, write_usage_report
+# Beam Reforging output format, tolerant parser and format-only repair (see Reforge.py)
+import Reforge
+# per-stage spans and opt-in verbose echo (see Trace.py)
+from Trace import span, span_name, annotate, echo
+from Checkpoint import CHECKPOINT_FILE, checkpointing, replay_stage, record_stage
 
 # -------------------------
-# database
 # -------------------------
-db_config = {
-    "host": "localhost",
-    "user": "root",
-    "password": "123456",
-    "database": "agent_room",
-    "auth_plugin": "mysql_native_password"
-}
+# routes each stage to its model / backend; every backend client is wrapped with
+# rate limiting, retry/backoff and adaptive concurrency (see Router.py, Limiter.py)
+client = get_router()
+# asyncio engine: with PRISM_ASYNC_CLIENT=1 calls go through the async-native HTTP
+# clients; otherwise the synchronous clients above are driven on worker threads
+aclient = get_router(is_async=True) if os.getenv("PRISM_ASYNC_CLIENT", "0") == "1" else None
 
-# -------------------------
-# -------------------------
-API_KEY = os.getenv("ZHIPUAI_API_KEY", "Your api key")
-client = ZhipuAI(api_key=API_KEY)
 
-# -------------------------
-def save_log(story_id, request_msg, response_msg, log_type):
-    try:
-        conn = mysql.connector.connect(**db_config)
-        cursor = conn.cursor()
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        sql = """
-            INSERT INTO story_logs (story_id, request_message, response_message, timestamp, type)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        cursor.execute(sql, (story_id, request_msg, response_msg, timestamp, log_type))
-        conn.commit()
-    except Exception as e:
-        print(f"[DB ERROR] write log error: {e}")
-    finally:
-        try:
-            cursor.close()
-            conn.close()
-        except Exception:
-            pass
+def engine_client():
+    return aclient if aclient is not None else client
 
 # -------------------------
 def extract_write_identifiers(plan_dict, story_dict):
@@ -54,55 +45,332 @@ def extract_write_identifiers(plan_dict, story_dict):
     return identifiers
 
 # -------------------------
-def call_agent_for_write(client, prompt, context_text, story_id, log_type="write"):
+# LLM call wrappers: checkpoint replay, span, usage accounting and logging around each stage
+# -------------------------
+async def acall_agent_for_write(client, prompt, context_text, story_id, log_type="write", on_chunk=None):
+    if on_chunk is not None:
+        # streaming mode: forward chunks as they arrive, still return the full text
+        parts = []
+        async for chunk in astream_agent_for_write(client, prompt, context_text, story_id, log_type=log_type):
+            parts.append(chunk)
+            on_chunk(log_type, chunk)
+        return "".join(parts)
+
+    # trim oversized context fields to the configured window (no-op by default)
+    context_text, trimmed_chars = fit_context(prompt, context_text, log_type)
     request_text = f"{prompt}\n{context_text}"
-    messages = [
-        {"role": "system", "content": "You are a creative writing assistant following the given prompt strictly."},
-        {"role": "user", "content": request_text}
-    ]
+    messages = build_stage_messages(prompt, context_text)
+    # stage completed by an interrupted earlier run: replay it from the checkpoint journal
+    replayed = replay_stage(story_id, log_type, request_text)
+    if replayed is not None:
+        return replayed
 
+    echo("\n--- Sending to LLM (WRITE stage) ---")
+    echo("REQUEST:\n", request_text)
 
-    print("\n--- Sending to LLM (WRITE stage) ---")
-    print("REQUEST:\n", request_text)
+    with span(span_name(log_type), story_id, log_type=log_type) as record:
+        try:
+            output = await achat_completion(client, messages, log_type=log_type)
+        except Exception as e:
+            # never hand error text downstream as if it were story text
+            print(f"[ERROR] LLM call error: {e}")
+            save_log(story_id, request_text, f"[ERROR] LLM call error: {e}", log_type)
+            raise
+        usage = last_usage()
+        annotate(record, usage, trimmed_chars)
 
-    try:
-        response = client.chat.completions.create(
-            model="glm-4-air",
-            messages=messages,
+    echo("\nRESPONSE:\n", output)
+    echo("--- End LLM response ---\n")
+
+    record_stage(story_id, log_type, request_text, output)
+    record_usage(story_id, log_type, usage, prompt_chars=len(request_text), trimmed_chars=trimmed_chars)
+    save_log(story_id, request_text, output, log_type, usage=usage, duration_s=record.get("duration_s"))
+
+    return output
+
+# -------------------------
+# Streaming variant: async generator of text chunks; the full text is still logged
+# -------------------------
+async def astream_agent_for_write(client, prompt, context_text, story_id, log_type="write"):
+    context_text, trimmed_chars = fit_context(prompt, context_text, log_type)
+    request_text = f"{prompt}\n{context_text}"
+    messages = build_stage_messages(prompt, context_text)
+
+    replayed = replay_stage(story_id, log_type, request_text)
+    if replayed is not None:
+        yield replayed
+        return
+
+    echo("\n--- Streaming from LLM (WRITE stage) ---")
+    echo("REQUEST:\n", request_text)
+
+    parts = []
+    started = time.perf_counter()
+    with span(span_name(log_type), story_id, log_type=log_type, stream=True) as record:
+        try:
+            async for chunk in astream_chat_completion(client, messages, log_type=log_type):
+                if not parts:
+                    record["first_chunk_s"] = round(time.perf_counter() - started, 4)
+                parts.append(chunk)
+                yield chunk
+        except Exception as e:
+            print(f"[ERROR] LLM stream error: {e}")
+            save_log(story_id, request_text, f"[ERROR] LLM stream error: {e}\n{''.join(parts)}", log_type)
+            raise
+        usage = last_usage()
+        annotate(record, usage, trimmed_chars)
+
+    output = "".join(parts)
+    echo("\nRESPONSE:\n", output)
+    echo("--- End LLM response ---\n")
+
+    record_stage(story_id, log_type, request_text, output)
+    record_usage(story_id, log_type, usage, prompt_chars=len(request_text), trimmed_chars=trimmed_chars)
+    save_log(story_id, request_text, output, log_type, usage=usage, duration_s=record.get("duration_s"))
+
+
+# -------------------------
+# Per-section review: Spectrum Conference, Spectral Analysis bands, Focal
+# Decision and (if needed) Beam Reforging of one drafted section.
+# Returns the reforged section text, or None to keep the draft.
+# -------------------------
+async def areview_section(llm, story_id, creative_writing_task, section, section_summary):
+    dimensions = DIMENSIONS
+    # Spectrum Conference Phase (temporary, single-round dialogue)
+    debate_prompt = (
+        "Initiate a Spectrum Conference: given the beam-focused summary of the section, run a single-round multi-agent collaborative discussion. Assign roles adaptively: Coherence Coordinator (structure), Innovator (originality), Expander (depth), Stylist (style). "
+        "Agents should exchange ideas synergistically: debate improvements, reflect briefly on others' ideas, and build toward unified suggestions. Produce a transcript (more than 10 exchanges) and conclude with consolidated, actionable suggestions aligned with the original task."
+    )
+    debate_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {section_summary}"
+    debate_output = await acall_agent_for_write(llm, debate_prompt, debate_context, story_id, log_type=f"prism_spectrum_conference_{section}")
+
+    # Spectral Analysis Phase (temporary, parallel)
+    critiques = ""
+    grade_counts = {"A": 0, "B": 0, "C": 0}
+    critique_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {section_summary}\n\nSpectrum Conference Transcript: {debate_output}"
+
+    async def run_critique_band(dim):
+        critique_prompt = (
+            f"Perform Spectral Analysis for one spectrum band: {dim}. "
+            f"For {dim} Analyst: Assess {'coherence, consistency, and progression' if dim=='Story Structure' else 'innovation, avoidance of clichés, and novel elements' if dim=='Originality' else 'character/setting richness and believability' if dim=='Depth' else 'variety, devices, and expressiveness' if dim=='Style' else 'adherence to original task (e.g., key elements, perspective, implications)'} (grade A/B/C, with evidence). "
+            "Start with Grade: X\nThen bullet points with suggestions. Ensure suggestions align with the original task."
         )
-        output = response.choices[0].message.content
-    except Exception as e:
-        print(f"[ERROR] LLM call error: {e}")
-        output = f"[ERROR] LLM call error: {e}"
+        return await acall_agent_for_write(llm, critique_prompt, critique_context, story_id, log_type=f"prism_spectral_analysis_{section}_{dim}")
+
+    # bands run concurrently; critiques/grades are still assembled in band order
+    critique_outputs = await arun_spectral_bands(dimensions, run_critique_band)
+    for dim, critique_output in zip(dimensions, critique_outputs):
+        if critique_output is None:
+            continue  # band failed after retries; judge on the remaining bands
+        critiques += f"\n{dim} Spectral Analysis:\n{critique_output}"
+        # Extract grade
+        grade = parse_grade(critique_output)
+        if grade:
+            grade_counts[grade] += 1
+
+    # Focal Decision Phase (temporary): decided from the grades; the LLM is only
+    # asked when they are ambiguous or targeted fixes are needed (see Spectrum.DecisionPolicy)
+    async def run_focal_decision():
+        decision_prompt = (
+            "Conduct a Focal Decision: given the spectral analyses (temporary), determine revisions for the section. Calculate majority grade (A/B/C by count). Output category: 'Severe (majority C)' / 'Major (majority B)' / 'Minor (majority A with B)' / 'No Issue (all A)', with reasons and confidence (High/Medium/Low). If <B, suggest targeted fixes."
+        )
+        decision_context = f"Spectral Analyses: {critiques}"
+        return await acall_agent_for_write(llm, decision_prompt, decision_context, story_id, log_type=f"prism_focal_decision_{section}")
+
+    decision = await aresolve_focal_decision(grade_counts, list(zip(dimensions, critique_outputs)), run_focal_decision)
+    print(f"[INFO] {story_id} {section} Focal Decision: {decision['category']} (from {decision['source']}, grades {grade_counts})")
+    need_refine = decision["need_refine"]
+    refine_suggestions = decision["suggestions"]
+
+    # Beam Reforging Phase (if needed)
+    if need_refine:
+        refine_format = f"Output: {section}: <refined text> "
+        refine_prompt = (
+            f"Perform Beam Reforging: given the beam-focused summary, spectral analyses, and focal decision suggestions (temporary), refine the {section}. Inject creative elements if Originality grade <B. Generate detailed, expansive refinements. "
+            + Reforge.output_format([section], refine_format) + "Ensure refinements match original task's style and requirements."
+        )
+        refine_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {section_summary}\n\nDecision Suggestions: {refine_suggestions}\n\nSpectral Analyses: {critiques}"
+        refine_output = await acall_agent_for_write(llm, refine_prompt, refine_context, story_id, log_type=f"prism_beam_reforging_{section}")
 
-    print("\nRESPONSE:\n", output)
-    print("--- End LLM response ---\n")
+        # Extract refined section (JSON, markdown headings, bold or plain "Section:" keys)
+        refined, parse_method = Reforge.parse_reforge(refine_output, [section])
+        if refined is None:
+            if Reforge.REFORGE_REPAIR == "full":
+                print(f"[WARN] Refined {section} failed to parse. Retrying with format fix.")
+                retry_refine_prompt = refine_prompt + " Strictly follow the output format with exact key."
+                retry_refine_output = await acall_agent_for_write(llm, retry_refine_prompt, refine_context, story_id, log_type=f"prism_beam_reforging_retry_{section}")
+            else:
+                # send back only the malformed output, not the whole reforge context
+                print(f"[WARN] Refined {section} failed to parse. Repairing the output format.")
+                repair_prompt, repair_context = Reforge.repair_request(refine_output, [section], refine_format)
+                retry_refine_output = await acall_agent_for_write(llm, repair_prompt, repair_context, story_id, log_type=f"prism_beam_reforging_repair_{section}")
+            refined, _ = Reforge.parse_reforge(retry_refine_output, [section])
+            parse_method = "repaired" if refined is not None else "failed"
+        record_parse(story_id, f"prism_beam_reforging_{section}", parse_method)
+
+        if refined is not None:
+            return refined[section]
+        print(f"[WARN] Retry failed for {section}. Keeping current.")
+    return None
 
-    try:
-        save_log(story_id, request_text, output, log_type)
-    except Exception as e:
-        print(f"[WARN] log error: {e}")
+# -------------------------
+# Rolling Beam Focusing request: previous summary + newest section only.
+# revised: (section, text) of the previous section when Beam Reforging replaced
+# the draft the previous summary was built from; it is folded into this call.
+# -------------------------
+def rolling_summary_request(creative_writing_task, plan_dict, previous_summary, section, section_text, revised=None):
+    prompt = (
+        "Beam Focusing: update the running summary of the story with the newly written section. Keep it concise, focusing on plot progression, character arcs, and key details "
+        "while preserving the original task's requirements. Retain sufficient details for expansive refinement and for writing the next sections. Output a compact beam-focused summary of the whole story so far."
+    )
+    if revised is not None:
+        prompt += f" The {revised[0]} section was revised after the summary so far was written; describe the revised version instead."
+    context = (
+        f"Original Task: {creative_writing_task}\n\nPlan: {json.dumps(plan_dict, ensure_ascii=False)}"
+        f"\n\nStory Summary So Far: {previous_summary or '(none, this is the first section)'}"
+    )
+    if revised is not None:
+        context += f"\n\nRevised Section ({revised[0]}): {revised[1]}"
+    context += f"\n\nNew Section ({section}): {section_text}"
+    return prompt, context
 
-    return output
+# -------------------------
+# Final Supervisor Synthesis (Beam Focusing for full and synthesis).
+# full_summary: reuse an existing summary of every refined section instead of
+# the prism_full_summary call. seams: sections were drafted in parallel and the
+# synthesis also has to reconcile the transitions between them.
+# -------------------------
+async def asynthesize_story(llm, story_id, creative_writing_task, story_dict, on_chunk=None, full_summary=None, seams=False):
+    if full_summary is None:
+        full_summary_prompt = (
+            "Beam Focusing: summarize all refined sections concisely, focusing on overall plot, character arcs, and key details "
+            "while preserving the original task's requirements. Retain sufficient details for expansive story generation. Output a compact beam-focused summary."
+        )
+        full_summary_context = f"Original Task: {creative_writing_task}\n\nRefined Sections: {json.dumps(story_dict, ensure_ascii=False)}"
+        full_summary = await acall_agent_for_write(llm, full_summary_prompt, full_summary_context, story_id, log_type="prism_full_summary")
+
+    synthesis_prompt = (
+        "Given all refined sections from story dict, synthesize the full story. Ensure overall coherence, resolve any inconsistencies, and optimize for all dimensions. Generate a complete, expansive narrative. "
+        "Output the complete narrative, strictly following the original task (e.g., perspective, ignoring word limits for fuller content)."
+    )
+    if seams:
+        synthesis_prompt += (
+            " The sections were written in parallel from a shared beat outline: reconcile the seams between them "
+            "(smooth the transitions, remove repeated introductions and recaps, and make names, timeline and details consistent)."
+        )
+    synthesis_context = f"Original Task: {creative_writing_task}\n\nFull Sections Summary: {full_summary}\n\nRefined Sections: {json.dumps(story_dict, ensure_ascii=False)}"
+    synthesis_output = await acall_agent_for_write(llm, synthesis_prompt, synthesis_context, story_id, log_type="prism_write_synthesis", on_chunk=on_chunk)
+    story_dict["Full Story"] = synthesis_output
 
+    return story_dict
 
 # -------------------------
-def generate_write_only(story_id, plan_dict, creative_writing_task):
+# Parallel section drafting (PRISM_PARALLEL_SECTIONS=1): one call derives a
+# per-section beat outline from the plan's Key Plot Points, then every section
+# is drafted, summarized and reviewed concurrently against that outline, and
+# the synthesis pass reconciles the seams. Write latency becomes roughly one
+# section's chain instead of five.
+# -------------------------
+BEAT_OUTLINE_FORMAT = "Output in exact format:\n" + "".join(f"{s}: <beats>\n" for s in SECTIONS)
+
+
+async def aoutline_section_beats(llm, story_id, plan_dict, creative_writing_task):
+    # returns {section: beats} or None when the outline cannot be parsed
+    outline_prompt = (
+        "Beat Outline: from the plan (especially the Key Plot Points), split the story into its five parts: "
+        f"{', '.join(SECTIONS)}. For each part list its beats in order: the events, the characters involved, where it happens, "
+        "and the state of the central conflict at its start and at its end, so that each part can be written on its own and still hand over "
+        "seamlessly to the next. " + Reforge.output_format(SECTIONS, BEAT_OUTLINE_FORMAT) + "Ensure fidelity to the original task."
+    )
+    outline_context = f"Original Task: {creative_writing_task}\n\nPlan: {json.dumps(plan_dict, ensure_ascii=False)}"
+    outline_output = await acall_agent_for_write(llm, outline_prompt, outline_context, story_id, log_type="prism_beat_outline")
+
+    beats, parse_method = Reforge.parse_reforge(outline_output, SECTIONS)
+    if beats is None:
+        print("[WARN] Beat outline failed to parse. Repairing the output format.")
+        repair_prompt, repair_context = Reforge.repair_request(outline_output, SECTIONS, BEAT_OUTLINE_FORMAT)
+        repaired_output = await acall_agent_for_write(llm, repair_prompt, repair_context, story_id, log_type="prism_beat_outline_repair")
+        beats, _ = Reforge.parse_reforge(repaired_output, SECTIONS)
+        parse_method = "repaired" if beats is not None else "failed"
+    record_parse(story_id, "prism_beat_outline", parse_method)
+    return beats
+
+
+async def adraft_section_from_beats(llm, story_id, plan_dict, creative_writing_task, beats, section, on_chunk=None):
+    # Writer Phase against the outline: neighbouring sections are being written at the same time
+    writer_prompt = (
+        f"Given the Creative Writing Task, the plan and the beat outline of the whole story, write the {section} part. Generate detailed, expansive content. "
+        f"The other parts are being written at the same time from the same outline: cover only the beats listed for {section}, "
+        "start from where the previous part's beats end and stop where the next part's beats begin. Do not re-explain details or events that belong to other parts. "
+        "Do not end the story (unless Resolution). Ensure fidelity to the original task."
+    )
+    writer_context = (
+        f"Original Task: {creative_writing_task}\n\nPlan: {json.dumps(plan_dict, ensure_ascii=False)}"
+        f"\n\nSection Beats: {json.dumps(beats, ensure_ascii=False)}"
+    )
+    draft = await acall_agent_for_write(llm, writer_prompt, writer_context, story_id, log_type=f"prism_weave_{section}", on_chunk=on_chunk)
+
+    # Section Beam Focusing Phase (temporary): this section only
+    section_summary_prompt = (
+        "Beam Focusing: summarize the new section concisely, focusing on plot progression, character arcs, and key details "
+        "while preserving the original task's requirements. Retain sufficient details for expansive refinement. Output a compact beam-focused summary."
+    )
+    section_summary_context = (
+        f"Original Task: {creative_writing_task}\n\nSection Beats ({section}): {beats[section]}"
+        f"\n\nNew Section ({section}): {draft}"
+    )
+    section_summary = await acall_agent_for_write(llm, section_summary_prompt, section_summary_context, story_id, log_type=f"prism_beam_focusing_section_{section}")
+
+    refined_section = await areview_section(llm, story_id, creative_writing_task, section, section_summary)
+    return refined_section if refined_section is not None else draft
+
+
+async def agenerate_parallel_sections(llm, story_id, plan_dict, creative_writing_task, beats, on_chunk=None):
+    drafts = await asyncio.gather(*(
+        adraft_section_from_beats(llm, story_id, plan_dict, creative_writing_task, beats, section, on_chunk=on_chunk)
+        for section in SECTIONS
+    ))
+    story_dict = dict(zip(SECTIONS, drafts))
+    return await asynthesize_story(llm, story_id, creative_writing_task, story_dict, on_chunk=on_chunk, seams=True)
+
+# -------------------------
+# on_chunk(log_type, text), if given, receives the section drafts and the final
+# synthesis as they stream in.
+# incremental_summary keeps a rolling summary (previous summary + newest section)
+# instead of re-summarizing every previous section at each step, so summary
+# input stays linear in the number of sections (PRISM_INCREMENTAL_SUMMARY=1).
+# parallel_sections drafts all sections concurrently from a beat outline
+# (PRISM_PARALLEL_SECTIONS=1); sequential drafting is the fallback when the
+# outline cannot be parsed.
+async def agenerate_write_only(story_id, plan_dict, creative_writing_task, on_chunk=None, incremental_summary=None,
+                               parallel_sections=None):
+    llm = engine_client()
+    if incremental_summary is None:
+        incremental_summary = os.environ.get("PRISM_INCREMENTAL_SUMMARY", "0") == "1"
+    if parallel_sections is None:
+        parallel_sections = os.environ.get("PRISM_PARALLEL_SECTIONS", "0") == "1"
+    if parallel_sections:
+        beats = await aoutline_section_beats(llm, story_id, plan_dict, creative_writing_task)
+        if beats is not None:
+            return await agenerate_parallel_sections(llm, story_id, plan_dict, creative_writing_task, beats, on_chunk=on_chunk)
+        print(f"[WARN] {story_id} beat outline unusable, drafting sections sequentially")
     story_dict = {}
-    sections = ["Exposition", "Rising Action", "Climax", "Falling Action", "Resolution"]
-    dimensions = ["Story Structure", "Originality", "Depth", "Style", "Task Alignment"]
-    max_iterations = 1  # per section
 
-    for i, section in enumerate(sections):
+    running_summary = ""  # incremental mode: summary of every section written so far
+    revised = None  # incremental mode: (section, text) reforged after running_summary was built
+    for i, section in enumerate(SECTIONS):
         # Prior sections summary (if any)
         prior_summary = ""
-        if i > 0:
+        if i > 0 and incremental_summary:
+            # reuse the previous section's post-section summary, no extra call
+            prior_summary = running_summary
+        elif i > 0:
             prior_summary_prompt = (
                 "Beam Focusing: summarize the previous story sections concisely, focusing on plot progression, character arcs, and key details "
                 "while preserving the original task's requirements. Retain sufficient details for expansive story generation. Output a compact beam-focused summary."
             )
-            prior_context = f"Original Task: {creative_writing_task}\n\nPrevious Sections: {json.dumps({s: story_dict[s] for s in sections[:i]}, ensure_ascii=False)}"
-            prior_summary = call_agent_for_write(client, prior_summary_prompt, prior_context, story_id, log_type=f"prism_beam_focusing_prior_{section}")
+            prior_context = f"Original Task: {creative_writing_task}\n\nPrevious Sections: {json.dumps({s: story_dict[s] for s in SECTIONS[:i]}, ensure_ascii=False)}"
+            prior_summary = await acall_agent_for_write(llm, prior_summary_prompt, prior_context, story_id, log_type=f"prism_beam_focusing_prior_{section}")
 
         # Writer Phase: Generate initial draft
         writer_prompt = (
@@ -111,125 +379,113 @@ def generate_write_only(story_id, plan_dict, creative_writing_task):
             "Focus only on the {section} part of the story. Do not write about the following parts of the story. Do not end the story (unless Resolution). Ensure fidelity to the original task."
         ).replace("<identifiers found in the scratchpad>", extract_write_identifiers(plan_dict, story_dict))
         writer_context = f"Original Task: {creative_writing_task}\n\nPlan: {json.dumps(plan_dict, ensure_ascii=False)}\n\nPrevious Sections Summary: {prior_summary}"
-        section_output = call_agent_for_write(client, writer_prompt, writer_context, story_id, log_type=f"prism_weave_{section}")
+        section_output = await acall_agent_for_write(llm, writer_prompt, writer_context, story_id, log_type=f"prism_weave_{section}", on_chunk=on_chunk)
         story_dict[section] = section_output
 
-        need_refine = False  # Flag for refinement
-
         # Section Beam Focusing Phase (temporary)
-        section_summary_prompt = (
-            "Beam Focusing: summarize the current story so far (including the new section) concisely, focusing on plot progression, character arcs, and key details "
-            "while preserving the original task's requirements. Retain sufficient details for expansive refinement. Output a compact beam-focused summary."
-        )
-        section_summary_context = f"Original Task: {creative_writing_task}\n\nPlan: {json.dumps(plan_dict, ensure_ascii=False)}\n\nCurrent Story Sections: {json.dumps(story_dict, ensure_ascii=False)}"
-        section_summary = call_agent_for_write(client, section_summary_prompt, section_summary_context, story_id, log_type=f"prism_beam_focusing_section_{section}")
-
-        # Spectrum Conference Phase (temporary, single-round dialogue)
-        debate_prompt = (
-            "Initiate a Spectrum Conference: given the beam-focused summary of the section, run a single-round multi-agent collaborative discussion. Assign roles adaptively: Coherence Coordinator (structure), Innovator (originality), Expander (depth), Stylist (style). "
-            "Agents should exchange ideas synergistically: debate improvements, reflect briefly on others' ideas, and build toward unified suggestions. Produce a transcript (more than 10 exchanges) and conclude with consolidated, actionable suggestions aligned with the original task."
-        )
-        debate_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {section_summary}"
-        debate_output = call_agent_for_write(client, debate_prompt, debate_context, story_id, log_type=f"prism_spectrum_conference_{section}")
-
-        # Spectral Analysis Phase (temporary, parallel)
-        critiques = ""
-        grade_counts = {"A": 0, "B": 0, "C": 0}
-        for dim in dimensions:
-            critique_prompt = (
-                f"Perform Spectral Analysis for one spectrum band: {dim}. "
-                f"For {dim} Analyst: Assess {'coherence, consistency, and progression' if dim=='Story Structure' else 'innovation, avoidance of clichés, and novel elements' if dim=='Originality' else 'character/setting richness and believability' if dim=='Depth' else 'variety, devices, and expressiveness' if dim=='Style' else 'adherence to original task (e.g., key elements, perspective, implications)'} (grade A/B/C, with evidence). "
-                "Start with Grade: X\nThen bullet points with suggestions. Ensure suggestions align with the original task."
+        if incremental_summary:
+            section_summary_prompt, section_summary_context = rolling_summary_request(
+                creative_writing_task, plan_dict, prior_summary, section, story_dict[section], revised=revised
             )
-            critique_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {section_summary}\n\nSpectrum Conference Transcript: {debate_output}"
-            critique_output = call_agent_for_write(client, critique_prompt, critique_context, story_id, log_type=f"prism_spectral_analysis_{section}_{dim}")
-            critiques += f"\n{dim} Spectral Analysis:\n{critique_output}"
-            # Extract grade
-            grade_match = re.search(r'Grade: (A|B|C)', critique_output, re.IGNORECASE)
-            if grade_match:
-                grade = grade_match.group(1).upper()
-                grade_counts[grade] += 1
-
-        # Focal Decision Phase (temporary)
-        decision_prompt = (
-            "Conduct a Focal Decision: given the spectral analyses (temporary), determine revisions for the section. Calculate majority grade (A/B/C by count). Output category: 'Severe (majority C)' / 'Major (majority B)' / 'Minor (majority A with B)' / 'No Issue (all A)', with reasons and confidence (High/Medium/Low). If <B, suggest targeted fixes."
-        )
-        decision_context = f"Spectral Analyses: {critiques}"
-        decision_output = call_agent_for_write(client, decision_prompt, decision_context, story_id, log_type=f"prism_focal_decision_{section}")
-
-        # Parse decision category
-        category_match = re.search(r'category: \'(Severe|Major|Minor|No Issue)\'', decision_output, re.IGNORECASE)
-        if category_match:
-            category = category_match.group(1).upper()
-            if category in ['SEVERE', 'MAJOR']:
-                need_refine = True
-                # Extract suggestions for refine
-                suggestions = re.search(r'suggest targeted fixes:\s*(.*)', decision_output, re.DOTALL | re.IGNORECASE)
-                refine_suggestions = suggestions.group(1).strip() if suggestions else ""
-            else:
-                need_refine = False
         else:
-            need_refine = True  # Default to refine if parse fails
-            refine_suggestions = ""
-
-        # Beam Reforging Phase (if needed, overwrite story_dict)
-        if need_refine:
-            refine_prompt = (
-                f"Perform Beam Reforging: given the beam-focused summary, spectral analyses, and focal decision suggestions (temporary), refine the {section}. Inject creative elements if Originality grade <B. Generate detailed, expansive refinements. "
-                f"Output: {section}: <refined text> Ensure refinements match original task's style and requirements."
+            section_summary_prompt = (
+                "Beam Focusing: summarize the current story so far (including the new section) concisely, focusing on plot progression, character arcs, and key details "
+                "while preserving the original task's requirements. Retain sufficient details for expansive refinement. Output a compact beam-focused summary."
             )
-            refine_context = f"Original Task: {creative_writing_task}\n\nBeam Focused Summary: {section_summary}\n\nDecision Suggestions: {refine_suggestions}\n\nSpectral Analyses: {critiques}"
-            refine_output = call_agent_for_write(client, refine_prompt, refine_context, story_id, log_type=f"prism_beam_reforging_{section}")
-
-            # Extract refined section (more flexible regex)
-            refined_match = re.search(re.escape(section) + r'\s*:\s*(.*)', refine_output, re.DOTALL | re.IGNORECASE)
-            if refined_match:
-                refined_section = refined_match.group(1).strip()
-                story_dict[section] = refined_section
-            else:
-                print(f"[WARN] Refined {section} failed to parse. Retrying with format fix.")
-                # Retry with format fix
-                retry_refine_prompt = refine_prompt + " Strictly follow the output format with exact key."
-                retry_refine_output = call_agent_for_write(client, retry_refine_prompt, refine_context, story_id, log_type=f"prism_beam_reforging_retry_{section}")
-                retry_match = re.search(re.escape(section) + r'\s*:\s*(.*)', retry_refine_output, re.DOTALL | re.IGNORECASE)
-                if retry_match:
-                    story_dict[section] = retry_match.group(1).strip()
-                else:
-                    print(f"[WARN] Retry failed for {section}. Keeping current.")
+            section_summary_context = f"Original Task: {creative_writing_task}\n\nPlan: {json.dumps(plan_dict, ensure_ascii=False)}\n\nCurrent Story Sections: {json.dumps(story_dict, ensure_ascii=False)}"
+        section_summary = await acall_agent_for_write(llm, section_summary_prompt, section_summary_context, story_id, log_type=f"prism_beam_focusing_section_{section}")
+        running_summary = section_summary
+
+        refined_section = await areview_section(llm, story_id, creative_writing_task, section, section_summary)
+        section_reforged = refined_section is not None
+        if section_reforged:
+            story_dict[section] = refined_section
+
+        # the rolling summary described the draft; the next section's rolling call
+        # folds the reforged text in instead of paying for a separate refresh
+        revised = (section, refined_section) if incremental_summary and section_reforged else None
+
+    if revised is not None:
+        # the last section has no next rolling call, but its summary stands in
+        # for prism_full_summary, so refresh it once
+        rolling_prompt, rolling_context = rolling_summary_request(
+            creative_writing_task, plan_dict, prior_summary, revised[0], revised[1]
+        )
+        running_summary = await acall_agent_for_write(llm, rolling_prompt, rolling_context, story_id, log_type=f"prism_beam_focusing_rolling_{revised[0]}")
 
-    # Final Supervisor Synthesis (Beam Focusing for full and synthesis)
-    full_summary_prompt = (
-        "Beam Focusing: summarize all refined sections concisely, focusing on overall plot, character arcs, and key details "
-        "while preserving the original task's requirements. Retain sufficient details for expansive story generation. Output a compact beam-focused summary."
-    )
-    full_summary_context = f"Original Task: {creative_writing_task}\n\nRefined Sections: {json.dumps(story_dict, ensure_ascii=False)}"
-    full_summary = call_agent_for_write(client, full_summary_prompt, full_summary_context, story_id, log_type="prism_full_summary")
+    # the rolling summary already covers every refined section
+    return await asynthesize_story(llm, story_id, creative_writing_task, story_dict, on_chunk=on_chunk,
+                                   full_summary=running_summary if incremental_summary else None)
 
-    synthesis_prompt = (
-        "Given all refined sections from story dict, synthesize the full story. Ensure overall coherence, resolve any inconsistencies, and optimize for all dimensions. Generate a complete, expansive narrative. "
-        "Output the complete narrative, strictly following the original task (e.g., perspective, ignoring word limits for fuller content)."
-    )
-    synthesis_context = f"Original Task: {creative_writing_task}\n\nFull Sections Summary: {full_summary}\n\nRefined Sections: {json.dumps(story_dict, ensure_ascii=False)}"
-    synthesis_output = call_agent_for_write(client, synthesis_prompt, synthesis_context, story_id, log_type="prism_write_synthesis")
-    story_dict["Full Story"] = synthesis_output
 
-    return story_dict
+def generate_write_only(story_id, plan_dict, creative_writing_task, on_chunk=None, incremental_summary=None,
+                        parallel_sections=None):
+    # synchronous entry point: runs the asyncio engine on a private event loop
+    return asyncio.run(agenerate_write_only(story_id, plan_dict, creative_writing_task, on_chunk=on_chunk,
+                                            incremental_summary=incremental_summary, parallel_sections=parallel_sections))
+
+# -------------------------
+# Generator API for downstream consumers: runs generate_write_only in a
+# background thread and yields (log_type, chunk) pairs while it streams.
+# The last item is ("story_dict", story_dict).
+# -------------------------
+def iter_write_stream(story_id, plan_dict, creative_writing_task):
+    chunks = queue.Queue()
+    done = object()
+    result = {}
+
+    def run():
+        try:
+            result["story_dict"] = generate_write_only(
+                story_id, plan_dict, creative_writing_task,
+                on_chunk=lambda log_type, chunk: chunks.put((log_type, chunk)),
+            )
+        except Exception as e:
+            result["error"] = e
+        finally:
+            chunks.put(done)
+
+    worker = threading.Thread(target=run, name=f"prism-write-{story_id}", daemon=True)
+    worker.start()
+    while True:
+        item = chunks.get()
+        if item is done:
+            break
+        yield item
+    worker.join()
+    if "error" in result:
+        raise result["error"]
+    yield "story_dict", result["story_dict"]
 
 # -------------------------
 def extract_full_story_from_story_dict(story_dict):
     if "Full Story" in story_dict:
         return story_dict["Full Story"].strip()
 
-    sections = ["Exposition", "Rising Action", "Climax", "Falling Action", "Resolution"]
-    full = [story_dict.get(sec, "").strip() for sec in sections if sec in story_dict]
+    full = [story_dict.get(sec, "").strip() for sec in SECTIONS if sec in story_dict]
     if full:
         return "\n\n".join(full)
 
     return ""
 
 # -------------------------
-def main(example_id=None, story_id=None, plan_path=None, plan_file=None, output_dir=None, output_txt=None, output_json=None):
+# main(...) is a thin synchronous wrapper; amain(...) is the same entry point
+# for callers already inside an event loop
+# -------------------------
+def main(example_id=None, story_id=None, plan_path=None, plan_file=None, output_dir=None, output_txt=None, output_json=None, stream=None, plan=None,
+         write_files=True):
+    return asyncio.run(amain(example_id=example_id, story_id=story_id, plan_path=plan_path, plan_file=plan_file,
+                             output_dir=output_dir, output_txt=output_txt, output_json=output_json, stream=stream, plan=plan,
+                             write_files=write_files))
+
+
+# write_files=False returns the result only (no story files, checkpoint journal or
+# usage_report.json); used by the worker service (Service.py)
+async def amain(example_id=None, story_id=None, plan_path=None, plan_file=None, output_dir=None, output_txt=None, output_json=None, stream=None, plan=None,
+                write_files=True):
     sid = example_id or story_id or "example_unknown"
+    if stream is None:
+        stream = os.environ.get("PRISM_WRITE_STREAM", "0") == "1"
 
     plan_path = plan_path or plan_file
 
@@ -246,7 +502,11 @@ def main(example_id=None, story_id=None, plan_path=None, plan_file=None, output_
 
     plan_dict = None
     creative_writing_task = ""
-    if plan_path and os.path.exists(plan_path):
+    if plan is not None:
+        # plan result handed over in memory (Plan.main return value), no file round-trip
+        plan_dict = plan.get("plan")
+        creative_writing_task = plan.get("task", "")
+    elif plan_path and os.path.exists(plan_path):
         try:
             with open(plan_path, "r", encoding="utf-8") as f:
                 data = json.load(f)
@@ -279,7 +539,30 @@ def main(example_id=None, story_id=None, plan_path=None, plan_file=None, output_
         plan_dict = {}
         creative_writing_task = ""
 
-    story_dict = generate_write_only(sid, plan_dict, creative_writing_task)
+    # journal every completed stage next to the outputs so a rerun resumes where it died
+    checkpoint_path = os.path.join(os.path.dirname(output_json), CHECKPOINT_FILE.format(stage="write")) if write_files else None
+    with span("write", sid), checkpointing(sid, checkpoint_path):
+        if stream and write_files:
+            # synthesis chunks go straight to story_text.txt; it is rewritten with the final text below
+            try:
+                os.makedirs(os.path.dirname(output_txt), exist_ok=True)
+                stream_file = open(output_txt, "w", encoding="utf-8")
+            except Exception as e:
+                print(f"[WARN] cannot stream to {output_txt}: {e}")
+                stream_file = None
+
+            def write_chunk(log_type, chunk):
+                if stream_file is not None and log_type == "prism_write_synthesis":
+                    stream_file.write(chunk)
+                    stream_file.flush()
+
+            try:
+                story_dict = await agenerate_write_only(sid, plan_dict, creative_writing_task, on_chunk=write_chunk)
+            finally:
+                if stream_file is not None:
+                    stream_file.close()
+        else:
+            story_dict = await agenerate_write_only(sid, plan_dict, creative_writing_task)
 
     full_story = extract_full_story_from_story_dict(story_dict)
 
@@ -289,6 +572,8 @@ def main(example_id=None, story_id=None, plan_path=None, plan_file=None, output_
         "story_dict": story_dict,
         "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
+    if not write_files:
+        return result
 
     try:
         os.makedirs(os.path.dirname(output_txt), exist_ok=True)
@@ -313,6 +598,8 @@ def main(example_id=None, story_id=None, plan_path=None, plan_file=None, output_
     except Exception as e:
         print(f"[WARN] write error {output_txt}: {e}")
 
+    write_usage_report(sid, os.path.join(os.path.dirname(output_json), "usage_report.json"))
+
     return result
 
 # -------------------------